@@ -1,30 +1,170 @@
+import logging
 import pandas as pd
-from logging import Logger
 from typing import Optional, Union
 import numpy as np
 
+from algo_code.intrabar import IntrabarCandles
 from algo_code.order_block import OrderBlock
+import algo_code.position_prices_setup as setup
+from algo_code.trade_records import TradeRecords
 from utils.logger import LoggerSingleton
 import utils.datatypes as dt
+from utils.time_index import PairTimeIndex
 from utils.general_utils import calc_candle_percentage
 from utils import constants
 
-ob_logger: Logger | None = None
+
+def first_index(mask: np.ndarray) -> int:
+    # The index of the first True element of a boolean array, or the length of the array if there is none
+    index = int(mask.argmax()) if len(mask) else 0
+    return index if len(mask) and mask[index] else len(mask)
+
+
+def find_position_exit(events_after_entry: np.ndarray, n_targets: float, trailing_sl_target_id: float) -> tuple[int, str | None, np.ndarray, float]:
+    """
+    Finds the exit of a position from the events after its entry, with whole-array NumPy operations instead of a loop over the candles:
+    1) A full target exits at the first n_targets event, and a stoploss exits at the first -1 event.
+    2) If trailing is enabled, the trailing stoploss is triggered by the first trailing_sl_target_id event, and exits at the first entry (0) event
+       after it.
+    3) The position exits at the earliest of these. The targets hit before the exit are the events which reach a new highest target, found as the
+       points where the running maximum of the target events increases.
+
+    Args:
+        events_after_entry (np.ndarray): The events array of the order block, starting at the entry candle
+        n_targets (float): The number of targets of the position
+        trailing_sl_target_id (float): The target which triggers the trailing stoploss, 0 if trailing is disabled
+
+    Returns:
+        tuple: The index of the exit relative to the entry, the exit type ('full_target', 'stoploss', 'trailing' or None if the position doesn't
+        exit), the indices of the targets hit relative to the entry and the highest target hit before the exit.
+    """
+    n_events = len(events_after_entry)
+
+    full_target_index = first_index(events_after_entry == n_targets)
+    stoploss_index = first_index(events_after_entry == -1)
+
+    trailing_index = n_events
+    if trailing_sl_target_id != 0:
+        trailing_trigger_index = first_index(events_after_entry == trailing_sl_target_id)
+        if trailing_trigger_index < n_events:
+            trailing_index = trailing_trigger_index + 1 + first_index(events_after_entry[trailing_trigger_index + 1:] == 0)
+
+    exit_index = min(full_target_index, stoploss_index, trailing_index)
+    if exit_index == n_events:
+        exit_type = None
+    elif exit_index == full_target_index:
+        exit_type = 'full_target'
+    elif exit_index == stoploss_index:
+        exit_type = 'stoploss'
+    else:
+        exit_type = 'trailing'
+
+    # The intermediate target events before the exit, and the highest target reached up to each of them
+    events_before_exit = events_after_entry[:exit_index]
+    target_events = np.where((events_before_exit >= 1) & (events_before_exit < n_targets), events_before_exit, 0)
+    highest_targets = np.maximum.accumulate(target_events) if len(target_events) else target_events
+    previous_highest_targets = np.concatenate(([0], highest_targets[:-1]))
+    target_hit_indices = np.flatnonzero(target_events > previous_highest_targets)
+
+    last_target = highest_targets[-1] if len(highest_targets) else 0
+
+    return exit_index, exit_type, target_hit_indices, last_target
+
+
+def calc_ob_events(ob: OrderBlock, highs: np.ndarray, lows: np.ndarray) -> np.ndarray:
+    """
+    Calculates the event each candle triggers for an order block, from the highs and lows of the candles. Used for the candles of the pair after the
+    formation of the order block, and for the lower timeframe candles within a single candle of the pair (see Algo.find_trade_intrabar).
+    """
+    if ob.type == 'long':
+        # The entry event will be triggered when the low of the candle is less than or equal to the entry price. These are the indices of
+        # candles whose lows are less than or equal to the entry price.
+        entry_level_events = lows <= ob.position.entry_price
+
+        # The entry event will be triggered when the low of the candle is less than or equal to the stoploss. These are the indices of
+        # candles whose lows are less than or equal to the stoploss.
+        stoploss_events = lows <= ob.position.stoploss
+
+        # The target_events list is a list whose elements represents events related to each target being hit. Each element is a list of events
+        # for that target. This means the 0-th element represents a list of indices of the candles which hit the 1-st target, the 1-st element
+        # represents the indices of the candles which hit the 2-nd target, and so on.
+        target_list_events = []
+        for target in ob.position.target_list:
+            target_list_events.append(highs >= target)
+
+    else:
+        # Same comments as ob.type=="long", in reverse.
+        entry_level_events = highs >= ob.position.entry_price
+
+        stoploss_events = highs >= ob.position.stoploss
+
+        target_list_events = []
+        for target in ob.position.target_list:
+            target_list_events.append(lows <= target)
+
+    # So now we have n_targets + 2 lists which represent the candles where events have happened. Now we need an array which contains
+    # what events EACH candle represents, so for every candle in pair_df there would be at most one event, and there are certain rules:
+    # 1) Targets and stop-losses may only happen exclusively after an entry is made, not even on the same candle.
+    # 2) Each candle may only have at most 1 sentiment.
+    # 3) Stop-losses take priority over targets if they happen on the same candle.
+
+    # The code now generates a numpy array the same size as pair_df - formation_pdi, which contains the order in which the events happened:
+    # 0.5 -> No event
+    # 0 -> Entry
+    # -1 -> Stoploss
+    # 1, 2, 3, ... -> Targets
+
+    # Initialize the events array with a default value (e.g., 0.5 for no event)
+    events_array = np.full_like(lows, 0.5)
+
+    # Set the target events (1, 2, 3, ... for targets), which will overwrite entry and stoploss events
+    for target_idx, target_events in enumerate(target_list_events):
+        events_array[target_events] = target_idx + 1
+
+    # Set the entry events (0 for entry). Entry events overwrite any target events.
+    events_array[entry_level_events] = 0
+
+    # Finally, set the stoploss events (-1 for stoploss), which will overwrite entry and target events.
+    events_array[stoploss_events] = -1
+
+    return events_array
 
 
 class Algo:
-    def __init__(self, pair_df: dt.PairDf, symbol: str, params):
-        # Set up the logger to be used in this module
-        global ob_logger
-        if ob_logger is None:
-            ob_logger = LoggerSingleton.get_logger("ob_logger")
+    def __init__(self, pair_df: dt.PairDf, symbol: str, params, segment_lengths: Optional[list[int]] = None):
+        # The logger of the order blocks, whose records are written to the log file of this pair
+        self.ob_logger = LoggerSingleton.get_pair_logger("ob_logger", symbol)
 
         self.pair_df: dt.PairDf = pair_df
         self.symbol: str = symbol
+
+        # The bidirectional PDI <-> time index of the pair, built once when the pair is loaded
+        self.time_index: PairTimeIndex = pair_df.time_index if isinstance(pair_df, dt.PairDf) else dt.PairDf(pair_df).time_index
         self.zigzag_df: Optional[dt.ZigZagDf] = None
+        self.msb_points_df: Optional[dt.MSBPointsDf] = None
+        self.ob_bases_df: Optional[pd.DataFrame] = None
         self.ob_list: Optional[list[OrderBlock]] = None
+        self.trade_records: Optional[TradeRecords] = None
         self.params = params
 
+        # pair_df may consist of several pairs' candles concatenated (see UniverseAlgo). Each pair is a segment, and no stage of the algo looks
+        # across the boundary of two segments. A single pair is a single segment.
+        if segment_lengths is None:
+            segment_lengths = [len(pair_df)]
+        self.segment_offsets: np.ndarray = np.concatenate(([0], np.cumsum(segment_lengths))).astype(np.int64)
+        self.segment_ids: np.ndarray = np.repeat(np.arange(len(segment_lengths)), segment_lengths)
+
+        # The lower timeframe candles used to resolve the ambiguous candles of the positions, if enabled with --intrabar. Only supported for a single
+        # pair, since the lower timeframe data is read from the pair's own cache.
+        intrabar_timeframe = getattr(params, 'intrabar_timeframe', None)
+        self.intrabar: Optional[IntrabarCandles] = None
+        if intrabar_timeframe and len(segment_lengths) == 1:
+            self.intrabar = IntrabarCandles(symbol, params.timeframe, intrabar_timeframe, self.time_index)
+
+        # Whether the events arrays are calculated one order block at a time while processing them, to bound the memory used under --memory_budget.
+        # The intrabar candles are prefetched from the events arrays of all the order blocks, so they need all of them calculated first.
+        self.lazy_events_arrays: bool = getattr(params, 'memory_budget_mb', None) is not None and self.intrabar is None
+
     def find_relative_pivot(self, zigzag_pdi, idx, delta) -> int | None:
         """
             Finds the relative pivot index in the zigzag pattern.
@@ -58,9 +198,12 @@ class Algo:
         rolling_high_max = self.pair_df.high.rolling(window=self.params.zigzag_window_size).max()
         rolling_low_min = self.pair_df.low.rolling(window=self.params.zigzag_window_size).min()
 
+        # The first zigzag_window_size candles of each segment don't have a full window of their own segment's candles to be compared to.
+        warmup_boolfilter = (np.arange(len(self.pair_df)) - self.segment_offsets[self.segment_ids]) < self.params.zigzag_window_size
+
         # Determine peaks and valleys
-        hh_sentiments = self.pair_df.iloc[self.params.zigzag_window_size:].high >= rolling_high_max.iloc[self.params.zigzag_window_size:]
-        ll_sentiments = self.pair_df.iloc[self.params.zigzag_window_size:].low <= rolling_low_min.iloc[self.params.zigzag_window_size:]
+        hh_sentiments = (self.pair_df.high >= rolling_high_max) & ~warmup_boolfilter
+        ll_sentiments = (self.pair_df.low <= rolling_low_min) & ~warmup_boolfilter
 
         # Check peak and valley conditions. The pure_ prefix means the candles which ONLY register a peak or a valley, not both. the bidir_ prefix
         # denotes candles that register both.
@@ -82,19 +225,23 @@ class Algo:
         # Filter out the non-set values
         zigzag_df = zigzag_df[zigzag_df.pivot_type != '']
 
+        # The last pivot candidate of each segment has no next row within its segment.
+        zigzag_segment_ids = pd.Series(self.segment_ids[zigzag_df.index.to_numpy()], index=zigzag_df.index)
+        is_segment_last_row = zigzag_segment_ids != zigzag_segment_ids.shift(-1)
+
         # Each zigzag pivot is confirmed whenever the next pivot is of a different type. This is done by shifting the pivot_type column by 1 and
         # comparing it to the current pivot_type column. If they are different, the pivot is confirmed. The formation time of the current pivot is
         # set to the time of the next pivot. This line sets the formation of each pivot to the time of its next row, and the consecutive
         # non-changing rows are later filtered out.
-        zigzag_df['formation_time'] = zigzag_df.shift(-1).time
+        zigzag_df['formation_time'] = zigzag_df.shift(-1).time.where(~is_segment_last_row)
 
         # Set the pivot_value column of the zigzag_df to the corresponding candle's high from self.pair_df if it is a peak, and the low if it's a
         # valley.
         zigzag_df.loc[peak_boolfilter, 'pivot_value'] = self.pair_df.high
         zigzag_df.loc[valley_boolfilter, 'pivot_value'] = self.pair_df.low
 
-        # Only keep the rows from zigzag_df which don't have the same pivot_type as the next row
-        zigzag_df = zigzag_df[zigzag_df.pivot_type != zigzag_df.pivot_type.shift(-1)]
+        # Only keep the rows from zigzag_df which don't have the same pivot_type as the next row, and the last row of each segment.
+        zigzag_df = zigzag_df[(zigzag_df.pivot_type != zigzag_df.pivot_type.shift(-1)) | is_segment_last_row]
 
         self.zigzag_df = zigzag_df.reset_index().rename(columns={'index': 'pdi'})
 
@@ -117,17 +264,19 @@ class Algo:
         next_pivot_values = np.roll(pivot_values, -1)[:-1]
         next_next_pivot_values = np.roll(pivot_values, -2)[:-2]
 
+        # An MSB is only formed by three consecutive pivots within the same segment
+        zigzag_segment_ids = self.segment_ids[zigzag_pdi]
+        same_segment_boolfilter = zigzag_segment_ids[:-2] == zigzag_segment_ids[2:]
+
         pair_df_low = self.pair_df['low'].to_numpy()
         pair_df_high = self.pair_df['high'].to_numpy()
 
-        def find_msb(pivot_type_to_find: str, comparison_op, threshold_op):
-            msb_list = []
-
+        def find_msb(pivot_type_to_find: str, comparison_op, threshold_op) -> pd.DataFrame:
             # Set indices to be the indices of the pivot points of the specified type, and those that pass the comparison test. The comparison test
             # filters out the valleys that are followed by lower valleys, and peaks that are followed by higher peaks. The [0] is there because
             # np.where returns a tuple, one element for each dimension of the array, but this is a 1-D array.
             potential_msb_zigzag_indices = np.where(
-                (pivot_types[:-2] == pivot_type_to_find) & comparison_op(pivot_values[:-2], next_next_pivot_values))[0]
+                (pivot_types[:-2] == pivot_type_to_find) & comparison_op(pivot_values[:-2], next_next_pivot_values) & same_segment_boolfilter)[0]
 
             # Calculate the MSB threshold for each pivot that has an index in potential_msb_indices
             msb_thresholds = threshold_op(pivot_values[:-1], next_pivot_values)[potential_msb_zigzag_indices]
@@ -135,39 +284,34 @@ class Algo:
             # Form search windows for each zigzag pivot index in potential_msb_zigzag_indices. Then in that search window, look for candles that
             # break the msb_threshold. Each search window is a series of highs or lows, depending on the pivot type, from the next pivot to the
             # next-next pivot.
-
             pair_df_of_type = pair_df_high
             if pivot_type_to_find == 'valley':
                 pair_df_of_type = pair_df_low
 
-            for counter, zigzag_idx in enumerate(potential_msb_zigzag_indices):
-                # These indices can apparently go out of bounds, so we need to catch that
-                try:
-                    search_window = pair_df_of_type[next_pdi[zigzag_idx]:next_next_pdi[zigzag_idx] + 1]
-                    msb_threshold = msb_thresholds[counter]
-                except IndexError:
-                    continue
-
-                if pivot_type_to_find == 'valley':
-                    msb_breaking_candles_search_window_idx = np.where(search_window < msb_threshold)[0]
-                else:
-                    msb_breaking_candles_search_window_idx = np.where(search_window > msb_threshold)[0]
-
-                if len(msb_breaking_candles_search_window_idx) > 0:
-                    first_breaking_candle_search_window_idx = msb_breaking_candles_search_window_idx[0]
+            # All the search windows are searched at once: their candles are laid out one window after the other in a single array, along with the
+            # window each one belongs to. The windows of the pivots of one type are consecutive legs of the zigzag, so this holds about as many
+            # candles as the pair.
+            window_starts = next_pdi[potential_msb_zigzag_indices]
+            window_lengths = next_next_pdi[potential_msb_zigzag_indices] + 1 - window_starts
+            window_ids = np.repeat(np.arange(len(potential_msb_zigzag_indices)), window_lengths)
+            window_first_positions = np.cumsum(window_lengths) - window_lengths
+            window_candle_pdis = np.arange(len(window_ids)) - window_first_positions[window_ids] + window_starts[window_ids]
 
-                    # msb_breaking_candle_search_window_idx is the index of the candle LOCAL TO SEARCH WINDOW which breaks the MSB threshold.
-                    # This has to be converted to regular PDI to be usable. This can be easily done by summing its value with the next_pdi value.
-                    formation_pdi = next_pdi[zigzag_idx] + first_breaking_candle_search_window_idx
+            if pivot_type_to_find == 'valley':
+                breaking_positions = np.flatnonzero(pair_df_of_type[window_candle_pdis] < msb_thresholds[window_ids])
+            else:
+                breaking_positions = np.flatnonzero(pair_df_of_type[window_candle_pdis] > msb_thresholds[window_ids])
 
-                    msb_list.append({
-                        'type': 'short' if pivot_type_to_find == 'valley' else 'long',
-                        'pdi': zigzag_pdi[zigzag_idx],
-                        'msb_value': pivot_values[zigzag_idx],
-                        'formation_pdi': formation_pdi
-                    })
+            # The first candle breaking the threshold in each window sets the formation index of the MSB. Windows without one don't form an MSB.
+            msb_window_ids, first_breaking_positions = np.unique(window_ids[breaking_positions], return_index=True)
+            msb_zigzag_indices = potential_msb_zigzag_indices[msb_window_ids]
 
-            return msb_list
+            return pd.DataFrame({
+                'type': np.full(len(msb_zigzag_indices), 'short' if pivot_type_to_find == 'valley' else 'long', dtype=object),
+                'pdi': zigzag_pdi[msb_zigzag_indices].astype(np.int64),
+                'msb_value': pivot_values[msb_zigzag_indices].astype(np.float64),
+                'formation_pdi': window_candle_pdis[breaking_positions[first_breaking_positions]].astype(np.int64)
+            })
 
         fib_retracement_increment_factor = 1 + self.params.fib_retracement_coeff
         short_msbs = find_msb('valley', lambda current_val, next_next_val: next_next_val < current_val,
@@ -175,56 +319,95 @@ class Algo:
         long_msbs = find_msb('peak', lambda current_val, next_next_val: next_next_val > current_val,
                              lambda current_val, next_val: next_val + (current_val - next_val) * fib_retracement_increment_factor)
 
-        return dt.MSBPointsDf(short_msbs + long_msbs)
+        self.msb_points_df = dt.MSBPointsDf(pd.concat([short_msbs, long_msbs], ignore_index=True))
+        return self.msb_points_df
 
-    def find_order_blocks(self) -> list[OrderBlock]:
+    def find_order_block_bases(self) -> pd.DataFrame:
         """
         This function will use the MSB points to find order blocks. The order blocks are formed on the last candle on a leg that has the correct
         color. The leg should start with an MSB point. For "long" MSB points, the order block will form on the last red candle in the leg. For "short"
         the order block's base candle would be the last green candle of the leg.
+
+        Only the detection is done here: the order blocks are returned as a table of their type, base candle PDI and formation PDI, which depends on
+        nothing but the data and the detection parameters and can be cached. find_order_blocks builds the OrderBlock objects from it.
         """
 
-        ob_list: list[OrderBlock] = []
         candle_colors = self.pair_df['candle_color'].to_numpy()
         candle_color_numeric = np.where(candle_colors == 'green', 1, -1)
 
         pair_df_highs = self.pair_df['high'].to_numpy()
         pair_df_lows = self.pair_df['low'].to_numpy()
-        pair_df_times = self.pair_df['time'].to_numpy()
         zigzag_pdi = self.zigzag_df['pdi'].to_numpy()
-        for msb_point in self.find_msb_points().itertuples(index=False):
-            msb_point: dt.MSBPoint
-            # Form the window to look for order blocks on
-            try:
-                zigzag_idx = np.where(zigzag_pdi == msb_point.pdi)[0][0]
-                next_pivot_pdi = int(zigzag_pdi[zigzag_idx + 1])
-            except IndexError:
-                continue
+        msb_points_df = self.msb_points_df if self.msb_points_df is not None else self.find_msb_points()
+        msb_types = msb_points_df['type'].to_numpy(dtype=object) if len(msb_points_df) else np.array([], dtype=object)
+        msb_pdis = msb_points_df['pdi'].to_numpy(dtype=np.int64) if len(msb_points_df) else np.array([], dtype=np.int64)
+        msb_formation_pdis = msb_points_df['formation_pdi'].to_numpy(dtype=np.int64) if len(msb_points_df) else np.array([], dtype=np.int64)
+
+        # The window to look for the order block of each MSB point in is the leg from its pivot to the next pivot. The zigzag PDIs are sorted, so
+        # the pivot of each MSB point is found by a binary search, and the MSB points of the last pivot have no leg.
+        zigzag_indices = np.searchsorted(zigzag_pdi, msb_pdis)
+        has_leg = zigzag_indices + 1 < len(zigzag_pdi)
+        has_leg[has_leg] = zigzag_pdi[zigzag_indices[has_leg]] == msb_pdis[has_leg]
+        msb_indices = np.flatnonzero(has_leg)
+
+        # All the windows are searched at once: their candles are laid out one window after the other in a single array, along with the window
+        # each one belongs to.
+        window_starts = msb_pdis[msb_indices]
+        window_lengths = zigzag_pdi[zigzag_indices[msb_indices] + 1] + 1 - window_starts
+        window_ids = np.repeat(np.arange(len(msb_indices)), window_lengths)
+        window_first_positions = np.cumsum(window_lengths) - window_lengths
+        window_candle_pdis = np.arange(len(window_ids)) - window_first_positions[window_ids] + window_starts[window_ids]
+
+        # The base candle is the last candle in the leg that has the correct color: red for "long" MSB points and green for "short" ones. The
+        # MSB points whose leg has no candle of the correct color don't form an order block.
+        correct_colors = np.where(msb_types[msb_indices] == 'long', -1, 1)
+        correct_color_positions = np.flatnonzero(candle_color_numeric[window_candle_pdis] == correct_colors[window_ids])
+        correct_color_window_ids = window_ids[correct_color_positions]
+        is_window_last = np.diff(correct_color_window_ids, append=-1) != 0
+        ob_msb_indices = msb_indices[correct_color_window_ids[is_window_last]]
+        base_candle_pdis = window_candle_pdis[correct_color_positions[is_window_last]]
+
+        base_candles = dt.Candle(pdi=base_candle_pdis, time=None, high=pair_df_highs[base_candle_pdis], low=pair_df_lows[base_candle_pdis])
+        base_candle_percentages = calc_candle_percentage(base_candles)
+        ob_boolfilter = (self.params.ob_size_lower_limit <= base_candle_percentages) & (base_candle_percentages < self.params.ob_size_upper_limit)
+        if constants.position_type:
+            ob_boolfilter &= msb_types[ob_msb_indices] == constants.position_type
+
+        self.ob_bases_df = pd.DataFrame({
+            'type': np.array(msb_types[ob_msb_indices[ob_boolfilter]], dtype=object),
+            'base_candle_pdi': np.array(base_candle_pdis[ob_boolfilter], dtype=np.int64),
+            'formation_pdi': np.array(msb_formation_pdis[ob_msb_indices[ob_boolfilter]] + 1, dtype=np.int64),
+        })
+        return self.ob_bases_df
 
-            search_window_candle_colors = candle_color_numeric[msb_point.pdi:next_pivot_pdi + 1]
-
-            # Find the last candle in the leg that has the correct color
-            correct_color = -1 if msb_point.type == 'long' else 1
-
-            # The try statement is here to catch cases where no appropriate candle is found
-            try:
-                base_candle_pdi: int = int(np.where(search_window_candle_colors == correct_color)[0][-1]) + msb_point.pdi
-                base_candle_time = pd.Timestamp(pair_df_times[base_candle_pdi])
-                base_candle_high = pair_df_highs[base_candle_pdi]
-                base_candle_low = pair_df_lows[base_candle_pdi]
+    def find_order_blocks(self) -> list[OrderBlock]:
+        """
+        Builds the OrderBlock objects, with their positions, from the order block table of find_order_block_bases.
+        """
 
-                base_candle = dt.Candle(pdi=base_candle_pdi,
-                                        time=base_candle_time,
-                                        high=base_candle_high,
-                                        low=base_candle_low)
+        ob_list: list[OrderBlock] = []
 
-                if self.params.ob_size_lower_limit <= calc_candle_percentage(base_candle) < self.params.ob_size_upper_limit:
-                    if not constants.position_type or msb_point.type == constants.position_type:
-                        ob = OrderBlock(base_candle, msb_point.type, formation_pdi=msb_point.formation_pdi + 1, params=self.params)
-                        ob_list.append(ob)
+        # If the price setup strategy has a batch version, the positions of all the order blocks are set up at once after they are found.
+        use_batch_price_setup = self.params.price_setup in setup.batch_price_setups
 
-            except IndexError:
-                continue
+        pair_df_highs = self.pair_df['high'].to_numpy()
+        pair_df_lows = self.pair_df['low'].to_numpy()
+        ob_bases_df = self.ob_bases_df if self.ob_bases_df is not None else self.find_order_block_bases()
+        for ob_type, base_candle_pdi, formation_pdi in zip(ob_bases_df['type'],
+                                                           ob_bases_df['base_candle_pdi'].tolist(),
+                                                           ob_bases_df['formation_pdi'].tolist()):
+            base_candle = dt.Candle(pdi=base_candle_pdi,
+                                    time=self.time_index.to_timestamp(base_candle_pdi),
+                                    high=pair_df_highs[base_candle_pdi],
+                                    low=pair_df_lows[base_candle_pdi])
+
+            ob = OrderBlock(base_candle, ob_type, formation_pdi=formation_pdi, params=self.params,
+                            pdi_offset=int(self.segment_offsets[self.segment_ids[base_candle_pdi]]),
+                            setup_position_prices=not use_batch_price_setup)
+            ob_list.append(ob)
+
+        if use_batch_price_setup:
+            setup.setup_positions_batch(ob_list, self.params)
 
         self.ob_list = ob_list
         return ob_list
@@ -233,7 +416,7 @@ class Algo:
         """
         This function will make sure that only a maximum of max_concurrent number of OB's are always active in each direction. When a new OB is
         introduced, meaning when it's formation_pdi is reached, the oldest OB in the same direction will be closed. That is to say, at all times, only
-        the most recent max_concurrent OB's will be active in each direction.
+        the most recent max_concurrent OB's will be active in each direction. The active OB's are tracked separately for each segment.
         """
         short_order_blocks = sorted([ob for ob in self.ob_list if ob.type == 'short'], key=lambda ob: ob.formation_pdi)
         long_order_blocks = sorted([ob for ob in self.ob_list if ob.type == 'long'], key=lambda ob: ob.formation_pdi)
@@ -241,24 +424,41 @@ class Algo:
         active_long_obs = []
         active_short_obs = []
 
+        # Checked once, so the loops below don't pay for the debug logs when they're disabled
+        log_debug = self.ob_logger.isEnabledFor(logging.DEBUG)
+
+        active_segment_id = None
         for ob in long_order_blocks:
             # print(ob.formation_pdi)
+            # OB's of a new segment don't close the ones from the previous segment
+            if self.segment_ids[ob.base_candle_pdi] != active_segment_id:
+                active_segment_id = self.segment_ids[ob.base_candle_pdi]
+                active_long_obs = []
+
             # Close the oldest OB if the limit is exceeded
             if len(active_long_obs) >= self.params.max_concurrent:
                 oldest_ob = active_long_obs.pop(0)
                 oldest_ob.end_pdi = ob.formation_pdi - 1
-                # print(f'Max concurrent OB reached. Set end_pdi for {oldest_ob} to {ob.formation_pdi - 1}')
+                if log_debug:
+                    self.ob_logger.debug(f'Max concurrent OB reached. Set end_pdi for {oldest_ob} to {ob.formation_pdi - 1}')
 
             # Add the new OB to the active list
             active_long_obs.append(ob)
 
+        active_segment_id = None
         for ob in short_order_blocks:
             # print(ob.formation_pdi)
+            # OB's of a new segment don't close the ones from the previous segment
+            if self.segment_ids[ob.base_candle_pdi] != active_segment_id:
+                active_segment_id = self.segment_ids[ob.base_candle_pdi]
+                active_short_obs = []
+
             # Close the oldest OB if the limit is exceeded
             if len(active_short_obs) >= self.params.max_concurrent:
                 oldest_ob = active_short_obs.pop(0)
                 oldest_ob.end_pdi = ob.formation_pdi - 1
-                # print(f'Max concurrent OB reached. Set end_pdi for {oldest_ob} to {ob.formation_pdi - 1}')
+                if log_debug:
+                    self.ob_logger.debug(f'Max concurrent OB reached. Set end_pdi for {oldest_ob} to {ob.formation_pdi - 1}')
 
             # Add the new OB to the active list
             active_short_obs.append(ob)
@@ -284,7 +484,7 @@ class Algo:
             return []
 
         # Map PDIs to their corresponding times
-        times = [self.pair_df.iloc[pdi].time for pdi in pdis]
+        times = self.time_index.to_timestamps(pdis)
 
         # If it's a singular entry, return it as a single timestamp
         if len(times) == 1:
@@ -304,66 +504,185 @@ class Algo:
         pair_df_highs = self.pair_df.high.to_numpy()
         pair_df_lows = self.pair_df.low.to_numpy()
 
+        # Under a memory budget, the events arrays are calculated one order block at a time by process_events_array instead, so only one of them is
+        # held at once
+        if self.lazy_events_arrays:
+            return
+
         # The events will be calculated for each order block, and the results will be stored in a numpy array and attributed to the order block
         # as an instance variable, OrderBlock.events_array.
         for ob in self.ob_list:
             ob: OrderBlock
+            ob.events_array = self.calc_ob_events_array(ob, pair_df_highs, pair_df_lows)
 
-            pair_df_lows_after_formation = pair_df_lows[ob.formation_pdi:]
-            pair_df_highs_after_formation = pair_df_highs[ob.formation_pdi:]
+        if self.intrabar is not None:
+            self.prefetch_intrabar_candles(pair_df_highs, pair_df_lows)
 
-            if ob.type == 'long':
-                # The entry event will be triggered when the low of the candle is less than or equal to the entry price. These are the indices of
-                # candles whose lows are less than or equal to the entry price.
-                entry_level_events = pair_df_lows_after_formation <= ob.position.entry_price
+    def calc_ob_events_array(self, ob: OrderBlock, pair_df_highs: np.ndarray, pair_df_lows: np.ndarray) -> np.ndarray:
+        # The events array of an order block, calculated up to the end of the OB's segment
+        segment_end = self.segment_offsets[self.segment_ids[ob.base_candle_pdi] + 1]
+        return calc_ob_events(ob, pair_df_highs[ob.formation_pdi:segment_end], pair_df_lows[ob.formation_pdi:segment_end])
 
-                # The entry event will be triggered when the low of the candle is less than or equal to the stoploss. These are the indices of
-                # candles whose lows are less than or equal to the stoploss.
-                stoploss_events = pair_df_lows_after_formation <= ob.position.stoploss
+    def spans_targets(self, ob: OrderBlock, highs: np.ndarray | float, lows: np.ndarray | float) -> np.ndarray | bool:
+        # Whether candles touch both the entry level (and maybe the stoploss) and the first target of an order block's position, in which case the
+        # order of their events is ambiguous
+        if ob.type == 'long':
+            return (lows <= ob.position.entry_price) & (highs >= ob.position.target_list[0])
+        return (highs >= ob.position.entry_price) & (lows <= ob.position.target_list[0])
 
-                # The target_events list is a list whose elements represents events related to each target being hit. Each element is a list of events
-                # for that target. This means the 0-th element represents a list of indices of the candles which hit the 1-st target, the 1-st element
-                # represents the indices of the candles which hit the 2-nd target, and so on.
-                target_list_events = []
-                for target in ob.position.target_list:
-                    target_list_events.append(pair_df_highs_after_formation >= target)
+    def prefetch_intrabar_candles(self, pair_df_highs: np.ndarray, pair_df_lows: np.ndarray):
+        """
+        Registers the ambiguous candles which are most likely to be resolved by find_trade_intrabar, so the lower timeframe candles of all of them
+        are read in a single pass: the first entry candle of each order block, if it's ambiguous, and the first candle after it which could be an
+        ambiguous exit. The candles of the later bounces are read on demand.
+        """
+        prefetched_pdis = []
+        for ob in self.ob_list:
+            entry_index = first_index((ob.events_array == 0) | (ob.events_array == -1))
+            if entry_index == len(ob.events_array):
+                continue
 
-            else:
-                # Same comments as ob.type=="long", in reverse.
-                entry_level_events = pair_df_highs_after_formation >= ob.position.entry_price
+            entry_pdi = ob.formation_pdi + entry_index
+            if ob.events_array[entry_index] == -1 or self.spans_targets(ob, pair_df_highs[entry_pdi], pair_df_lows[entry_pdi]):
+                prefetched_pdis.append(entry_pdi)
+
+            segment_end = entry_pdi + len(ob.events_array) - entry_index
+            exit_candidates = (ob.events_array[entry_index + 1:] <= 0) & self.spans_targets(ob,
+                                                                                            pair_df_highs[entry_pdi + 1:segment_end],
+                                                                                            pair_df_lows[entry_pdi + 1:segment_end])
+            exit_index = first_index(exit_candidates)
+            if exit_index < len(exit_candidates):
+                prefetched_pdis.append(entry_pdi + 1 + exit_index)
+
+        self.intrabar.prefetch(prefetched_pdis)
+
+    def get_intrabar_events(self, ob: OrderBlock, pdi: int) -> np.ndarray:
+        # The events of an order block on the lower timeframe candles within a candle
+        highs, lows = self.intrabar.get_candles(pdi)
+        return calc_ob_events(ob, highs, lows)
+
+    def find_trade(self, ob: OrderBlock, event_array_start_index: int, n_targets: float) -> tuple | None:
+        """
+        Finds the next trade of an order block from its events array, starting at event_array_start_index, and enters its position.
+
+        Returns:
+            tuple | None: The exit PDI, the exit type, the PDIs of the targets hit and the highest target hit before the exit, or None if there is no
+            entry, the order block is discarded, or the position doesn't exit before the end of the data.
+        """
+        # The events array after the starting point
+        sliced_events_array = ob.events_array[event_array_start_index:]
 
-                stoploss_events = pair_df_highs_after_formation >= ob.position.stoploss
+        # The index of the first entry, local to the sliced events array. This should eventually be added to the event_array_start_index to
+        # get the absolute distance from the formation of the OB.
+        try:
+            first_entry_index = np.where(sliced_events_array == 0)[0][0]
+
+            # If an entry is found, register it on the OB's position. The method throws an exception if the entry found isn't between the
+            # formation_pdi and end_pdi of its parent order block.
+            ob.position.enter(first_entry_index + event_array_start_index + ob.formation_pdi)
+
+        # If no entry is found, go on to the next OB.
+        except IndexError:
+            return None
+
+        # If a stoploss even has happened before any entry event, discard the order block completely.
+        try:
+            first_stoploss_index = np.where(sliced_events_array == -1)[0][0]
+
+            if first_stoploss_index <= first_entry_index:
+                return None
+
+        # If no stoploss event is found, continue with the code.
+        except IndexError:
+            pass
+
+        events_after_entry = sliced_events_array[first_entry_index:]
+
+        # The absolute PDI of the entry, which the indices of events_after_entry are relative to
+        entry_pdi = first_entry_index + event_array_start_index + ob.formation_pdi
 
-                target_list_events = []
-                for target in ob.position.target_list:
-                    target_list_events.append(pair_df_lows_after_formation <= target)
+        exit_index, exit_type, target_hit_indices, last_target = find_position_exit(events_after_entry,
+                                                                                    n_targets,
+                                                                                    self.params.trailing_sl_target_id)
+        if exit_type is None:
+            return None
+
+        return entry_pdi + exit_index, exit_type, target_hit_indices + entry_pdi, last_target
 
-            # So now we have n_targets + 2 lists which represent the candles where events have happened. Now we need an array which contains
-            # what events EACH candle represents, so for every candle in pair_df there would be at most one event, and there are certain rules:
-            # 1) Targets and stop-losses may only happen exclusively after an entry is made, not even on the same candle.
-            # 2) Each candle may only have at most 1 sentiment.
-            # 3) Stop-losses take priority over targets if they happen on the same candle.
+    def find_trade_intrabar(self, ob: OrderBlock, event_array_start_index: int, n_targets: float) -> tuple | None:
+        """
+        Same as find_trade, but the candles whose order of events is ambiguous are resolved from the lower timeframe candles within them:
+        1) The entry candle, if it touches the stoploss or a target as well. Without intrabar resolution, a candle touching the entry and the stoploss
+           discards the order block, and the targets touched by the entry candle are ignored. With it, the position is entered on the first lower
+           timeframe candle touching the entry, and the lower timeframe candles after it can already hit targets or exit the position on the same
+           candle. The order block is still discarded if the lower timeframe candle of the entry touches the stoploss as well.
+        2) The exit candle, if it touches both the entry side and the target side of the position. Its single event is replaced with the events of
+           its lower timeframe candles, so a target hit before the stoploss on the same candle is counted, and a full target hit before the
+           stoploss exits at the full target instead of the stoploss.
+        The same rules apply to the lower timeframe candles themselves. If the lower timeframe has no candles within an ambiguous candle, the candle
+        is handled as in find_trade.
+        """
+        sliced_events_array = ob.events_array[event_array_start_index:]
 
-            # The code now generates a numpy array the same size as pair_df - formation_pdi, which contains the order in which the events happened:
-            # 0.5 -> No event
-            # 0 -> Entry
-            # -1 -> Stoploss
-            # 1, 2, 3, ... -> Targets
+        # The first candle touching the entry level. A candle touching the stoploss touches the entry level too, since it lies between the stoploss
+        # and the targets.
+        entry_index = first_index((sliced_events_array == 0) | (sliced_events_array == -1))
+        if entry_index == len(sliced_events_array):
+            return None
 
-            # Initialize the events array with a default value (e.g., 0.5 for no event)
-            events_array = np.full_like(pair_df_lows_after_formation, 0.5)
+        entry_pdi = entry_index + event_array_start_index + ob.formation_pdi
+        pair_df_highs = self.pair_df['high'].to_numpy()
+        pair_df_lows = self.pair_df['low'].to_numpy()
 
-            # Set the target events (1, 2, 3, ... for targets), which will overwrite entry and stoploss events
-            for target_idx, target_events in enumerate(target_list_events):
-                events_array[target_events] = target_idx + 1
+        # The events from the entry on, and the PDI of the candle of each event, since an ambiguous candle is replaced with the events of its lower
+        # timeframe candles
+        events = sliced_events_array[entry_index:]
+        event_pdis = np.arange(entry_pdi, entry_pdi + len(events))
+        resolved_pdis = set()
 
-            # Set the entry events (0 for entry). Entry events overwrite any target events.
-            events_array[entry_level_events] = 0
+        if sliced_events_array[entry_index] == -1 or self.spans_targets(ob, pair_df_highs[entry_pdi], pair_df_lows[entry_pdi]):
+            candle_events = self.get_intrabar_events(ob, entry_pdi)
+            intrabar_entry_index = first_index((candle_events == 0) | (candle_events == -1))
+            if intrabar_entry_index == len(candle_events):
+                return self.find_trade(ob, event_array_start_index, n_targets)
 
-            # Finally, set the stoploss events (-1 for stoploss), which will overwrite entry and target events.
-            events_array[stoploss_events] = -1
+            if candle_events[intrabar_entry_index] == -1:
+                # Still ambiguous on the lower timeframe, so the order block is discarded as in find_trade
+                try:
+                    ob.position.enter(entry_pdi)
+                except IndexError:
+                    pass
+                return None
 
-            ob.events_array = events_array
+            # The entry, followed by the events of the lower timeframe candles after it and the events of the next candles
+            events = np.concatenate(([0], candle_events[intrabar_entry_index + 1:], events[1:]))
+            event_pdis = np.concatenate((np.full(len(candle_events) - intrabar_entry_index, entry_pdi), event_pdis[1:]))
+            resolved_pdis.add(entry_pdi)
+
+        try:
+            ob.position.enter(entry_pdi)
+        except IndexError:
+            return None
+
+        # The exit candle is resolved until the exit found is on a candle which isn't ambiguous or is already resolved
+        while True:
+            exit_index, exit_type, target_hit_indices, last_target = find_position_exit(events, n_targets, self.params.trailing_sl_target_id)
+            if exit_type is None:
+                return None
+
+            exit_pdi = int(event_pdis[exit_index])
+            if exit_pdi in resolved_pdis or not self.spans_targets(ob, pair_df_highs[exit_pdi], pair_df_lows[exit_pdi]):
+                break
+
+            resolved_pdis.add(exit_pdi)
+            candle_events = self.get_intrabar_events(ob, exit_pdi)
+            if len(candle_events) == 0:
+                break
+
+            events = np.concatenate((events[:exit_index], candle_events, events[exit_index + 1:]))
+            event_pdis = np.concatenate((event_pdis[:exit_index], np.full(len(candle_events), exit_pdi), event_pdis[exit_index + 1:]))
+
+        return exit_pdi, exit_type, event_pdis[target_hit_indices], last_target
 
     def process_events_array(self):
         """
@@ -384,13 +703,21 @@ class Algo:
         The OrderBlock.events_array for each block is an array which represents the events that happened after the formation_pdi of the OB. Each
         element of the array represents one candle and its sentiment (event registered by the candle) and it can have values of -1 (for non-trailing
         stoploss), 0 (for entry price level), 0.5 (for no event at all) or 1 through len(OrderBlock.position.target_list) for each target hit.
+
+        The exits are written to self.trade_records, whose times are filled in once all the order blocks have been processed.
         """
-        # The times array of pair_df, used for registering exit times in Position.exit()
-        pair_df_times = self.pair_df.time.to_numpy()
+        self.trade_records = TradeRecords(self.symbol, n_targets=self.params.n_targets, capital_used=self.params.used_capital)
+
+        pair_df_highs = self.pair_df.high.to_numpy()
+        pair_df_lows = self.pair_df.low.to_numpy()
 
         for ob in self.ob_list:
             ob: OrderBlock
 
+            # The events array isn't calculated yet if calc_events_array left it to be calculated here
+            if ob.events_array is None:
+                ob.events_array = self.calc_ob_events_array(ob, pair_df_highs, pair_df_lows)
+
             # The starting index of the event array check window. This gets updated when checking for bounces after the first.
             event_array_start_index = 0
 
@@ -400,117 +727,64 @@ class Algo:
             # If there are bounces remaining for the OB, the entry is still valid. This is set to 0 after a stoploss event and reduced by 1 after each
             # full target.
             while ob.remaining_bounces > 0:
-                # The events array after the starting point
-                sliced_events_array = ob.events_array[event_array_start_index:]
-
-                # The index of the first entry, local to the sliced events array. This should eventually be added to the event_array_start_index to
-                # get the absolute distance from the formation of the OB.
-                try:
-                    first_entry_index = np.where(sliced_events_array == 0)[0][0]
-
-                    # If an entry is found, register it on the OB's position. The method throws an exception if the entry found isn't between the
-                    # formation_pdi and end_pdi of its parent order block.
-                    ob.position.enter(first_entry_index + event_array_start_index + ob.formation_pdi)
+                # The next trade of the OB from the starting point, with the ambiguous candles resolved from the lower timeframe if enabled. If
+                # there is no entry, the OB is discarded, or the position doesn't exit before the end of the data, go on to the next OB.
+                if self.intrabar is not None:
+                    trade = self.find_trade_intrabar(ob, event_array_start_index, n_targets)
+                else:
+                    trade = self.find_trade(ob, event_array_start_index, n_targets)
 
-                # If no entry is found, go on to the next OB.
-                except IndexError:
+                if trade is None:
                     break
 
-                # If a stoploss even has happened before any entry event, discard the order block completely.
-                try:
-                    first_stoploss_index = np.where(sliced_events_array == -1)[0][0]
+                exit_pdi, exit_type, target_hit_pdis, last_target = trade
+
+                # Check for full target event
+                if exit_type == 'full_target':
+                    ob.remaining_bounces -= 1
+
+                    # If a full-target event happens, the rest of the target hit PDI's list should be filled by the current PDI, assuming the
+                    # current candle has hit all the remaining targets.
+                    target_hit_pdis = np.concat((target_hit_pdis, np.array([exit_pdi] * (int(n_targets) - len(target_hit_pdis)))))
+
+                    ob.position.exit(trade_records=self.trade_records,
+                                     exit_pdi=exit_pdi,
+                                     target_hit_pdis=target_hit_pdis,
+                                     exit_price=ob.position.target_list[-1],
+                                     last_target=int(n_targets),
+                                     is_full_target=True
+                                     )
+
+                    event_array_start_index = exit_pdi - ob.formation_pdi + 1
+
+                # Stoploss events. Register the last_event as the exit status, if it is 0, that means the position didn't hit any targets before
+                # hitting the original stoploss. Otherwise, the exit status is registered with the last_event as it's highest target.
+                elif exit_type == 'stoploss':
+                    # Stoploss events prevent further bounces.
+                    ob.remaining_bounces = 0
+
+                    # If there was any target registered before the stoploss, the exit status is the highest target hit, if not it's 'STOPLOSS'.
+                    ob.position.exit(trade_records=self.trade_records,
+                                     exit_pdi=exit_pdi,
+                                     target_hit_pdis=target_hit_pdis,
+                                     exit_price=ob.position.stoploss,
+                                     last_target=int(last_target)
+                                     )
+
+                # Trailing stoploss events exit the position at the entry price and reduce the remaining bounces by 1, since the OB is still valid
+                # for entry.
+                else:
+                    ob.remaining_bounces -= 1
+                    ob.position.exit(trade_records=self.trade_records,
+                                     exit_pdi=exit_pdi,
+                                     target_hit_pdis=target_hit_pdis,
+                                     exit_price=ob.position.entry_price,
+                                     last_target=int(last_target)
+                                     )
 
-                    if first_stoploss_index <= first_entry_index:
-                        break
+                    event_array_start_index = exit_pdi - ob.formation_pdi + 1
 
-                # If no stoploss event is found, continue with the code.
-                except IndexError:
-                    pass
+            # The events array is only scratch space for finding the trades, so it's released as soon as the OB is processed
+            ob.events_array = None
 
-                events_after_entry = sliced_events_array[first_entry_index:]
-
-                last_target = 0
-                trailing_triggered = False
-                target_hit_pdis = np.array([], dtype='int')
-
-                for event_index, event in enumerate(events_after_entry):
-                    # 0.5 events (NO_EVENT candles) don't do anything.
-                    if event == 0.5:
-                        continue
-
-                    # Check for full target event
-                    if event == n_targets:
-                        ob.remaining_bounces -= 1
-
-                        # If a full-target event happens, the rest of the target hit PDI's list should be filled by the current PDI, assuming the
-                        # current candle has hit all the remaining targets.
-                        exit_pdi = first_entry_index + event_array_start_index + ob.formation_pdi + event_index
-                        target_hit_pdis = np.concat((target_hit_pdis, np.array([exit_pdi] * (int(n_targets) - len(target_hit_pdis)))))
-
-                        ob.position.exit(symbol=self.symbol,
-                                         pair_df_times=pair_df_times,
-                                         exit_status=f'FULL_TARGET_{int(n_targets)}',
-                                         exit_pdi=exit_pdi,
-                                         target_hit_pdis=target_hit_pdis,
-                                         exit_price=ob.position.target_list[-1]
-                                         )
-
-                        event_array_start_index += event_index + first_entry_index + 1
-
-                        break
-
-                    # Stoploss events. Register the last_event as the exit status, if it is 0, that means the position didn't hit any targets before
-                    # hitting the original stoploss. Otherwise, the exit status is registered with the last_event as it's highest target.
-                    elif event == -1:
-                        # Stoploss events prevent further bounces.
-                        ob.remaining_bounces = 0
-
-                        # If there was any target registered before the stoploss, the exit status is the highest target hit, if not it's 'STOPLOSS'.
-                        exit_status = 'STOPLOSS' if last_target == 0 else f'TARGET_{int(last_target)}'
-                        ob.position.exit(symbol=self.symbol,
-                                         pair_df_times=pair_df_times,
-                                         exit_status=exit_status,
-                                         exit_pdi=first_entry_index + event_array_start_index + ob.formation_pdi + event_index,
-                                         target_hit_pdis=target_hit_pdis,
-                                         exit_price=ob.position.stoploss
-                                         )
-
-                        break
-
-                    # Target events register a last event as a target. In this case, the stoploss is moved to the entry, so events of 0 will also
-                    # trigger a trailing stoploss event.
-                    elif event >= 1:
-                        # If the now-found target-hitting candle registers a higher target than the previously registered one, append it to the
-                        # targets hit.
-                        if event > last_target:
-                            target_hit_pdis = np.append(target_hit_pdis, first_entry_index + event_array_start_index + ob.formation_pdi + event_index)
-                            last_target = event
-
-                        # The price level to put the trailing stoploss at. If the target is at that level, the trailing stoploss variable is set to
-                        # true. This means the next time price reaches a 0 event, it will trigger a TRAILING exit status code.
-                        if self.params.trailing_sl_target_id != 0 and event == self.params.trailing_sl_target_id:
-                            trailing_triggered = True
-
-                    # Entry price level events
-                    # If the event is a 0, that means the candle has hit an entry price level.
-                    elif event == 0:
-                        # If the trailing configuration hasn't triggered, continue to the next candle
-                        if not trailing_triggered:
-                            continue
-
-                        # If it has, trigger an exit from the position, and reduce remaining bounces by 1, since our OB is still valid for entry.
-                        else:
-                            ob.remaining_bounces -= 1
-                            ob.position.exit(symbol=self.symbol,
-                                             pair_df_times=pair_df_times,
-                                             exit_status=f'TARGET_{int(last_target)}',
-                                             exit_pdi=first_entry_index + event_array_start_index + ob.formation_pdi + event_index,
-                                             target_hit_pdis=target_hit_pdis,
-                                             exit_price=ob.position.entry_price
-                                             )
-
-                            event_array_start_index += event_index + first_entry_index + 1
-
-                            break
-                else:
-                    break
+        self.trade_records.finalize(self.time_index)
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import utils.datatypes as dt
+from utils import constants
+
+# Bumped whenever the detection stages or the stored format change, so the entries of older versions are never loaded
+STORE_VERSION = 2
+
+
+# The number of entries whose tables are kept in memory by each process, so the parameter sets sharing the detection parameters of a pair only
+# read and convert its entry once
+memo_max_entries = 256
+
+# The detection store of each directory in this process
+_detection_stores: dict[tuple[str, int], 'DetectionStore'] = {}
+
+
+def fingerprint_pair_df(pair_df: dt.PairDf) -> str:
+    """
+    A hash of the candles the detection stages depend on (time, high, low and candle color). Two DataFrames with the same fingerprint give the same
+    zigzag, MSB points and order blocks for the same detection parameters, however they were loaded.
+
+    The fingerprint is computed once per loaded pair and cached on the PairDf (and pickled with it to the workers) along with the time index it was
+    computed with, so it's computed again for a frame with other candles, such as a slice of the pair.
+    """
+    time_index = pair_df.time_index if isinstance(pair_df, dt.PairDf) else None
+    cached = getattr(pair_df, '_fingerprint', None)
+    if time_index is not None and cached is not None and cached[0] is time_index:
+        return cached[1]
+
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(pair_df.time_index.epochs.tobytes())
+    hasher.update(np.ascontiguousarray(pair_df['high'].to_numpy(dtype=np.float64)).tobytes())
+    hasher.update(np.ascontiguousarray(pair_df['low'].to_numpy(dtype=np.float64)).tobytes())
+    hasher.update((pair_df['candle_color'].to_numpy() == 'green').tobytes())
+
+    fingerprint = hasher.hexdigest()
+    if time_index is not None:
+        object.__setattr__(pair_df, '_fingerprint', (time_index, fingerprint))
+
+    return fingerprint
+
+
+def get_detection_params(params) -> dict:
+    # The parameters the detection stages (zigzag, MSB points and order blocks) depend on
+    return {
+        'zigzag_window_size': params.zigzag_window_size,
+        'fib_retracement_coeff': params.fib_retracement_coeff,
+        'ob_size_lower_limit': params.ob_size_lower_limit,
+        'ob_size_upper_limit': params.ob_size_upper_limit,
+        'position_type': constants.position_type,
+    }
+
+
+def frame_to_arrays(name: str, frame: pd.DataFrame) -> dict[str, np.ndarray]:
+    """
+    Converts a DataFrame to one array per column, named <name>|<column>. Datetime columns are stored as int64 epoch nanoseconds with their time zone
+    in the name, and object columns as fixed-width unicode arrays, so the arrays can be saved without pickling. The column names are stored in an
+    array named <name>, so a table without columns (like the MSB points of a pair too short to have any) is still stored.
+    """
+    arrays = {name: np.array([str(column) for column in frame.columns], dtype=str)}
+    for column in frame.columns:
+        values = frame[column]
+        if isinstance(values.dtype, pd.DatetimeTZDtype) or pd.api.types.is_datetime64_dtype(values.dtype):
+            tz = values.dt.tz
+            arrays[f'{name}|{column}|datetime|{tz}'] = pd.DatetimeIndex(values).as_unit('ns').asi8
+        elif values.dtype == object:
+            arrays[f'{name}|{column}'] = values.to_numpy().astype(str)
+        else:
+            arrays[f'{name}|{column}'] = values.to_numpy()
+
+    return arrays
+
+
+def arrays_to_frame(name: str, arrays: dict[str, np.ndarray]) -> pd.DataFrame:
+    # The inverse of frame_to_arrays
+    columns = {}
+    for array_name, values in arrays.items():
+        parts = array_name.split('|')
+        if parts[0] != name or len(parts) == 1:
+            continue
+
+        if len(parts) == 4 and parts[2] == 'datetime':
+            times = pd.to_datetime(values, unit='ns', utc=True)
+            columns[parts[1]] = times.tz_convert(parts[3]) if parts[3] != 'None' else times.tz_localize(None)
+        elif values.dtype.kind == 'U':
+            columns[parts[1]] = values.astype(object)
+        else:
+            columns[parts[1]] = values
+
+    return pd.DataFrame(columns, columns=list(arrays[name]))
+
+
+class DetectionStore:
+    """
+    A persistent on-disk store of the results of the detection stages, so separate runs on the same data don't recompute them. Each entry is a
+    compressed .npz file holding the columns of the zigzag, MSB points and order block tables, keyed by the pair, timeframe, the fingerprint of the
+    data and the detection parameters.
+
+    Entries are written atomically (to a temporary file which is then renamed), so concurrent processes never read a partial entry. Loading an
+    entry marks it as recently used, and the least recently used entries are evicted once the store grows beyond max_size_bytes. The size of the
+    store is listed from the directory once, then tracked through the entries saved by this process, and listed again only when it exceeds
+    max_size_bytes, so the store may exceed it by what the other processes saved in the meantime.
+
+    The tables of the last memo_max_entries entries loaded or saved are kept in memory, and returned by later loads of the same key without reading
+    the file. They're shared by the algos using them, which don't modify them.
+    """
+
+    def __init__(self, store_dir: str, max_size_bytes: int):
+        self.store_dir = store_dir
+        self.max_size_bytes = max_size_bytes
+        self.total_size: int | None = None
+        self.memo: dict[str, dict[str, pd.DataFrame]] = {}
+
+    def make_key(self, pair_name: str, timeframe: str, fingerprint: str, params) -> str:
+        key_source = json.dumps([STORE_VERSION, pair_name, timeframe, fingerprint, get_detection_params(params)], sort_keys=True)
+        return f'{pair_name}-{hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()}'
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.store_dir, f'{key}.npz')
+
+    def load(self, key: str, table_names: list[str]) -> dict[str, pd.DataFrame] | None:
+        """
+        Returns the given tables of an entry by name, or None if there is no valid entry for the key holding all of them.
+        """
+        tables = self.memo.get(key)
+        if tables is not None and all(table_name in tables for table_name in table_names):
+            return self.remember(key, tables)
+
+        path = self.get_path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {array_name: entry[array_name] for array_name in entry.files}
+        except (FileNotFoundError, OSError, ValueError):
+            # A missing entry, or one evicted or corrupted in the meantime
+            return None
+
+        # An entry missing a table is a miss, and is overwritten by the run recomputing it
+        if any(table_name not in arrays for table_name in table_names):
+            return None
+
+        # Mark the entry as recently used for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return self.remember(key, {table_name: arrays_to_frame(table_name, arrays) for table_name in table_names})
+
+    def remember(self, key: str, tables: dict[str, pd.DataFrame]) -> dict[str, pd.DataFrame]:
+        # Keeps the tables of an entry in memory as the most recently used one, forgetting the least recently used entry beyond memo_max_entries
+        self.memo.pop(key, None)
+        self.memo[key] = tables
+        if len(self.memo) > memo_max_entries:
+            del self.memo[next(iter(self.memo))]
+
+        return tables
+
+    def save(self, key: str, tables: dict[str, pd.DataFrame]):
+        arrays = {}
+        for table_name, table in tables.items():
+            arrays.update(frame_to_arrays(table_name, table))
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        if self.total_size is None:
+            self.total_size = self.evict()
+
+        path = self.get_path(key)
+        try:
+            previous_size = os.path.getsize(path)
+        except OSError:
+            previous_size = 0
+
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.store_dir, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                np.savez_compressed(temp_file, **arrays)
+            entry_size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self.remember(key, tables)
+        self.total_size += entry_size - previous_size
+        if self.total_size > self.max_size_bytes:
+            self.total_size = self.evict()
+
+    def evict(self) -> int:
+        # Deletes the least recently used entries until the store fits in max_size_bytes, and returns the size of the remaining entries
+        entries = []
+        for file_name in os.listdir(self.store_dir):
+            if not file_name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.store_dir, file_name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, file_name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+
+            try:
+                os.remove(os.path.join(self.store_dir, file_name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+        return total_size
+
+
+def get_detection_store(timeframe: str) -> DetectionStore | None:
+    # The detection store of the timeframe, shared by every run in this process, or None if it's disabled with --no_detection_store
+    if not constants.use_detection_store:
+        return None
+
+    store_key = (f'./cached_data/{timeframe}/detection_store', int(constants.detection_store_max_mb * 1024 * 1024))
+    if store_key not in _detection_stores:
+        _detection_stores[store_key] = DetectionStore(*store_key)
+
+    return _detection_stores[store_key]
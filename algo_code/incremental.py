@@ -0,0 +1,183 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from algo_code.algo import Algo
+from algo_code.detection_store import fingerprint_pair_df
+from algo_code.run_algo import run_detection_stages
+from algo_code.trade_records import TradeRecords
+import utils.datatypes as dt
+from utils import constants
+
+# Bumped whenever the simulation or the stored format change, so the results of older versions are never reused
+MANIFEST_VERSION = 1
+
+# The parameters the trades of a pair depend on
+trading_param_names = ['timeframe', 'zigzag_window_size', 'fib_retracement_coeff', 'stoploss_coeff', 'target_coeff', 'max_bounces', 'max_concurrent',
+                       'used_capital', 'trailing_sl_target_id', 'ob_size_lower_limit', 'ob_size_upper_limit', 'n_targets', 'price_setup',
+                       'intrabar_timeframe']
+
+
+def hash_trading_params(params) -> str:
+    # The parameters whose value is None aren't part of the parameter sets (see param_set_generator.get_base_params)
+    trading_params = {param_name: getattr(params, param_name, None) for param_name in trading_param_names}
+    trading_params['position_type'] = constants.position_type
+    key_source = json.dumps([MANIFEST_VERSION, trading_params], sort_keys=True)
+
+    return hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()
+
+
+def get_finished_order_blocks(ob_list: list, n_candles: int) -> np.ndarray:
+    """
+    Finds the order blocks whose trades can't change when candles are appended to the data. An order block is finished if its position isn't left
+    open at the end of the data, and it can't be entered again: either it has no bounces left, or its active region (which is never extended by
+    new candles) ended within the data.
+    """
+    return np.array([ob.position.status != "ENTERED" and (ob.remaining_bounces <= 0 or -1 < ob.end_pdi < n_candles) for ob in ob_list],
+                    dtype=bool)
+
+
+def get_ob_table(ob_list: list) -> dict[str, np.ndarray]:
+    # The identity of each order block, used to match the order blocks of two runs
+    return {
+        'base_candle_pdi': np.array([ob.base_candle_pdi for ob in ob_list], dtype=np.int64),
+        'is_long': np.array([ob.type == 'long' for ob in ob_list], dtype=bool),
+        'formation_pdi': np.array([ob.formation_pdi for ob in ob_list], dtype=np.int64),
+        'end_pdi': np.array([ob.end_pdi for ob in ob_list], dtype=np.int64),
+    }
+
+
+class IncrementalManifest:
+    """
+    The results of the previous run of main.py for each pair: the fingerprint of the pair's data, the hash of the trading parameters, the trade
+    records and the order blocks with whether they were finished. Stored in a directory per report, as a manifest.json and an .npz file per pair.
+    """
+
+    def __init__(self, manifest_dir: str):
+        self.manifest_dir = manifest_dir
+        self.manifest_path = os.path.join(manifest_dir, 'manifest.json')
+
+        try:
+            with open(self.manifest_path) as manifest_file:
+                self.entries: dict[str, dict] = json.load(manifest_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def get_pair_path(self, pair_name: str) -> str:
+        return os.path.join(self.manifest_dir, f'{pair_name}.npz')
+
+    def load_pair(self, pair_name: str, params_hash: str) -> tuple[dict, dict[str, np.ndarray]] | None:
+        # The manifest entry and the stored arrays of a pair, if it was processed with the same trading parameters
+        entry = self.entries.get(pair_name)
+        if entry is None or entry['params_hash'] != params_hash:
+            return None
+
+        try:
+            with np.load(self.get_pair_path(pair_name), allow_pickle=False) as pair_file:
+                return entry, {array_name: pair_file[array_name] for array_name in pair_file.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+
+    def save_pair(self, pair_name: str, entry: dict, arrays: dict[str, np.ndarray]):
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.write_atomically(self.get_pair_path(pair_name), lambda temp_file: np.savez(temp_file, **arrays))
+        self.entries[pair_name] = entry
+
+    def save(self):
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.write_atomically(self.manifest_path, lambda temp_file: temp_file.write(json.dumps(self.entries, indent=2).encode()))
+
+    def write_atomically(self, path: str, write):
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.manifest_dir, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                write(temp_file)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def run_algo_incremental(pair_name: str, pair_df: dt.PairDf, params, manifest: IncrementalManifest) -> tuple[TradeRecords, Algo | None]:
+    """
+    Runs the algo on a pair, reusing the results of the previous run stored in the manifest where the inputs haven't changed:
+    1) If the data and the trading parameters are unchanged, the previous trade records are returned as they are, without running the algo.
+    2) If candles were only appended to the previous data (the fingerprint of the previous number of candles matches), the detection stages run
+       on the full data, but only the order blocks which aren't identical to an order block finished in the previous run are simulated. The trades
+       of the finished ones are taken from the previous run.
+    3) Otherwise, the whole pair is processed again.
+
+    Returns:
+        tuple[TradeRecords, Algo | None]: The trade records of the pair, and the algo, or None if nothing was run
+    """
+    params_hash = hash_trading_params(params)
+    fingerprint = fingerprint_pair_df(pair_df)
+    n_candles = len(pair_df)
+
+    previous = manifest.load_pair(pair_name, params_hash)
+    if previous is not None and previous[0]['fingerprint'] == fingerprint and previous[0]['n_candles'] == n_candles:
+        entry, arrays = previous
+        return TradeRecords.from_records(pair_name, params.n_targets, params.used_capital, arrays['records'], tz=entry['tz']), None
+
+    algo = Algo(pair_df, pair_name, params)
+    run_detection_stages(algo)
+    algo.find_order_blocks()
+    algo.process_concurrent_order_blocks()
+    full_ob_list = algo.ob_list
+    ob_table = get_ob_table(full_ob_list)
+
+    # The keys of the order blocks whose trades are reused. Order blocks sharing a (base candle, type) key with another one are never reused, since
+    # their trade records can't be told apart.
+    reused_keys = set()
+    if previous is not None and 0 < previous[0]['n_candles'] <= n_candles:
+        entry, arrays = previous
+        if fingerprint_pair_df(pair_df.iloc[:entry['n_candles']]) == entry['fingerprint']:
+            new_keys = list(zip(ob_table['base_candle_pdi'].tolist(), ob_table['is_long'].tolist()))
+            previous_keys = list(zip(arrays['ob_base_candle_pdi'].tolist(), arrays['ob_is_long'].tolist()))
+            new_key_counts = collections.Counter(new_keys)
+            previous_key_counts = collections.Counter(previous_keys)
+            unique_keys = {key for key in new_keys if new_key_counts[key] == 1 and previous_key_counts[key] == 1}
+
+            previous_obs = {key: (formation_pdi, end_pdi) for key, formation_pdi, end_pdi, is_finished
+                            in zip(previous_keys, arrays['ob_formation_pdi'].tolist(), arrays['ob_end_pdi'].tolist(), arrays['ob_finished'].tolist())
+                            if is_finished}
+            reused_keys = {key for key, formation_pdi, end_pdi in zip(new_keys, ob_table['formation_pdi'].tolist(), ob_table['end_pdi'].tolist())
+                           if key in unique_keys and previous_obs.get(key) == (formation_pdi, end_pdi)}
+
+    # Only the order blocks which aren't reused are simulated
+    algo.ob_list = [ob for ob in full_ob_list if (ob.base_candle_pdi, ob.type == 'long') not in reused_keys]
+    algo.calc_events_array()
+    algo.process_events_array()
+    algo.ob_list = full_ob_list
+
+    records = algo.trade_records.records
+    if reused_keys:
+        previous_records = previous[1]['records']
+        is_reused = np.array([key in reused_keys for key in zip(previous_records['ob_base_pdi'].tolist(), previous_records['is_long'].tolist())],
+                             dtype=bool)
+        records = np.concatenate([previous_records[is_reused], records])
+
+        # Order the records by their order block, as if all the order blocks had been simulated
+        ob_order = {}
+        for ob_index, key in enumerate(zip(ob_table['base_candle_pdi'].tolist(), ob_table['is_long'].tolist())):
+            ob_order.setdefault(key, ob_index)
+        record_ob_order = np.array([ob_order[key] for key in zip(records['ob_base_pdi'].tolist(), records['is_long'].tolist())], dtype=np.int64)
+        records = records[np.argsort(record_ob_order, kind='stable')]
+
+    trade_records = TradeRecords.from_records(pair_name, params.n_targets, params.used_capital, records, tz=algo.time_index.tz)
+
+    # The order blocks reused from the previous run are finished by definition; the others are checked after their simulation.
+    is_finished = get_finished_order_blocks(full_ob_list, n_candles)
+    is_finished |= np.array([(ob.base_candle_pdi, ob.type == 'long') in reused_keys for ob in full_ob_list], dtype=bool)
+
+    manifest.save_pair(pair_name,
+                       {'fingerprint': fingerprint, 'n_candles': n_candles, 'params_hash': params_hash,
+                        'tz': str(algo.time_index.tz) if algo.time_index.tz is not None else None},
+                       {'records': records, 'ob_finished': is_finished, **{f'ob_{name}': values for name, values in ob_table.items()}})
+
+    return trade_records, algo
@@ -0,0 +1,85 @@
+import numpy as np
+
+from utils.general_utils import get_high_low_array, get_pair_data_path, get_time_offsets_index
+from utils.resample import parse_timeframe
+from utils.time_index import PairTimeIndex
+
+
+class IntrabarCandles:
+    """
+    The lower timeframe candles within the candles of a pair, used to resolve the order of the events of the candles which touch several price
+    levels of a position (see Algo.find_trade_intrabar).
+
+    Nothing is loaded up front. The highs and lows within a candle are read from the lower timeframe cache the first time the candle is requested,
+    together with all the candles registered with prefetch() in the meantime: the rows of each candle are found by a binary search in the
+    memory-mapped index of the candle times of the file, and the rows of all the candles are read at once from the memory-mapped highs and lows of
+    the file (see get_sidecar_array), whatever the format of the file. Both are mapped once per process and shared by all its algos, and the
+    candles read are kept for the later requests, so the cost is proportional to the number of ambiguous candles, not to the size of the lower
+    timeframe data.
+    """
+
+    def __init__(self, pair_name: str, timeframe: str, lower_timeframe: str, time_index: PairTimeIndex):
+        if parse_timeframe(lower_timeframe) >= parse_timeframe(timeframe):
+            raise ValueError(f'The intrabar timeframe {lower_timeframe} must be lower than the timeframe {timeframe}')
+
+        self.hdf_path = get_pair_data_path(pair_name, lower_timeframe)
+        self.candle_duration = parse_timeframe(timeframe).value
+        self.time_index = time_index
+
+        # The times of the lower timeframe candles and their memory-mapped highs and lows, once opened
+        self.times: np.ndarray | None = None
+        self.high_low: np.ndarray | None = None
+
+        # The highs and lows of the lower timeframe candles within each candle read so far, by PDI, and the PDIs to read with the next request
+        self.candles: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        self.pending_pdis: set[int] = set()
+
+        # The number of times the file was read
+        self.n_reads = 0
+
+    def prefetch(self, pdis):
+        # Registers candles to be read together with the next candle requested
+        self.pending_pdis.update(int(pdi) for pdi in pdis if int(pdi) not in self.candles)
+
+    def get_candles(self, pdi: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the highs and lows of the lower timeframe candles within a candle, which are empty if the lower timeframe has no candles within it.
+        """
+        if pdi not in self.candles:
+            self.pending_pdis.add(pdi)
+            self.load(np.array(sorted(self.pending_pdis), dtype=np.int64))
+            self.pending_pdis.clear()
+
+        return self.candles[pdi]
+
+    def open(self):
+        # Maps the index of the candle times of the lower timeframe file and its highs and lows, which are shared by all the algos of the process
+        try:
+            self.times = get_time_offsets_index(self.hdf_path)
+            self.high_low = get_high_low_array(self.hdf_path)
+        except (FileNotFoundError, OSError):
+            # No lower timeframe data for the pair, so none of the candles can be resolved
+            self.times = np.array([], dtype=np.int64)
+            self.high_low = np.empty((0, 2))
+
+    def load(self, pdis: np.ndarray):
+        if self.times is None:
+            self.open()
+
+        # The row range of the lower timeframe candles within each candle
+        candle_starts = self.time_index.to_epochs(pdis)
+        start_rows = np.searchsorted(self.times, candle_starts, side='left')
+        stop_rows = np.searchsorted(self.times, candle_starts + self.candle_duration, side='left')
+
+        # The offsets of the rows of each candle in the rows read
+        n_rows = stop_rows - start_rows
+        row_offsets = np.concatenate(([0], np.cumsum(n_rows)))
+
+        # The rows of all the candles are read at once from the memory-mapped highs and lows
+        rows = np.repeat(start_rows - row_offsets[:-1], n_rows) + np.arange(row_offsets[-1])
+        high_low = self.high_low[rows]
+        highs, lows = high_low[:, 0], high_low[:, 1]
+        self.n_reads += 1
+
+        for pdi, row_offset, next_row_offset in zip(pdis.tolist(), row_offsets[:-1], row_offsets[1:]):
+            self.candles[pdi] = (highs[row_offset:next_row_offset], lows[row_offset:next_row_offset])
@@ -9,7 +9,8 @@ from utils import constants
 
 
 class OrderBlock:
-    def __init__(self, base_candle: pd.Series | dt.Candle, ob_type: str, formation_pdi: int, params):
+    def __init__(self, base_candle: pd.Series | dt.Candle, ob_type: str, formation_pdi: int, params, pdi_offset: int = 0,
+                 setup_position_prices: bool = True):
         if isinstance(base_candle, pd.Series):
             self.base_candle_pdi = base_candle.name
         elif isinstance(base_candle, dt.Candle):
@@ -22,7 +23,9 @@ class OrderBlock:
         self.formation_pdi = formation_pdi
         self.end_pdi = -1
         self.type = ob_type
-        self.id = f"OB{self.base_candle_pdi}/" + gen_utils.convert_timestamp_to_readable(base_candle.time)
+        # pdi_offset is the PDI of the first candle of the OB's pair, when several pairs are processed concatenated. The ID always uses the PDI
+        # within the pair.
+        self.id = f"OB{self.base_candle_pdi - pdi_offset}/" + gen_utils.convert_timestamp_to_readable(base_candle.time)
         self.id += "L" if ob_type == "long" else "S"
 
         # Geometry
@@ -35,10 +38,7 @@ class OrderBlock:
         self.remaining_bounces = params.max_bounces
 
         # The position formed by the OrderBLock
-        self.position = Position(self, params)
-
-        # A list of positions that have been exit, this will be compiled into a report as the output.
-        self.exit_positions = []
+        self.position = Position(self, params, setup_prices=setup_position_prices)
 
         # The events array is an array of events after the start (formation) of the order block for each candle. 0 means entry, -1 means (unmoved)
         # stoploss, and 1, 2, 3 etc. mean the target hits.
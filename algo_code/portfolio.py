@@ -0,0 +1,167 @@
+import csv
+import heapq
+import os
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from algo_code.trade_records import TradeRecords
+
+# The order of the events happening at the same time: the exits of the positions entered earlier free their capital before the entries, and the
+# exit of a position entered and exited on the same candle comes after its own entry.
+EXIT = 0
+ENTRY = 1
+SAME_CANDLE_EXIT = 2
+
+
+# The number of trades of a pair whose capital and net profit are calculated at once while its events are generated
+events_block_size = 4096
+
+
+def iter_trade_events(pair_index: int, trade_records: TradeRecords, block_size: int = events_block_size) -> Iterator[tuple]:
+    """
+    Yields the entries and exits of the trades of a pair in time order, as (time, event type, pair index, trade index, capital, net profit) tuples.
+    The first four items are unique to each event, so the events of several pairs can be merged by comparing the tuples.
+
+    The events are generated lazily: the trades are walked in the order of their entries, with their capital and net profit calculated a block of
+    trades at a time, and the exit of each trade entered waits in a heap until the next entry comes after it. Besides the records, a pair only
+    holds a block of trades, the exits of its open trades and, if its records aren't in the order of their entries, the order of its entries.
+    """
+    records = trade_records.records
+    entry_times = records['entry_time']
+    entry_order = np.argsort(entry_times, kind='stable') if np.any(entry_times[1:] < entry_times[:-1]) else None
+
+    pending_exits = []
+    for block_start in range(0, len(records), block_size):
+        block_stop = min(block_start + block_size, len(records))
+        trade_indices = entry_order[block_start:block_stop] if entry_order is not None else np.arange(block_start, block_stop)
+
+        block_records = TradeRecords.from_records(trade_records.symbol, trade_records.n_targets, trade_records.capital_used,
+                                                  records[trade_indices])
+        capitals = block_records.records['qty'] * block_records.records['entry_price']
+        net_profits = block_records.net_profits()
+
+        for trade_index, entry_time, exit_time, capital, net_profit in zip(trade_indices.tolist(), block_records.records['entry_time'].tolist(),
+                                                                           block_records.records['exit_time'].tolist(), capitals.tolist(),
+                                                                           net_profits.tolist()):
+            # The exits of the trades entered earlier which come before this entry
+            while pending_exits and pending_exits[0][:2] < (entry_time, ENTRY):
+                yield heapq.heappop(pending_exits)
+
+            yield entry_time, ENTRY, pair_index, trade_index, capital, net_profit
+            heapq.heappush(pending_exits, (exit_time, SAME_CANDLE_EXIT if exit_time == entry_time else EXIT, pair_index, trade_index, capital,
+                                           net_profit))
+
+    while pending_exits:
+        yield heapq.heappop(pending_exits)
+
+
+class PortfolioSimulator:
+    """
+    Simulates the trades of all the pairs on a single account. The time-ordered entries and exits of each pair are merged into one stream with a
+    heap (heapq.merge), which only holds the next event of each pair, and each entry is only taken if the account can afford it:
+    1) The capital of the open positions can't exceed the equity of the account (no leverage), nor max_capital, if given.
+    2) The number of open positions can't exceed max_positions, if given.
+    The exits of the trades which weren't taken are ignored. The equity is the realized equity: the initial capital plus the net profits of the
+    positions exited so far.
+
+    The equity curve is written row by row to a CSV file while the events are processed, and the events of each pair are generated lazily (see
+    iter_trade_events). Besides the trade records and the taken masks it returns, one boolean per trade, the simulation holds a block of trades
+    and the exits of the open trades of each pair, and the entry order of the pairs whose records aren't in that order.
+    """
+
+    def __init__(self, initial_capital: float, max_capital: float | None = None, max_positions: int | None = None):
+        self.initial_capital = initial_capital
+        self.max_capital = max_capital
+        self.max_positions = max_positions
+
+    def run(self, trade_records_list: list[TradeRecords], equity_curve_path: str | None = None) -> tuple[dict, list[np.ndarray]]:
+        """
+        Runs the simulation over the trades of the given pairs.
+
+        Args:
+            trade_records_list (list[TradeRecords]): The finalized trade records of each pair
+            equity_curve_path (str | None): The CSV file to write the equity curve to, one row per entry or exit taken, if given
+
+        Returns:
+            tuple[dict, list[np.ndarray]]: The summary of the simulation, and for each pair, whether each of its trades was taken
+        """
+        taken_masks = [np.zeros(len(trade_records), dtype=bool) for trade_records in trade_records_list]
+        tz = next((trade_records.tz for trade_records in trade_records_list if trade_records.tz is not None), None)
+
+        equity = self.initial_capital
+        peak_equity = equity
+        max_drawdown = 0
+        capital_in_use = 0
+        open_positions = 0
+        max_open_positions = 0
+        n_skipped_for_capital = 0
+        n_skipped_for_positions = 0
+
+        equity_curve_file = None
+        if equity_curve_path is not None:
+            os.makedirs(os.path.dirname(equity_curve_path) or '.', exist_ok=True)
+            equity_curve_file = open(equity_curve_path, 'w', newline='')
+        try:
+            equity_curve_writer = csv.writer(equity_curve_file) if equity_curve_file is not None else None
+            if equity_curve_writer is not None:
+                equity_curve_writer.writerow(['Time', 'Pair name', 'Event', 'Equity', 'Capital in use', 'Open positions', 'Drawdown'])
+
+            event_streams = [iter_trade_events(pair_index, trade_records) for pair_index, trade_records in enumerate(trade_records_list)]
+            for time, event_type, pair_index, trade_index, capital, net_profit in heapq.merge(*event_streams):
+                if event_type == ENTRY:
+                    if self.max_positions is not None and open_positions >= self.max_positions:
+                        n_skipped_for_positions += 1
+                        continue
+
+                    capital_limit = min(equity, self.max_capital) if self.max_capital is not None else equity
+                    if capital_in_use + capital > capital_limit:
+                        n_skipped_for_capital += 1
+                        continue
+
+                    taken_masks[pair_index][trade_index] = True
+                    capital_in_use += capital
+                    open_positions += 1
+                    max_open_positions = max(max_open_positions, open_positions)
+
+                else:
+                    if not taken_masks[pair_index][trade_index]:
+                        continue
+
+                    capital_in_use -= capital
+                    open_positions -= 1
+                    equity += net_profit
+
+                    peak_equity = max(peak_equity, equity)
+                    max_drawdown = max(max_drawdown, peak_equity - equity)
+
+                if equity_curve_writer is not None:
+                    timestamp = pd.Timestamp(time, tz='UTC')
+                    equity_curve_writer.writerow([timestamp.tz_convert(tz) if tz is not None else timestamp.tz_localize(None),
+                                                  trade_records_list[pair_index].symbol,
+                                                  'entry' if event_type == ENTRY else 'exit',
+                                                  equity,
+                                                  capital_in_use,
+                                                  open_positions,
+                                                  peak_equity - equity])
+        finally:
+            if equity_curve_file is not None:
+                equity_curve_file.close()
+
+        n_trades = sum(len(taken_mask) for taken_mask in taken_masks)
+        n_taken = sum(int(taken_mask.sum()) for taken_mask in taken_masks)
+        summary = {
+            'initial_capital': self.initial_capital,
+            'final_equity': equity,
+            'net_profit': equity - self.initial_capital,
+            'max_drawdown': max_drawdown,
+            'max_drawdown_pct': max_drawdown / peak_equity * 100 if peak_equity > 0 else 0,
+            'n_trades': n_trades,
+            'n_taken': n_taken,
+            'n_skipped_for_capital': n_skipped_for_capital,
+            'n_skipped_for_positions': n_skipped_for_positions,
+            'max_open_positions': max_open_positions,
+        }
+
+        return summary, taken_masks
@@ -2,11 +2,11 @@
 import numpy as np
 
 import algo_code.position_prices_setup as setup
-import utils.constants as constants
+from algo_code.trade_records import TradeRecords
 
 
 class Position:
-    def __init__(self, parent_ob, params):
+    def __init__(self, parent_ob, params, setup_prices: bool = True):
         self.parent_ob = parent_ob
         self.entry_price = parent_ob.top if parent_ob.type == "long" else parent_ob.bottom
 
@@ -18,16 +18,16 @@ class Position:
         self.highest_target: int = 0
         self.target_hit_pdis: list[int] = []
         self.exit_pdi = None
-        self.portioned_qty: np.ndarray = np.array([])
-        self.net_profit = None
 
         self.target_list: np.ndarray = np.array([])
         self.stoploss = None
 
         self.params = params
 
-        # Set up the target list nd stoploss using a function which operates on the "self" object and directly manipulates the instance.
-        setup.small_box_1234(self, params)
+        # Set up the target list nd stoploss using a function which operates on the "self" object and directly manipulates the instance. When the
+        # positions of many order blocks are created at once, this is skipped and they are set up together using setup.setup_positions_batch().
+        if setup_prices:
+            setup.price_setups[params.price_setup](self, params)
 
     def enter(self, entry_pdi: int):
         """
@@ -43,79 +43,39 @@ class Position:
 
         self.entry_pdi = entry_pdi
         self.qty = self.params.used_capital / self.entry_price
-        target_count = len(self.target_list)
-        self.portioned_qty = np.array([self.qty / target_count] * target_count)
         self.status = "ENTERED"
 
     def exit(self,
-             symbol: str,
-             pair_df_times: np.ndarray,
-             exit_status: str,
+             trade_records: TradeRecords,
              exit_pdi: int,
-             target_hit_pdis: list[int],
-             exit_price: float) -> dict:
+             target_hit_pdis: np.ndarray,
+             exit_price: float,
+             last_target: int,
+             is_full_target: bool = False):
         """
-        Calculate the exit parameters when triggered, and return a dict item containing the exit parameters.
+        Register the exit of the position as a record in the trade records of the pair. The net profit and the exit status of the record are
+        calculated later for all the records at once.
+
         Args:
-            symbol (str): The name of the pair currently being backtested
-            pair_df_times (np.ndarray): A numpy ndarray containing time data from pair_df
-            exit_status (str): The exit status, can be 'STOPLOSS', 'TRAILING', 'FULL_TARGET_*' or 'TARGET_*'
+            trade_records (TradeRecords): The trade records of the pair currently being backtested
             exit_pdi (int): The PDI of the exiting candle
-            target_hit_pdis (list[int]): The PDI's of the targets hit
+            target_hit_pdis (np.ndarray): The PDI's of the targets hit
             exit_price (float): The exiting price
-
-        Returns:
-            dict: A dict containing the exit parameters of the position, to be added to its parent OB's exit_positions list.
+            last_target (int): The highest target hit before the exit, 0 if no target was hit
+            is_full_target (bool): Whether the position exited by hitting its full target
         """
 
-        # Net profit calculation
-        n_targets_hit = len(target_hit_pdis)
-        targets_hit = self.target_list[:n_targets_hit]
-        targets_qty = self.portioned_qty[:n_targets_hit]
-        stopped_qty = self.qty - sum(targets_qty)
-
-        if self.type == 'long':
-            loss_from_entry = self.qty * self.entry_price
-            gain_from_targets = sum(targets_qty * targets_hit)
-            # If the exit status is anything but FULL_TARGET, that means a stoploss has been hit, therefore the exit price is the stoploss OR
-            # the trailing stoploss
-            if not exit_status.startswith('FULL_TARGET'):
-                gain_from_stoploss = stopped_qty * exit_price
-            else:
-                gain_from_stoploss = 0
-
-            net_profit = gain_from_targets + gain_from_stoploss - loss_from_entry
-
-        else:
-            gain_from_entry = self.qty * self.entry_price
-            loss_from_targets = sum(targets_qty * targets_hit)
-
-            # If the exit status is anything but FULL_TARGET, that means a stoploss has been hit, therefore the exit price is the stoploss OR
-            # the trailing stoploss
-            if not exit_status.startswith('FULL_TARGET'):
-                loss_from_stoploss = stopped_qty * exit_price
-            else:
-                loss_from_stoploss = 0
-
-            net_profit = gain_from_entry - loss_from_targets - loss_from_stoploss
-
-        exit_parameters = {
-            'Pair name': symbol,
-            'Position ID': self.parent_ob.id,
-            'Capital used': constants.used_capital,
-            'Status': exit_status,
-            'Net profit': net_profit,
-            'Quantity': self.qty,
-            'Entry time': pair_df_times[self.entry_pdi],
-            'Exit time': pair_df_times[exit_pdi],
-            'Target hit times': pair_df_times[target_hit_pdis].copy(),
-            'Type': self.type,
-            'Entry price': self.entry_price,
-            'Exit price': exit_price,
-            'Stoploss': self.stoploss,
-            'Target list': [float(target) for target in self.target_list]
-        }
-
-        self.parent_ob.exit_positions.append(exit_parameters)
-
-        return exit_parameters
+        trade_records.append(ob_base_pdi=self.parent_ob.base_candle_pdi,
+                             is_long=self.type == 'long',
+                             entry_pdi=self.entry_pdi,
+                             exit_pdi=exit_pdi,
+                             target_hit_pdis=target_hit_pdis,
+                             last_target=last_target,
+                             is_full_target=is_full_target,
+                             qty=self.qty,
+                             entry_price=self.entry_price,
+                             exit_price=exit_price,
+                             stoploss=self.stoploss,
+                             target_list=self.target_list)
+
+        self.status = "EXITED"
@@ -1,6 +1,31 @@
+from typing import Callable
+
 import numpy as np
 
+# The registries of the price setup strategies. Each strategy has a scalar version, which sets up the stoploss and targets of a single position,
+# and optionally a batch version, which calculates the stoplosses and targets of all the positions at once. The strategy used is selected by
+# params.price_setup, and the batch version is used automatically whenever one is registered.
+price_setups: dict[str, Callable] = {}
+batch_price_setups: dict[str, Callable] = {}
+
+
+def register_price_setup(name: str):
+    def decorator(function):
+        price_setups[name] = function
+        return function
+
+    return decorator
+
+
+def register_batch_price_setup(name: str):
+    def decorator(function):
+        batch_price_setups[name] = function
+        return function
 
+    return decorator
+
+
+@register_price_setup('default_1234')
 def default_1234(position, params):
     if position.type == "long":
         position.stoploss = position.entry_price - params.stoploss_coeff * position.parent_ob.height
@@ -16,6 +41,7 @@ def default_1234(position, params):
         ])
 
 
+@register_price_setup('small_box_1234')
 def small_box_1234(position, params):
     # For very small boxes, calculate targets and stoplosses based on a box height of 1% of the price.
     if position.parent_ob.height_percentage > 1:
@@ -48,3 +74,51 @@ def small_box_1234(position, params):
                 for i in range(params.n_targets)
             ])
 
+
+def calc_prices_from_box_heights(entry_prices: np.ndarray, box_heights: np.ndarray, is_long: np.ndarray, params) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the stoplosses and targets of positions whose stoploss is stoploss_coeff box heights away from the entry, and whose n-th target is
+    n * target_coeff box heights away from the entry.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The stoploss vector and the targets matrix, with one row per position and one column per target
+    """
+    stoploss_offsets = params.stoploss_coeff * box_heights
+    stoplosses = np.where(is_long, entry_prices - stoploss_offsets, entry_prices + stoploss_offsets)
+
+    target_offsets = (np.arange(1, params.n_targets + 1) * params.target_coeff)[None, :] * box_heights[:, None]
+    targets = np.where(is_long[:, None], entry_prices[:, None] + target_offsets, entry_prices[:, None] - target_offsets)
+
+    return stoplosses, targets
+
+
+@register_batch_price_setup('default_1234')
+def default_1234_batch(entry_prices: np.ndarray, heights: np.ndarray, height_percentages: np.ndarray, is_long: np.ndarray, params):
+    return calc_prices_from_box_heights(entry_prices, heights, is_long, params)
+
+
+@register_batch_price_setup('small_box_1234')
+def small_box_1234_batch(entry_prices: np.ndarray, heights: np.ndarray, height_percentages: np.ndarray, is_long: np.ndarray, params):
+    # Same as small_box_1234, a box height of exactly 1% is left without a stoploss and targets (NaN).
+    box_heights = np.where(height_percentages > 1, heights, np.where(height_percentages < 1, 0.01 * heights, np.nan))
+    return calc_prices_from_box_heights(entry_prices, box_heights, is_long, params)
+
+
+def setup_positions_batch(order_blocks: list, params):
+    """
+    Sets up the stoplosses and targets of the positions of all the given order blocks with a single call to the batch version of the price setup
+    strategy in params.price_setup.
+    """
+    if not order_blocks:
+        return
+
+    entry_prices = np.array([ob.position.entry_price for ob in order_blocks], dtype=np.float64)
+    heights = np.array([ob.height for ob in order_blocks], dtype=np.float64)
+    height_percentages = np.array([ob.height_percentage for ob in order_blocks], dtype=np.float64)
+    is_long = np.array([ob.type == 'long' for ob in order_blocks])
+
+    stoplosses, targets = batch_price_setups[params.price_setup](entry_prices, heights, height_percentages, is_long, params)
+
+    for ob, stoploss, target_list in zip(order_blocks, stoplosses.tolist(), targets):
+        ob.position.stoploss = stoploss
+        ob.position.target_list = target_list
@@ -1,20 +1,82 @@
-import pandas as pd
+from typing import Optional
 
 from algo_code.algo import Algo
+from algo_code.detection_store import fingerprint_pair_df, get_detection_store
+from algo_code.trade_records import TradeRecords
+from algo_code.universe_algo import Universe, UniverseAlgo
 import utils.datatypes as dt
 
 
-def run_algo(pair_name: str, pair_df: dt.PairDf, params) -> tuple[list, Algo]:
-    algo = Algo(pair_df, pair_name, params)
+# The tables of the detection stages kept in the detection store
+detection_table_names = ['zigzag', 'msb_points', 'ob_bases']
+
+
+def detection_key(params) -> tuple:
+    # The parameters the detection stages (zigzag, MSB points and order block bases) depend on
+    return params.zigzag_window_size, params.fib_retracement_coeff, params.ob_size_lower_limit, params.ob_size_upper_limit
+
+
+def run_detection_stages(algo: Algo):
+    """
+    Runs the detection stages of the algo (zigzag, MSB points and order block bases), or loads their results from the detection store if an earlier
+    run has stored them for the same data and detection parameters.
+    """
+    store = get_detection_store(algo.params.timeframe)
+    if store is None:
+        algo.init_zigzag()
+        algo.find_msb_points()
+        algo.find_order_block_bases()
+        return
+
+    key = store.make_key(algo.symbol, algo.params.timeframe, fingerprint_pair_df(algo.pair_df), algo.params)
+    tables = store.load(key, detection_table_names)
+    if tables is not None:
+        algo.zigzag_df = dt.ZigZagDf(tables['zigzag'])
+        algo.msb_points_df = dt.MSBPointsDf(tables['msb_points'])
+        algo.ob_bases_df = tables['ob_bases']
+        return
+
     algo.init_zigzag()
     algo.find_msb_points()
-    order_blocks = algo.find_order_blocks()
+    algo.find_order_block_bases()
+    store.save(key, {'zigzag': algo.zigzag_df, 'msb_points': algo.msb_points_df, 'ob_bases': algo.ob_bases_df})
+
+
+def run_detection(pair_name: str, pair_df: dt.PairDf, params) -> Algo:
+    # Runs only the detection stages of the algo, whose results can be reused for every parameter set with the same detection_key.
+    algo = Algo(pair_df, pair_name, params)
+    run_detection_stages(algo)
+
+    return algo
+
+
+def run_algo(pair_name: str, pair_df: dt.PairDf, params, detection: Optional[Algo] = None) -> tuple[TradeRecords, Algo]:
+    algo = Algo(pair_df, pair_name, params)
+
+    # Reuse the results of a previous detection run with the same detection_key, if given
+    if detection is not None:
+        algo.zigzag_df = detection.zigzag_df
+        algo.msb_points_df = detection.msb_points_df
+        algo.ob_bases_df = detection.ob_bases_df
+    else:
+        run_detection_stages(algo)
+
+    algo.find_order_blocks()
     algo.process_concurrent_order_blocks()
     algo.calc_events_array()
     algo.process_events_array()
 
-    pair_exit_positions = []
-    for ob in order_blocks:
-        pair_exit_positions.extend(ob.exit_positions)
+    return algo.trade_records, algo
+
+
+def run_universe_algo(universe: Universe, params) -> tuple[dict[str, TradeRecords], UniverseAlgo]:
+    # Runs the stages of the algo once over all the pairs of the universe, and returns the trade records split per pair.
+    algo = UniverseAlgo(universe, params)
+    algo.init_zigzag()
+    algo.find_msb_points()
+    algo.find_order_blocks()
+    algo.process_concurrent_order_blocks()
+    algo.calc_events_array()
+    algo.process_events_array()
 
-    return pair_exit_positions, algo
+    return algo.split_trade_records(), algo
@@ -0,0 +1,196 @@
+import numpy as np
+import pandas as pd
+
+import utils.general_utils as gen_utils
+from utils.time_index import PairTimeIndex
+
+
+def trade_record_dtype(n_targets: int) -> np.dtype:
+    return np.dtype([
+        ('ob_base_pdi', np.int64),
+        ('ob_base_time', np.int64),
+        ('is_long', np.bool_),
+        ('entry_pdi', np.int64),
+        ('exit_pdi', np.int64),
+        ('entry_time', np.int64),
+        ('exit_time', np.int64),
+        ('n_targets_hit', np.int16),
+        ('target_hit_pdis', np.int64, (n_targets,)),
+        ('target_hit_times', np.int64, (n_targets,)),
+        ('last_target', np.int16),
+        ('is_full_target', np.bool_),
+        ('qty', np.float64),
+        ('entry_price', np.float64),
+        ('exit_price', np.float64),
+        ('stoploss', np.float64),
+        ('target_list', np.float64, (n_targets,)),
+    ])
+
+
+class TradeRecords:
+    """
+    The exits of the positions of a pair, written into a preallocated NumPy structured array which grows by doubling its capacity. Times are stored
+    as int64 epoch nanoseconds and are filled in for all the records at once by finalize(). The records are only converted to a DataFrame of
+    report rows at the output boundary, using to_dataframe().
+    """
+
+    def __init__(self, symbol: str, n_targets: int, capital_used: float, capacity: int = 64, tz=None):
+        self.symbol = symbol
+        self.n_targets = n_targets
+        self.capital_used = capital_used
+        self.tz = tz
+
+        self._buffer = np.zeros(capacity, dtype=trade_record_dtype(n_targets))
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def records(self) -> np.ndarray:
+        return self._buffer[:self._size]
+
+    def append(self,
+               ob_base_pdi: int,
+               is_long: bool,
+               entry_pdi: int,
+               exit_pdi: int,
+               target_hit_pdis: np.ndarray,
+               last_target: int,
+               is_full_target: bool,
+               qty: float,
+               entry_price: float,
+               exit_price: float,
+               stoploss: float,
+               target_list: np.ndarray):
+        if self._size == len(self._buffer):
+            grown_buffer = np.zeros(max(2 * len(self._buffer), 1), dtype=self._buffer.dtype)
+            grown_buffer[:self._size] = self._buffer
+            self._buffer = grown_buffer
+
+        record = self._buffer[self._size]
+        record['ob_base_pdi'] = ob_base_pdi
+        record['is_long'] = is_long
+        record['entry_pdi'] = entry_pdi
+        record['exit_pdi'] = exit_pdi
+        record['n_targets_hit'] = len(target_hit_pdis)
+        record['target_hit_pdis'] = -1
+        record['target_hit_pdis'][:len(target_hit_pdis)] = target_hit_pdis
+        record['last_target'] = last_target
+        record['is_full_target'] = is_full_target
+        record['qty'] = qty
+        record['entry_price'] = entry_price
+        record['exit_price'] = exit_price
+        record['stoploss'] = stoploss
+        record['target_list'] = target_list
+
+        self._size += 1
+
+    @classmethod
+    def from_records(cls, symbol: str, n_targets: int, capital_used: float, records: np.ndarray, tz=None) -> 'TradeRecords':
+        # Trade records holding an existing array of (finalized) records, e.g. records loaded from disk or merged from several runs
+        trade_records = cls(symbol, n_targets, capital_used, capacity=0, tz=tz)
+        trade_records._buffer = records
+        trade_records._size = len(records)
+
+        return trade_records
+
+    def take(self, mask: np.ndarray, symbol: str, pdi_offset: int = 0) -> 'TradeRecords':
+        """
+        Returns the records selected by a boolean mask as the trade records of another pair, with their PDIs shifted by -pdi_offset. Used to split
+        the records of several pairs processed concatenated back into records per pair.
+        """
+        taken = TradeRecords(symbol, self.n_targets, self.capital_used, capacity=0, tz=self.tz)
+        taken._buffer = self.records[mask].copy()
+        taken._size = len(taken._buffer)
+
+        for pdi_field in ['ob_base_pdi', 'entry_pdi', 'exit_pdi']:
+            taken._buffer[pdi_field] -= pdi_offset
+        taken._buffer['target_hit_pdis'] = np.where(taken._buffer['target_hit_pdis'] >= 0, taken._buffer['target_hit_pdis'] - pdi_offset, -1)
+
+        return taken
+
+    def finalize(self, time_index: PairTimeIndex):
+        """
+        Converts the PDIs of all the records to times in one vectorized pass, and trims the buffer to the number of records.
+        """
+        self._buffer = self._buffer[:self._size].copy()
+        self.tz = time_index.tz
+
+        records = self._buffer
+        records['ob_base_time'] = time_index.to_epochs(records['ob_base_pdi'])
+        records['entry_time'] = time_index.to_epochs(records['entry_pdi'])
+        records['exit_time'] = time_index.to_epochs(records['exit_pdi'])
+        records['target_hit_times'] = np.where(records['target_hit_pdis'] >= 0,
+                                               time_index.to_epochs(np.maximum(records['target_hit_pdis'], 0)),
+                                               -1)
+
+    def net_profits(self) -> np.ndarray:
+        """
+        Calculates the net profit of all the records in one vectorized operation. The quantity of each position is divided equally between its
+        targets, and whatever quantity remains after the hit targets is exited at the exit price, unless the position has hit its full target.
+        """
+        records = self.records
+        portioned_qty = records['qty'] / self.n_targets
+
+        targets_hit_mask = np.arange(self.n_targets) < records['n_targets_hit'][:, None]
+        targets_value = (records['target_list'] * targets_hit_mask).sum(axis=1) * portioned_qty
+
+        stopped_qty = records['qty'] - portioned_qty * records['n_targets_hit']
+        stopped_value = np.where(records['is_full_target'], 0, stopped_qty * records['exit_price'])
+
+        entry_value = records['qty'] * records['entry_price']
+
+        return np.where(records['is_long'],
+                        targets_value + stopped_value - entry_value,
+                        entry_value - targets_value - stopped_value)
+
+    def statuses(self) -> np.ndarray:
+        records = self.records
+        target_statuses = np.char.add('TARGET_', records['last_target'].astype(str))
+        statuses = np.where(records['last_target'] == 0, 'STOPLOSS', target_statuses)
+
+        return np.where(records['is_full_target'], f'FULL_TARGET_{self.n_targets}', statuses).astype(object)
+
+    def _to_datetimes(self, epochs: np.ndarray) -> pd.DatetimeIndex:
+        times = pd.to_datetime(epochs, unit='ns', utc=True)
+        return times.tz_convert(self.tz) if self.tz is not None else times.tz_localize(None)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Converts the records to the report rows of the positions, one row per exit.
+        """
+        records = self.records
+
+        # The target hit times of all records are converted at once, then split into a list per record.
+        target_hit_times = self._to_datetimes(records['target_hit_times'].ravel()).to_numpy(dtype=object).reshape(len(records), self.n_targets)
+        position_ids = [f'OB{base_pdi}/{gen_utils.convert_timestamp_to_readable(base_time)}{"L" if is_long else "S"}'
+                        for base_pdi, base_time, is_long in zip(records['ob_base_pdi'],
+                                                                 self._to_datetimes(records['ob_base_time']),
+                                                                 records['is_long'])]
+
+        return pd.DataFrame({
+            'Pair name': self.symbol,
+            'Position ID': position_ids,
+            'Capital used': self.capital_used,
+            'Status': self.statuses(),
+            'Net profit': self.net_profits(),
+            'Quantity': records['qty'],
+            'Entry time': self._to_datetimes(records['entry_time']),
+            'Exit time': self._to_datetimes(records['exit_time']),
+            'Target hit times': [list(times[:n_hit]) for times, n_hit in zip(target_hit_times, records['n_targets_hit'])],
+            'Type': np.where(records['is_long'], 'long', 'short'),
+            'Entry price': records['entry_price'],
+            'Exit price': records['exit_price'],
+            'Stoploss': records['stoploss'],
+            'Target list': records['target_list'].tolist()
+        })
+
+    @staticmethod
+    def to_combined_dataframe(trade_records_list: list['TradeRecords']) -> pd.DataFrame:
+        # The report rows of the positions of several pairs
+        dataframes = [trade_records.to_dataframe() for trade_records in trade_records_list if len(trade_records)]
+        if not dataframes:
+            return pd.DataFrame()
+
+        return pd.concat(dataframes, ignore_index=True)
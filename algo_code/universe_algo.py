@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from algo_code.algo import Algo
+from algo_code.trade_records import TradeRecords
+import utils.datatypes as dt
+
+
+class Universe:
+    """
+    The candles of several pairs concatenated into single columns, along with an offsets table. The candles of the i-th pair are the PDIs
+    offsets[i] through offsets[i + 1] - 1 of pair_df. This is built once and reused for every parameter set.
+    """
+
+    # The columns used by the algo
+    columns = ['time', 'high', 'low', 'candle_color']
+
+    def __init__(self, pairs_data: dict[str, dt.PairDf]):
+        self.pair_names: list[str] = list(pairs_data.keys())
+        self.lengths: list[int] = [len(pair_df) for pair_df in pairs_data.values()]
+        self.offsets: np.ndarray = np.concatenate(([0], np.cumsum(self.lengths))).astype(np.int64)
+
+        self.pair_df: dt.PairDf = dt.PairDf(pd.concat([pair_df[self.columns] for pair_df in pairs_data.values()], ignore_index=True))
+
+        # Build the time index of the universe once
+        _ = self.pair_df.time_index
+
+
+class UniverseAlgo(Algo):
+    """
+    Runs every stage of the algo once over all the pairs of a Universe, instead of once per pair. Every stage is segment-aware, meaning no zigzag
+    window, MSB, order block, concurrency limit or events array crosses the boundary between two pairs, so the results are the same as running the
+    pairs one by one. The results are split back per pair at the end.
+    """
+
+    def __init__(self, universe: Universe, params):
+        super().__init__(universe.pair_df, 'UNIVERSE', params, segment_lengths=universe.lengths)
+        self.universe = universe
+
+    def split_trade_records(self) -> dict[str, TradeRecords]:
+        # The trade records of each pair, with the PDIs local to the pair
+        record_segment_ids = self.segment_ids[self.trade_records.records['ob_base_pdi']]
+
+        return {pair_name: self.trade_records.take(record_segment_ids == segment_id, pair_name, pdi_offset=int(self.segment_offsets[segment_id]))
+                for segment_id, pair_name in enumerate(self.universe.pair_names)}
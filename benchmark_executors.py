@@ -0,0 +1,54 @@
+import time
+
+import pandas as pd
+
+import main_param_opt
+from algo_code.universe_algo import Universe
+from param_opt.param_set_generator import get_parameter_sets
+from utils import constants
+from utils.general_utils import get_executor, get_pair_list, load_local_data, format_time
+
+
+def benchmark_pair_level(executor_type, pair_list, all_pairs_data, benchmark_parameter_sets):
+    # Pair-level parallelism: the pairs of each parameter set are processed in parallel, as in main_param_opt.multiprocessing_version.
+    with get_executor(constants.max_processes, executor_type) as executor:
+        for params, _ in benchmark_parameter_sets:
+            list(executor.map(main_param_opt.process_pair,
+                              pair_list,
+                              [params] * len(pair_list),
+                              [all_pairs_data[pair_name] for pair_name in pair_list]))
+
+
+def benchmark_param_level(executor_type, universe, benchmark_parameter_sets):
+    # Parameter-level parallelism: the parameter sets are processed in parallel over the universe, as in main_param_opt.universe_version.
+    with get_executor(constants.max_processes, executor_type, initializer=main_param_opt.init_universe_worker, initargs=(universe,)) as executor:
+        list(executor.map(main_param_opt.process_universe, benchmark_parameter_sets))
+
+
+if __name__ == '__main__':
+    pair_list = get_pair_list(constants.timeframe)
+    all_pairs_data = {pair: load_local_data(pair, constants.timeframe, start=constants.start_time, end=constants.end_time,
+                                            columns=constants.load_columns)
+                      for pair in pair_list}
+    universe = Universe({pair_name: all_pairs_data[pair_name] for pair_name in pair_list})
+    # The number of parameter sets each executor is timed on is given by --benchmark_sets
+    benchmark_parameter_sets = list(get_parameter_sets()[:constants.benchmark_sets])
+
+    print(f'Benchmarking the executors on {len(benchmark_parameter_sets)} parameter sets with {constants.max_processes} workers...')
+
+    results = []
+    for executor_type in ['processes', 'threads']:
+        for level, benchmark in [('pair', lambda: benchmark_pair_level(executor_type, pair_list, all_pairs_data, benchmark_parameter_sets)),
+                                 ('param', lambda: benchmark_param_level(executor_type, universe, benchmark_parameter_sets))]:
+            start_time = time.perf_counter()
+            benchmark()
+            elapsed_time = time.perf_counter() - start_time
+
+            results.append({'executor': executor_type,
+                            'parallelism': level,
+                            'seconds': round(elapsed_time, 3),
+                            'parameter_sets_per_second': round(len(benchmark_parameter_sets) / elapsed_time, 3)})
+            print(f'{executor_type} / {level}-level: {format_time(elapsed_time)} ({elapsed_time:.2f}s)')
+
+    print()
+    print(pd.DataFrame(results).to_string(index=False))
@@ -0,0 +1,122 @@
+"""
+Calibrates the execution settings of main_param_opt.py on this machine by running a short sample of the real workload: the first
+constants.benchmark_sets parameter sets over the pairs. The executor and the number of workers are searched first, with one pair per task, then
+the chunk size and the batching of small pairs for the best of them. The best settings are written to the run profile, which the multiprocessing
+version of main_param_opt.py applies on the same timeframe and number of CPUs and a comparable number of pairs (see utils.config.apply_run_profile);
+the command line arguments still override it.
+"""
+import copy
+import json
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import main_param_opt
+from param_opt.param_set_generator import get_parameter_sets
+from utils import constants
+from utils.config import get_config, set_config, run_profile_path
+from utils.general_utils import get_executor, get_pair_list, load_local_data
+
+
+def time_configuration(pair_list, all_pairs_data, sample_parameter_sets, executor_type: str, n_workers: int, chunksize: int,
+                       min_task_candles: int) -> float:
+    """
+    Times the multiprocessing version of main_param_opt.py on the sample parameter sets with the given execution settings, and returns the
+    parameter sets processed per second. The first parameter set only warms the workers up and isn't timed.
+    """
+    # The settings are passed to the workers and to main_param_opt.map_pairs through the configuration, like the settings of a real run
+    trial_config = copy.copy(get_config())
+    trial_config.executor_type = executor_type
+    trial_config.max_processes = n_workers
+    trial_config.task_chunksize = chunksize
+    trial_config.min_task_candles = min_task_candles
+
+    base_config = get_config()
+    set_config(trial_config)
+    try:
+        with get_executor(n_workers, executor_type) as executor:
+            main_param_opt.map_pairs(executor, sample_parameter_sets[0][0], pair_list, all_pairs_data)
+
+            start_time = time.perf_counter()
+            for params, _ in sample_parameter_sets[1:]:
+                main_param_opt.map_pairs(executor, params, pair_list, all_pairs_data)
+            elapsed_time = time.perf_counter() - start_time
+    finally:
+        set_config(base_config)
+
+    return (len(sample_parameter_sets) - 1) / elapsed_time
+
+
+def get_worker_counts(max_workers: int) -> list[int]:
+    # The powers of 2 up to max_workers, and max_workers itself
+    worker_counts = {max_workers}
+    n_workers = 1
+    while n_workers < max_workers:
+        worker_counts.add(n_workers)
+        n_workers *= 2
+
+    return sorted(worker_counts)
+
+
+if __name__ == '__main__':
+    pair_list = get_pair_list(constants.timeframe)
+    all_pairs_data = {pair: load_local_data(pair, constants.timeframe, start=constants.start_time, end=constants.end_time,
+                                            columns=constants.load_columns)
+                      for pair in pair_list}
+    sample_parameter_sets = list(get_parameter_sets()[:max(constants.benchmark_sets, 2)])
+
+    # More workers than pairs would be idle with one pair per task
+    max_workers = max(min(os.cpu_count() or 1, len(pair_list)), 1)
+    total_candles = sum(len(pair_df) for pair_df in all_pairs_data.values())
+    mean_pair_candles = total_candles / max(len(pair_list), 1)
+
+    print(f'Calibrating on {len(sample_parameter_sets)} parameter sets, {len(pair_list)} pairs and up to {max_workers} workers...')
+
+    results = []
+
+    def run_trial(executor_type, n_workers, chunksize, min_task_candles):
+        sets_per_second = time_configuration(pair_list, all_pairs_data, sample_parameter_sets, executor_type, n_workers, chunksize, min_task_candles)
+        results.append({'executor': executor_type, 'processes': n_workers, 'chunksize': chunksize, 'min_task_candles': min_task_candles,
+                        'sets_per_second': sets_per_second})
+        print(f'{executor_type}, {n_workers} workers, chunksize {chunksize}, min {min_task_candles} candles per task: '
+              f'{sets_per_second:.3f} parameter sets/s')
+
+    # 1) The executor and the number of workers
+    for executor_type in ['processes', 'threads']:
+        for n_workers in get_worker_counts(max_workers):
+            run_trial(executor_type, n_workers, 1, 0)
+    best = max(results, key=lambda result: result['sets_per_second'])
+
+    # 2) The chunk size and the batching of small pairs, aiming at about 4 tasks per worker for each parameter set. The chunk size only makes a
+    # difference for worker processes.
+    tasks_per_set = best['processes'] * 4
+    chunksizes = [1, max(len(pair_list) // tasks_per_set, 1)] if best['executor'] == 'processes' else [1]
+    min_task_candles_options = [0, total_candles // tasks_per_set]
+    for chunksize in sorted(set(chunksizes)):
+        for min_task_candles in sorted(set(min_task_candles_options)):
+            if (chunksize, min_task_candles) != (1, 0):
+                run_trial(best['executor'], best['processes'], chunksize, min_task_candles)
+    best = max(results, key=lambda result: result['sets_per_second'])
+
+    print()
+    print(pd.DataFrame(results).sort_values('sets_per_second', ascending=False).to_string(index=False))
+    print()
+
+    # The minimum number of candles per task is stored relative to the mean size of the pairs, so it scales to the pairs of the runs
+    run_profile = {'executor': best['executor'],
+                   'processes': best['processes'],
+                   'chunksize': best['chunksize'],
+                   'min_task_pairs': best['min_task_candles'] / mean_pair_candles if mean_pair_candles else 0,
+                   'sets_per_second': best['sets_per_second'],
+                   'cpu_count': os.cpu_count(),
+                   'n_pairs': len(pair_list),
+                   'mean_pair_candles': mean_pair_candles,
+                   'timeframe': constants.timeframe,
+                   'calibrated_at': datetime.now().isoformat(timespec='seconds')}
+    with open(run_profile_path, 'w') as profile_file:
+        json.dump(run_profile, profile_file, indent=4)
+
+    print(f'Wrote the best settings to {run_profile_path}: {best["executor"]}, {best["processes"]} workers, chunksize {best["chunksize"]}, '
+          f'min {best["min_task_candles"]} candles per task ({best["sets_per_second"]:.3f} parameter sets/s)')
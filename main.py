@@ -1,42 +1,101 @@
+import os
+
+import numpy as np
 import pandas as pd
 
-from algo_code.algo import Algo
-from algo_code.run_algo import run_algo
+from algo_code.incremental import IncrementalManifest, run_algo_incremental
+from algo_code.portfolio import PortfolioSimulator
+from algo_code.run_algo import run_algo, run_universe_algo
+from algo_code.trade_records import TradeRecords
+from algo_code.universe_algo import Universe
+from utils.config import get_config
 from utils.general_utils import load_local_data, get_pair_list
-from utils import constants
-from utils.plotting import PlottingTool
+from utils.logger import LoggerSingleton
 
 plot_results = False
 
-all_pairs_exit_positions = []
-pair_counter = 1
-n_pairs = len(get_pair_list(constants.timeframe))
 
-for pair_name in get_pair_list(constants.timeframe):
-    print(f'Processing {pair_counter} / {n_pairs}: {pair_name}')
+def main():
+    config = get_config()
+
+    LoggerSingleton.start_logging(config.log_level, config.log_queue_size)
+
+    all_pairs_trade_records = []
+    pair_counter = 1
+    pair_list = get_pair_list(config.timeframe)
+    n_pairs = len(pair_list)
+    algo = None
+
+    if config.engine == 'universe':
+        print(f'Processing {n_pairs} pairs as a universe')
+
+        universe = Universe({pair_name: load_local_data(pair_name, config.timeframe, start=config.start_time, end=config.end_time,
+                                                        columns=config.load_columns)
+                             for pair_name in pair_list})
+        all_pairs_trade_records = list(run_universe_algo(universe, config)[0].values())
+
+    else:
+        # The results of the previous run for the same report, reused for the pairs whose data and parameters haven't changed
+        manifest = IncrementalManifest(f'./reports/incremental/{config.output_filename}') if config.incremental else None
+
+        for pair_name in pair_list:
+            print(f'Processing {pair_counter} / {n_pairs}: {pair_name}')
+
+            pair_df = load_local_data(pair_name, config.timeframe, start=config.start_time, end=config.end_time,
+                                      columns=config.load_columns).reset_index()
+
+            if manifest is not None:
+                pair_trade_records, algo = run_algo_incremental(pair_name, pair_df, config, manifest)
+            else:
+                pair_trade_records, algo = run_algo(pair_name, pair_df, config)
+            all_pairs_trade_records.append(pair_trade_records)
+
+            pair_counter += 1
+
+        if manifest is not None:
+            manifest.save()
+
+    LoggerSingleton.stop_logging()
+
+    all_positions_df = TradeRecords.to_combined_dataframe(all_pairs_trade_records)
+
+    all_positions_df['Entry time'] = pd.DatetimeIndex(all_positions_df['Entry time']).tz_localize(None)
+    all_positions_df['Exit time'] = pd.DatetimeIndex(all_positions_df['Exit time']).tz_localize(None)
+    all_positions_df['Target hit times'] = all_positions_df['Target hit times'].apply(lambda x: pd.DatetimeIndex(x).tz_localize(None).to_list())
+
+    if config.portfolio:
+        # The trades of all the pairs on a single account, with its equity curve written to ./reports/portfolio/<output name>/equity_curve.csv
+        output_name = os.path.splitext(config.output_filename)[0]
+        simulator = PortfolioSimulator(config.initial_capital, max_capital=config.max_capital, max_positions=config.max_positions)
+        portfolio_summary, taken_masks = simulator.run(all_pairs_trade_records,
+                                                       equity_curve_path=f'./reports/portfolio/{output_name}/equity_curve.csv')
 
-    pair_df = load_local_data(pair_name, constants.timeframe).reset_index()
+        if len(all_positions_df):
+            all_positions_df['Taken by portfolio'] = np.concatenate(taken_masks)
 
-    algo_outputs = run_algo(pair_name, pair_df, constants)
-    pair_exit_positions = algo_outputs[0]
-    algo = algo_outputs[1]
-    all_pairs_exit_positions.extend(pair_exit_positions)
+        print(f'Portfolio: {portfolio_summary["n_taken"]} / {portfolio_summary["n_trades"]} trades taken, final equity '
+              f'{portfolio_summary["final_equity"]:.2f}, max drawdown {portfolio_summary["max_drawdown"]:.2f} '
+              f'({portfolio_summary["max_drawdown_pct"]:.2f}%), at most {portfolio_summary["max_open_positions"]} open positions')
 
-    pair_counter += 1
+    all_positions_df.to_excel(f'./reports/{config.output_filename}')
 
-all_positions_df = pd.DataFrame(all_pairs_exit_positions)
+    # The algo isn't run for a pair whose previous results are reused, so there is nothing to plot
+    if plot_results and config.engine == 'pair' and algo is not None:
+        # Imported here, since lightweight_charts is only needed when plotting
+        from utils.plotting import PlottingTool
 
-all_positions_df['Entry time'] = pd.DatetimeIndex(all_positions_df['Entry time']).tz_localize(None)
-all_positions_df['Exit time'] = pd.DatetimeIndex(all_positions_df['Exit time']).tz_localize(None)
-all_positions_df['Target hit times'] = all_positions_df['Target hit times'].apply(lambda x: pd.DatetimeIndex(x).tz_localize(None).to_list())
+        pt = PlottingTool()
+        pt.draw_candlesticks(algo.pair_df)
+        # pt.register_msb_point_updates(msb_points_df)
+        pt.register_ob_updates(algo.ob_list)
+        pt.draw_zigzag(algo.zigzag_df)
 
-all_positions_df.to_excel(f'./reports/{constants.output_filename}')
+        pt.show()
 
-if __name__ == '__main__' and plot_results:
-    pt = PlottingTool()
-    pt.draw_candlesticks(algo.pair_df)
-    # pt.register_msb_point_updates(msb_points_df)
-    pt.register_ob_updates(algo.ob_list)
-    pt.draw_zigzag(algo.zigzag_df)
 
-    pt.show()
+if __name__ == '__main__':
+    if get_config().startup_profile:
+        from utils.startup_profile import report_startup_profile
+        report_startup_profile('main')
+    else:
+        main()
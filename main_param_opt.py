@@ -1,21 +1,57 @@
 import os
+import pickle
+import sys
 import time
+import numpy as np
 import pandas as pd
-from multiprocessing import Pool
 
-from algo_code.run_algo import run_algo
+from algo_code.run_algo import run_algo, run_universe_algo
+from algo_code.universe_algo import Universe
+from param_opt.bootstrap import calc_bootstrap_fitness
+from param_opt.equivalence import EquivalenceClasses
+from param_opt.distributed import LeaseCoordinator, get_authkey, run_workers
 from param_opt.fitness_function import calc_fitness_parameters
-from param_opt.param_set_generator import parameter_sets
+from param_opt.multi_fidelity import get_resample_ratio, make_coarse_parameter_sets, select_promoted, summarize_screening
+from param_opt.param_set_generator import get_parameter_sets
+from param_opt.verify_engine import verify_engine
+from param_opt.walk_forward import make_windows, process_pair_walk_forward, summarize_walk_forward
 from utils import constants
-from utils.general_utils import get_pair_list, load_local_data, format_time
+from utils.config import apply_run_profile, get_config, set_config
+from utils.logger import LoggerSingleton
+from utils.general_utils import get_executor, get_pair_list, load_local_data, format_time
+from utils.memory_budget import MemoryBudget
+from utils.telemetry import SweepTelemetry, run_measured_task
+
+
+def get_results_path(results_name: str, extension: str = 'csv') -> str:
+    # The path of a results file, with the shard in the file name if only a shard of the parameter space is run
+    shard_suffix = f'_shard{constants.shard[0]}of{constants.shard[1]}' if constants.shard else ''
+    return f'./reports/param_opt/{constants.output_filename}/{results_name}{shard_suffix}.{extension}'
+
+
+def create_telemetry() -> SweepTelemetry | None:
+    # The telemetry of the sweep, if enabled with --telemetry, appending to telemetry.jsonl next to the results
+    if not constants.telemetry_interval:
+        return None
+    return SweepTelemetry(get_results_path('telemetry', extension='jsonl'), constants.telemetry_interval)
+
+
+def calc_fitness(all_pairs_trade_records) -> dict:
+    """
+    Calculates the fitness of a parameter set from the trade records of the pairs, with the bootstrap statistics if --bootstrap is given.
+    """
+    fitness_dict = calc_fitness_parameters(all_pairs_trade_records)
+    if constants.bootstrap_samples:
+        fitness_dict.update(calc_bootstrap_fitness(all_pairs_trade_records, constants.bootstrap_samples, constants.initial_capital))
+    return fitness_dict
 
 
 def process_pair(pair_name, params, pair_data):
     """
     Helper function to process a single pair with the given parameters.
     """
-    pair_positions = run_algo(pair_name, pair_data, params)[0]
-    return pair_positions
+    pair_trade_records = run_algo(pair_name, pair_data, params)[0]
+    return pair_trade_records
 
 
 def single_threaded_version(pair_list, all_pairs_data):
@@ -23,17 +59,20 @@ def single_threaded_version(pair_list, all_pairs_data):
     Single-threaded version of the parameter optimization code.
     """
     start_time = time.time()
+    parameter_sets = get_parameter_sets()
     results = []
 
     print("Running single-threaded version...")
-    for params, permutation_params_dict in parameter_sets:
-        all_pairs_exit_positions = []
+    equivalence_classes = EquivalenceClasses(parameter_sets)
+    print(equivalence_classes.report())
+
+    for params, permutation_params_dict in equivalence_classes:
+        all_pairs_trade_records = []
         for pair_name in pair_list:
-            pair_positions = process_pair(pair_name, params, all_pairs_data[pair_name])
-            all_pairs_exit_positions.extend(pair_positions)
+            pair_trade_records = process_pair(pair_name, params, all_pairs_data[pair_name])
+            all_pairs_trade_records.append(pair_trade_records)
 
-        all_positions_df = pd.DataFrame(all_pairs_exit_positions)
-        fitness_dict = calc_fitness_parameters(all_positions_df)
+        fitness_dict = calc_fitness(all_pairs_trade_records)
         result_row = {**permutation_params_dict, **fitness_dict}
 
         print(result_row)
@@ -41,70 +80,514 @@ def single_threaded_version(pair_list, all_pairs_data):
 
         results.append(result_row)
 
-    # Convert the list of dictionaries to a DataFrame and write to CSV
-    results_df = pd.DataFrame(results)
+    # Convert the list of dictionaries to a DataFrame and write to CSV, with a row for every member of each equivalence class
+    results_df = pd.DataFrame(equivalence_classes.fan_out(results))
     if not os.path.exists(f'./reports/param_opt/{constants.output_filename}'):
         os.mkdir(f'./reports/param_opt/{constants.output_filename}')
-    results_df.to_csv(f'./reports/param_opt/{constants.output_filename}/results_single_threaded.csv', index=False)
+    results_df.to_csv(get_results_path('results_single_threaded'), index=False)
 
     elapsed_time = time.time() - start_time
     print(f"Single-threaded execution time: {format_time(elapsed_time)}")
 
 
+def create_memory_budget(initializer=None, initargs: tuple = ()) -> MemoryBudget | None:
+    # The memory budget of the sweep, if enabled with --memory_budget, which creates its executors with the given worker initializer
+    if not constants.memory_budget_mb:
+        return None
+    return MemoryBudget(constants.memory_budget_mb, constants.max_processes,
+                        lambda n_workers: get_executor(n_workers, constants.executor_type, initializer=initializer, initargs=initargs),
+                        shared_process=constants.executor_type == 'threads')
+
+
+def process_pair_batch(pair_names, params, pair_datas):
+    """
+    Helper function to process a batch of pairs with the given parameters in a single task.
+    """
+    return [process_pair(pair_name, params, pair_data) for pair_name, pair_data in zip(pair_names, pair_datas)]
+
+
+def make_pair_batches(pair_list, all_pairs_data, min_task_candles: int) -> list[list[str]]:
+    """
+    Groups consecutive pairs into batches of at least min_task_candles candles, so the small pairs don't cost a task (and a round trip to a worker)
+    each. A pair with at least min_task_candles candles is a batch of its own, and every pair is a batch of its own if min_task_candles is 0.
+    """
+    pair_batches = []
+    batch, batch_candles = [], 0
+    for pair_name in pair_list:
+        batch.append(pair_name)
+        batch_candles += len(all_pairs_data[pair_name])
+        if batch_candles >= min_task_candles:
+            pair_batches.append(batch)
+            batch, batch_candles = [], 0
+
+    if batch:
+        pair_batches.append(batch)
+
+    return pair_batches
+
+
+def map_pairs(executor, params, pair_list, all_pairs_data, telemetry: SweepTelemetry | None = None, pair_data_bytes: dict | None = None,
+              memory_budget: MemoryBudget | None = None):
+    """
+    Processes the pairs with the given parameters in parallel, and returns their trade records in the order of pair_list. The pairs are batched
+    into tasks by make_pair_batches, which are sent to the workers constants.task_chunksize at a time. With telemetry or a memory budget, the tasks
+    are measured by the workers and reported as they finish, and with a memory budget (which is then the executor), only as many tasks are handed
+    out at once as the budget allows.
+    """
+    pair_batches = make_pair_batches(pair_list, all_pairs_data, constants.min_task_candles)
+    batch_datas = [[all_pairs_data[pair_name] for pair_name in pair_batch] for pair_batch in pair_batches]
+    n_tasks = len(pair_batches)
+
+    if telemetry is None and memory_budget is None:
+        batch_results = executor.map(process_pair_batch, pair_batches, [params] * n_tasks, batch_datas, chunksize=constants.task_chunksize)
+        return [pair_trade_records for batch_result in batch_results for pair_trade_records in batch_result]
+
+    # The pair data and parameters are only pickled when sent to worker processes
+    measure_bytes = pair_data_bytes is not None
+    if telemetry is not None:
+        sent_bytes = sum(pair_data_bytes[pair_name] for pair_name in pair_list) + len(pickle.dumps(params)) * n_tasks if measure_bytes else 0
+        telemetry.submit_tasks(n_tasks, sent_bytes)
+
+    task_arguments = ([measure_bytes] * n_tasks, [process_pair_batch] * n_tasks, pair_batches, [params] * n_tasks, batch_datas)
+    if memory_budget is not None:
+        task_results = memory_budget.map(run_measured_task, *task_arguments)
+    else:
+        task_results = executor.map(run_measured_task, *task_arguments, chunksize=constants.task_chunksize)
+
+    all_pairs_trade_records = []
+    for batch_data, (batch_result, task_stats) in zip(batch_datas, task_results):
+        if telemetry is not None:
+            telemetry.finish_task(task_stats, sum(len(pair_data) for pair_data in batch_data))
+        all_pairs_trade_records.extend(batch_result)
+
+    return all_pairs_trade_records
+
+
 def multiprocessing_version(pair_list, all_pairs_data):
     """
     Multiprocessing version of the parameter optimization code.
     """
     start_time = time.time()
+    parameter_sets = get_parameter_sets()
     results = []
 
     print("Running multiprocessing version...")
-    total_parameter_sets = len(parameter_sets)  # Total number of parameter sets to process
-    print(f'Parameter space size: {total_parameter_sets}')
-
-    for i, (params, permutation_params_dict) in enumerate(parameter_sets, 1):
-        all_pairs_exit_positions = []
-        with Pool(processes=constants.max_processes) as pool:
-            backtest_results = pool.starmap(process_pair, [(pair_name, params, all_pairs_data[pair_name]) for pair_name in pair_list])
-            for result in backtest_results:
-                all_pairs_exit_positions.extend(result)
-
-        all_positions_df = pd.DataFrame.from_dict(all_pairs_exit_positions)
-        fitness_dict = calc_fitness_parameters(all_positions_df)
-        result_row = {**permutation_params_dict, **fitness_dict}
+    print(f'Parameter space size: {len(parameter_sets)}')
 
-        print(result_row)
-        print()
+    # The execution settings of the run profile are measured by calibrate.py on this version, and only apply to it
+    mean_pair_candles = sum(len(all_pairs_data[pair_name]) for pair_name in pair_list) / len(pair_list) if pair_list else 0
+    set_config(apply_run_profile(get_config(), len(pair_list), mean_pair_candles))
+
+    # Only one parameter set of each equivalence class is processed
+    equivalence_classes = EquivalenceClasses(parameter_sets)
+    print(equivalence_classes.report())
+    total_parameter_sets = len(equivalence_classes)  # Total number of parameter sets to process
+
+    if not os.path.exists(f'./reports/param_opt/{constants.output_filename}'):
+        os.mkdir(f'./reports/param_opt/{constants.output_filename}')
+
+    # The size of the pickled data of each pair, measured once for the IPC statistics of the telemetry
+    telemetry = create_telemetry()
+    pair_data_bytes = None
+    if telemetry is not None:
+        if constants.executor_type == 'processes':
+            pair_data_bytes = {pair_name: len(pickle.dumps(all_pairs_data[pair_name])) for pair_name in pair_list}
+        telemetry.start()
+    console_print = telemetry.print if telemetry is not None else print
+
+    # The pairs of each parameter set are processed in parallel by the same executor. Under a memory budget, the budget is the executor, and resizes
+    # its workers to the memory used.
+    memory_budget = create_memory_budget()
+    executor = memory_budget if memory_budget is not None else get_executor(constants.max_processes, constants.executor_type)
+    with executor:
+        for i, (params, permutation_params_dict) in enumerate(equivalence_classes, 1):
+            all_pairs_trade_records = map_pairs(executor, params, pair_list, all_pairs_data, telemetry, pair_data_bytes, memory_budget)
+
+            fitness_dict = calc_fitness(all_pairs_trade_records)
+            result_row = {**permutation_params_dict, **fitness_dict}
+
+            # With telemetry, the result of each parameter set is only written to the results, since printing it would break up the status line
+            if telemetry is None:
+                print(result_row)
+                print()
+
+            results.append(result_row)
+
+            # Display progress every 10 parameter sets
+            if i % 10 == 0 or i == total_parameter_sets:
+                elapsed_time = time.time() - start_time
+                time_per_set = elapsed_time / i
+                remaining_sets = total_parameter_sets - i
+                estimated_time_remaining = time_per_set * remaining_sets
+
+                console_print(f"Processed {i}/{total_parameter_sets} parameter sets.")
+                console_print(f"Elapsed time: {format_time(elapsed_time)}.")
+                console_print(f"Estimated time remaining: {format_time(estimated_time_remaining)}.")
+                console_print()
+
+    if telemetry is not None:
+        telemetry.stop()
+
+    # Convert the list of dictionaries to a DataFrame and write to CSV, with a row for every member of each equivalence class
+    results_df = pd.DataFrame(equivalence_classes.fan_out(results))
+    results_df.to_csv(get_results_path('results_multiprocessing'), index=False)
+
+    elapsed_time = time.time() - start_time
+    print(f"Multiprocessing execution time: {format_time(elapsed_time)}")
+
+
+# The universe of the worker processes of universe_version, set once per worker by the pool initializer
+worker_universe: Universe | None = None
+
+
+def init_universe_worker(universe: Universe):
+    global worker_universe
+    worker_universe = universe
+
+
+def process_universe(parameter_set):
+    """
+    Helper function to process the whole universe of pairs with the given parameters, in a single run of the algo.
+    """
+    params, permutation_params_dict = parameter_set
+    all_pairs_trade_records = run_universe_algo(worker_universe, params)[0]
+    return {**permutation_params_dict, **calc_fitness(list(all_pairs_trade_records.values()))}
+
+
+def universe_version(pair_list, all_pairs_data):
+    """
+    Universe version of the parameter optimization code. All the pairs are concatenated once into a universe, which is sent to each worker process
+    once, and each parameter set is processed over the whole universe in a single run of the algo. The parameter sets are distributed between the
+    processes.
+    """
+    start_time = time.time()
+    parameter_sets = get_parameter_sets()
+    results = []
+
+    print("Running universe version...")
+    print(f'Parameter space size: {len(parameter_sets)}')
+
+    # Only one parameter set of each equivalence class is processed
+    equivalence_classes = EquivalenceClasses(parameter_sets)
+    print(equivalence_classes.report())
+    total_parameter_sets = len(equivalence_classes)  # Total number of parameter sets to process
+
+    universe = Universe({pair_name: all_pairs_data[pair_name] for pair_name in pair_list})
+
+    if not os.path.exists(f'./reports/param_opt/{constants.output_filename}'):
+        os.mkdir(f'./reports/param_opt/{constants.output_filename}')
+
+    # The universe is sent once to each worker process by the initializer, and is counted once per worker in the IPC statistics of the telemetry.
+    # The parameter sets sent with the tasks are negligible next to it.
+    telemetry = create_telemetry()
+    measure_bytes = telemetry is not None and constants.executor_type == 'processes'
+    if telemetry is not None:
+        telemetry.start()
+        telemetry.submit_tasks(total_parameter_sets, len(pickle.dumps(universe)) * constants.max_processes if measure_bytes else 0)
+    console_print = telemetry.print if telemetry is not None else print
+
+    memory_budget = create_memory_budget(initializer=init_universe_worker, initargs=(universe,))
+    measured = telemetry is not None or memory_budget is not None
+
+    executor = memory_budget if memory_budget is not None else get_executor(constants.max_processes, constants.executor_type,
+                                                                             initializer=init_universe_worker, initargs=(universe,))
+    with executor:
+        if not measured:
+            result_rows = executor.map(process_universe, equivalence_classes)
+        else:
+            task_arguments = ([measure_bytes] * total_parameter_sets, [process_universe] * total_parameter_sets, equivalence_classes)
+            if memory_budget is not None:
+                result_rows = memory_budget.map(run_measured_task, *task_arguments)
+            else:
+                result_rows = executor.map(run_measured_task, *task_arguments)
+
+        for i, result_row in enumerate(result_rows, 1):
+            if measured:
+                result_row, task_stats = result_row
+                if telemetry is not None:
+                    telemetry.finish_task(task_stats, len(universe.pair_df))
+
+            # With telemetry, the result of each parameter set is only written to the results, since printing it would break up the status line
+            if telemetry is None:
+                print(result_row)
+                print()
+
+            results.append(result_row)
+
+            # Display progress every 10 parameter sets
+            if i % 10 == 0 or i == total_parameter_sets:
+                elapsed_time = time.time() - start_time
+                estimated_time_remaining = elapsed_time / i * (total_parameter_sets - i)
+
+                console_print(f"Processed {i}/{total_parameter_sets} parameter sets.")
+                console_print(f"Elapsed time: {format_time(elapsed_time)}.")
+                console_print(f"Estimated time remaining: {format_time(estimated_time_remaining)}.")
+                console_print()
+
+    if telemetry is not None:
+        telemetry.stop()
+
+    results_df = pd.DataFrame(equivalence_classes.fan_out(results))
+    results_df.to_csv(get_results_path('results_universe'), index=False)
+
+    elapsed_time = time.time() - start_time
+    print(f"Universe execution time: {format_time(elapsed_time)}")
 
-        results.append(result_row)
 
-        # Display progress every 10 parameter sets
-        if i % 10 == 0 or i == total_parameter_sets:
+def process_pair_windows(pair_name, pair_data, evaluated_parameter_sets, windows):
+    """
+    Helper function to process a single pair with all the given parameter sets, split between the walk-forward windows.
+    """
+    return process_pair_walk_forward(pair_name, pair_data, evaluated_parameter_sets, windows)
+
+
+def walk_forward_version(pair_list, all_pairs_data):
+    """
+    Walk-forward version of the parameter optimization code. Each pair is processed with all the parameter sets over its full history by a single
+    worker process, and the detection of each pair is only computed once per detection parameters. The trades are then assigned to the rolling
+    train/test windows by their entry, the best parameter set of each window is selected on its train period and scored on its test period.
+    """
+    start_time = time.time()
+    parameter_sets = get_parameter_sets()
+
+    print("Running walk-forward version...")
+    print(f'Parameter space size: {len(parameter_sets)}')
+
+    # Only one parameter set of each equivalence class is processed
+    equivalence_classes = EquivalenceClasses(parameter_sets)
+    print(equivalence_classes.report())
+
+    first_time = min(all_pairs_data[pair_name].time.iloc[0] for pair_name in pair_list)
+    last_time = max(all_pairs_data[pair_name].time.iloc[-1] for pair_name in pair_list)
+    windows = make_windows(first_time, last_time, *constants.walk_forward_days)
+    print(f'Number of walk-forward windows: {len(windows)}')
+
+    all_stats = None
+    with get_executor(constants.max_processes, constants.executor_type) as executor:
+        for pair_stats in executor.map(process_pair_windows,
+                                       pair_list,
+                                       [all_pairs_data[pair_name] for pair_name in pair_list],
+                                       [equivalence_classes] * len(pair_list),
+                                       [windows] * len(pair_list)):
+            all_stats = pair_stats if all_stats is None else all_stats + pair_stats
+
+    # The statistics of each class are fanned out to all its members before selecting the best parameter sets
+    scores_df, summary_df = summarize_walk_forward(all_stats[equivalence_classes.class_indices], parameter_sets, windows)
+    print(summary_df)
+    print()
+
+    if not os.path.exists(f'./reports/param_opt/{constants.output_filename}'):
+        os.mkdir(f'./reports/param_opt/{constants.output_filename}')
+    scores_df.to_csv(get_results_path('results_walk_forward_scores'), index=False)
+    summary_df.to_csv(get_results_path('results_walk_forward'), index=False)
+
+    elapsed_time = time.time() - start_time
+    print(f"Walk-forward execution time: {format_time(elapsed_time)}")
+
+
+def evaluate_parameter_sets(executor, parameter_sets, pair_list, all_pairs_data, stage_name: str) -> list[dict]:
+    """
+    Runs the given parameter sets over the pairs, each equivalence class once, and returns the fitness of every parameter set in order.
+    """
+    equivalence_classes = EquivalenceClasses(parameter_sets)
+    print(equivalence_classes.report())
+
+    class_results = []
+    for i, (params, _) in enumerate(equivalence_classes, 1):
+        class_results.append(calc_fitness(map_pairs(executor, params, pair_list, all_pairs_data)))
+        if i % 10 == 0 or i == len(equivalence_classes):
+            print(f"{stage_name}: processed {i}/{len(equivalence_classes)} parameter sets.")
+
+    return [class_results[class_index] for class_index in equivalence_classes.class_indices]
+
+
+def screening_version(pair_list, all_pairs_data):
+    """
+    Multi-fidelity version of the parameter optimization code. Every parameter set is first scored on the coarser timeframe given with --screen,
+    derived from the cached candles, with its window sizes scaled by the resample ratio, which is cheaper by about the ratio. Only the best
+    fraction of the parameter sets is then run at full resolution. The report holds the coarse and full resolution fitness of every parameter set,
+    and the rank correlation between them is printed to tune the fraction and the timeframe by.
+    """
+    start_time = time.time()
+    parameter_sets = get_parameter_sets()
+    coarse_timeframe, promote_fraction = constants.screen_timeframe, constants.screen_fraction
+    ratio = get_resample_ratio(constants.timeframe, coarse_timeframe)
+
+    print(f"Running screening version on {coarse_timeframe}, promoting the best {promote_fraction * 100:g}% to {constants.timeframe}...")
+    print(f'Parameter space size: {len(parameter_sets)}')
+
+    coarse_pairs_data = {pair_name: load_local_data(pair_name, coarse_timeframe, start=constants.start_time, end=constants.end_time,
+                                                    columns=constants.load_columns)
+                         for pair_name in pair_list}
+
+    with get_executor(constants.max_processes, constants.executor_type) as executor:
+        coarse_start_time = time.time()
+        coarse_results = evaluate_parameter_sets(executor, make_coarse_parameter_sets(parameter_sets, coarse_timeframe, ratio), pair_list,
+                                                 coarse_pairs_data, 'Screening')
+        coarse_time = time.time() - coarse_start_time
+
+        promoted_indices = select_promoted(np.array([result['net_profit'] for result in coarse_results]), promote_fraction)
+
+        fine_start_time = time.time()
+        fine_results = evaluate_parameter_sets(executor, [parameter_sets[int(set_index)] for set_index in promoted_indices], pair_list,
+                                               all_pairs_data, 'Full resolution')
+        fine_time = time.time() - fine_start_time
+
+    report_df, summary = summarize_screening(parameter_sets, coarse_results, dict(zip(promoted_indices.tolist(), fine_results)))
+    print(f"Promoted {summary['n_promoted']}/{summary['n_parameter_sets']} parameter sets. Screening time: {format_time(coarse_time)}, "
+          f"full resolution time: {format_time(fine_time)}.")
+    print(f"Spearman rank correlation between the coarse and full resolution net profits of the promoted sets: {summary['rank_correlation']:.3f}, "
+          f"overlap of their top 10%: {summary['top_overlap'] * 100:.0f}%.")
+
+    if not os.path.exists(f'./reports/param_opt/{constants.output_filename}'):
+        os.mkdir(f'./reports/param_opt/{constants.output_filename}')
+    report_df.to_csv(get_results_path('results_screening'), index=False)
+
+    elapsed_time = time.time() - start_time
+    print(f"Screening execution time: {format_time(elapsed_time)}")
+
+
+def verify_engine_version(pair_list, all_pairs_data):
+    """
+    Engine verification version of the parameter optimization code. Runs the reference engine and the fast engine given with --verify_engine on
+    every parameter set, one after the other in this process, and reports for every pair whether their zigzag, MSB points, order blocks and trades
+    are the same, along with the speedup of the fast engine.
+    """
+    start_time = time.time()
+    parameter_sets = get_parameter_sets()
+
+    print(f"Verifying the {constants.verify_engine} engine against the reference engine...")
+    print(f'Parameter space size: {len(parameter_sets)}')
+
+    report_df = verify_engine(constants.verify_engine, pair_list, all_pairs_data, parameter_sets)
+
+    n_diverging = int((~report_df['equal']).sum()) if len(report_df) else 0
+    print(f'{n_diverging} / {len(report_df)} pair runs diverging, median speedup {report_df["speedup"].median():.2f}x')
+
+    if not os.path.exists(f'./reports/param_opt/{constants.output_filename}'):
+        os.mkdir(f'./reports/param_opt/{constants.output_filename}')
+    report_df.to_csv(get_results_path(f'verify_engine_{constants.verify_engine}'), index=False)
+
+    elapsed_time = time.time() - start_time
+    print(f"Engine verification execution time: {format_time(elapsed_time)}")
+
+
+def coordinator_version(pair_list):
+    """
+    Coordinator of the distributed version of the parameter optimization code. The (parameter set, pair batch) tasks are handed out as leases to
+    the worker processes connecting to constants.coordinator_address, which may run on any number of machines, and the fitness of each parameter
+    set is calculated once the results of all its pair batches are collected. The coordinator doesn't load any data itself.
+    """
+    start_time = time.time()
+    parameter_sets = get_parameter_sets()
+
+    print(f"Running distributed version, coordinating the workers on {constants.coordinator_address}...")
+    print(f'Parameter space size: {len(parameter_sets)}')
+
+    # Only one parameter set of each equivalence class is handed out
+    equivalence_classes = EquivalenceClasses(parameter_sets)
+    print(equivalence_classes.report())
+    total_parameter_sets = len(equivalence_classes)  # Total number of parameter sets to process
+
+    load_kwargs = {'timeframe': constants.timeframe, 'start': constants.start_time, 'end': constants.end_time, 'columns': constants.load_columns}
+    coordinator = LeaseCoordinator(equivalence_classes, pair_list, constants.pair_batch_size, constants.lease_timeout, load_kwargs,
+                                   constants.max_task_failures)
+
+    def print_progress(set_index, fitness_dict):
+        print({**equivalence_classes[set_index][1], **fitness_dict})
+        print()
+
+        n_finished = len(coordinator.fitness_results)
+        if n_finished % 10 == 0 or n_finished == total_parameter_sets:
             elapsed_time = time.time() - start_time
-            time_per_set = elapsed_time / i
-            remaining_sets = total_parameter_sets - i
-            estimated_time_remaining = time_per_set * remaining_sets
+            estimated_time_remaining = elapsed_time / n_finished * (total_parameter_sets - n_finished)
 
-            print(f"Processed {i}/{total_parameter_sets} parameter sets.")
+            print(f"Processed {n_finished}/{total_parameter_sets} parameter sets.")
             print(f"Elapsed time: {format_time(elapsed_time)}.")
             print(f"Estimated time remaining: {format_time(estimated_time_remaining)}.")
             print()
 
-    # Convert the list of dictionaries to a DataFrame and write to CSV
+    def print_failure(set_index, error):
+        print(f'Parameter set {equivalence_classes[set_index][1]} failed {constants.max_task_failures} times, the last time with:')
+        print(error)
+
+    coordinator.on_parameter_set_finished = print_progress
+    coordinator.on_parameter_set_failed = print_failure
+    coordinator.serve(constants.coordinator_address, get_authkey(constants.coordinator_address, constants.authkey))
 
-    results_df = pd.DataFrame(results)
+    # The results are written in the order of the parameter sets, regardless of the order they were finished in, with a row for every member of
+    # each equivalence class. The rows of the failed parameter sets only hold the last line of their error.
+    results_df = pd.DataFrame(equivalence_classes.fan_out([coordinator.fitness_results[class_index] if class_index in coordinator.fitness_results
+                                                           else {'error': coordinator.failed_sets[class_index].strip().splitlines()[-1]}
+                                                           for class_index in range(total_parameter_sets)]))
     if not os.path.exists(f'./reports/param_opt/{constants.output_filename}'):
         os.mkdir(f'./reports/param_opt/{constants.output_filename}')
-    results_df.to_csv(f'./reports/param_opt/{constants.output_filename}/results_multiprocessing.csv', index=False)
+    results_df.to_csv(get_results_path('results_distributed'), index=False)
 
     elapsed_time = time.time() - start_time
-    print(f"Multiprocessing execution time: {format_time(elapsed_time)}")
+    print(f"Distributed execution time: {format_time(elapsed_time)}")
+
+    if coordinator.failed_sets:
+        print(f'{len(coordinator.failed_sets)}/{total_parameter_sets} parameter sets failed.')
+        return 1
+
+
+def worker_version():
+    """
+    Worker of the distributed version of the parameter optimization code. Runs constants.max_processes worker processes, which process the tasks
+    of the coordinator on constants.coordinator_address using the local cached data, until all the tasks are finished.
+    """
+    start_time = time.time()
+
+    print(f"Running {constants.max_processes} workers for the coordinator on {constants.coordinator_address}...")
+    failed_exit_codes = run_workers(constants.coordinator_address, get_authkey(constants.coordinator_address, constants.authkey),
+                                    constants.max_processes, LoggerSingleton.get_process_config())
+
+    elapsed_time = time.time() - start_time
+    print(f"Worker execution time: {format_time(elapsed_time)}")
+
+    if failed_exit_codes:
+        print(f'{len(failed_exit_codes)}/{constants.max_processes} worker processes failed, with the exit codes {failed_exit_codes}.')
+        return 1
+
+
+def main() -> int | None:
+    # Returns the exit status of the run: 1 if any task of the distributed version failed
+    LoggerSingleton.start_logging(constants.log_level, constants.log_queue_size)
+
+    # The workers load their own data from the local cache, and the coordinator needs nothing but the pair list
+    exit_status = None
+    if constants.role == 'worker':
+        exit_status = worker_version()
+    elif constants.role == 'coordinator':
+        exit_status = coordinator_version(get_pair_list(constants.timeframe))
+    else:
+        pair_list = get_pair_list(constants.timeframe)
+        all_pairs_data = {pair: load_local_data(pair, constants.timeframe, start=constants.start_time, end=constants.end_time,
+                                                columns=constants.load_columns)
+                          for pair in pair_list}
+
+        # single_threaded_version(pair_list, all_pairs_data)
+        if constants.verify_engine:
+            verify_engine_version(pair_list, all_pairs_data)
+        elif constants.screen_timeframe:
+            screening_version(pair_list, all_pairs_data)
+        elif constants.walk_forward_days:
+            walk_forward_version(pair_list, all_pairs_data)
+        elif constants.engine == 'universe':
+            universe_version(pair_list, all_pairs_data)
+        else:
+            multiprocessing_version(pair_list, all_pairs_data)
+
+    LoggerSingleton.stop_logging()
+
+    return exit_status
 
 
 # Run both versions and compare their execution times
 if __name__ == "__main__":
-    pair_list = get_pair_list(constants.timeframe)
-    all_pairs_data = {pair: load_local_data(pair, constants.timeframe) for pair in pair_list}
-
-    # single_threaded_version(pair_list, all_pairs_data)
-    multiprocessing_version(pair_list, all_pairs_data)
+    if constants.startup_profile:
+        from utils.startup_profile import report_startup_profile
+        report_startup_profile('main_param_opt')
+    else:
+        sys.exit(main())
@@ -0,0 +1,134 @@
+import numpy as np
+
+from algo_code.trade_records import TradeRecords
+
+# The largest number of values in the matrix of resampled trades processed at once, which bounds the memory used by the bootstrap (8 MB of
+# float64 values) regardless of the number of trades and samples. Larger chunks are slower, since their matrices no longer fit in the CPU caches.
+max_chunk_elements = 2 ** 20
+
+
+def iter_chunk_sizes(n_samples: int, n_values: int):
+    # The number of samples of each chunk, so that each chunk holds at most max_chunk_elements values
+    chunk_size = max(1, max_chunk_elements // max(n_values, 1))
+    for chunk_start in range(0, n_samples, chunk_size):
+        yield min(chunk_size, n_samples - chunk_start)
+
+
+def calc_max_drawdowns(net_profit_paths: np.ndarray) -> np.ndarray:
+    # The largest drop of the cumulative net profit from its running peak along each row, counting the starting point as a peak
+    cumulative_profits = np.cumsum(net_profit_paths, axis=1)
+    running_peaks = np.maximum(np.maximum.accumulate(cumulative_profits, axis=1), 0)
+    return (running_peaks - cumulative_profits).max(axis=1, initial=0)
+
+
+def bootstrap_trades(net_profits: np.ndarray, n_samples: int, initial_capital: float, ruin_fraction: float,
+                     rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Resamples the trades with replacement: each sample is a sequence of as many trades as the original, drawn at random from them.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The net profit, the winrate and whether the account was ruined, i.e. its equity fell to
+        initial_capital * (1 - ruin_fraction) or lower at any point, of each sample
+    """
+    n_trades = len(net_profits)
+    sample_net_profits, sample_winrates, sample_ruined = [], [], []
+
+    for chunk_size in iter_chunk_sizes(n_samples, n_trades):
+        sampled_paths = net_profits[rng.integers(0, n_trades, size=(chunk_size, n_trades))]
+        cumulative_profits = np.cumsum(sampled_paths, axis=1)
+
+        sample_net_profits.append(cumulative_profits[:, -1])
+        sample_winrates.append((sampled_paths > 0).mean(axis=1) * 100)
+        sample_ruined.append(cumulative_profits.min(axis=1) <= -initial_capital * ruin_fraction)
+
+    return np.concatenate(sample_net_profits), np.concatenate(sample_winrates), np.concatenate(sample_ruined)
+
+
+def shuffle_trades(net_profits: np.ndarray, n_samples: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Shuffles the order of the trades: the net profit of each sample is the same as the original, but the drawdown depends on the order the wins
+    and losses come in.
+
+    Returns:
+        np.ndarray: The max drawdown of each sample
+    """
+    sample_max_drawdowns = []
+
+    for chunk_size in iter_chunk_sizes(n_samples, len(net_profits)):
+        shuffled_paths = np.tile(net_profits, (chunk_size, 1))
+        rng.permuted(shuffled_paths, axis=1, out=shuffled_paths)
+        sample_max_drawdowns.append(calc_max_drawdowns(shuffled_paths))
+
+    return np.concatenate(sample_max_drawdowns)
+
+
+def bootstrap_pairs(pair_net_profits: np.ndarray, n_samples: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Resamples the pairs with replacement, each pair with all its trades as one block, which keeps the correlation between the trades of the same
+    pair and shows how much the results depend on a few pairs.
+
+    Args:
+        pair_net_profits (np.ndarray): The summed net profit of the trades of each pair
+
+    Returns:
+        np.ndarray: The net profit of each sample
+    """
+    n_pairs = len(pair_net_profits)
+    sample_net_profits = []
+
+    for chunk_size in iter_chunk_sizes(n_samples, n_pairs):
+        sample_net_profits.append(pair_net_profits[rng.integers(0, n_pairs, size=(chunk_size, n_pairs))].sum(axis=1))
+
+    return np.concatenate(sample_net_profits)
+
+
+def calc_bootstrap_fitness(trade_records_list: list[TradeRecords], n_samples: int, initial_capital: float, ruin_fraction: float = 0.5,
+                           seed: int = 0) -> dict:
+    """
+    Calculates the robustness statistics of a parameter set from Monte Carlo resamples of its trades, added to its fitness values. Each kind of
+    resample is computed for a chunk of samples at a time as a matrix operation, with one sample per row.
+
+    The random generator is seeded with the same seed for every parameter set, so the differences between the statistics of two parameter sets
+    come from their trades and not from the random draws, and the results are reproducible.
+
+    Args:
+        trade_records_list (list[TradeRecords]): The trade records of the pairs
+        n_samples (int): The number of samples of each kind of resample
+        initial_capital (float): The capital of the account the ruin probability is calculated for
+        ruin_fraction (float): The fraction of the initial capital the account is ruined at when it's lost
+        seed (int): The seed of the random generator
+
+    Returns:
+        dict: The 5th, 50th and 95th percentiles of the net profit and winrate of the trade resamples and of the net profit of the pair resamples,
+        the 50th and 95th percentiles of the max drawdown of the trade shuffles, and the ruin probability in percent
+    """
+    rng = np.random.default_rng(seed)
+
+    pair_net_profits = [trade_records.net_profits() for trade_records in trade_records_list]
+    net_profits = np.concatenate(pair_net_profits) if pair_net_profits else np.array([])
+    if len(net_profits) == 0:
+        return {}
+
+    sample_net_profits, sample_winrates, sample_ruined = bootstrap_trades(net_profits, n_samples, initial_capital, ruin_fraction, rng)
+    sample_max_drawdowns = shuffle_trades(net_profits, n_samples, rng)
+    sample_pair_net_profits = bootstrap_pairs(np.array([pair_profits.sum() for pair_profits in pair_net_profits]), n_samples, rng)
+
+    net_profit_percentiles = np.percentile(sample_net_profits, [5, 50, 95])
+    winrate_percentiles = np.percentile(sample_winrates, [5, 50, 95])
+    pair_net_profit_percentiles = np.percentile(sample_pair_net_profits, [5, 50, 95])
+    max_drawdown_percentiles = np.percentile(sample_max_drawdowns, [50, 95])
+
+    return {
+        'net_profit_p5': float(net_profit_percentiles[0]),
+        'net_profit_p50': float(net_profit_percentiles[1]),
+        'net_profit_p95': float(net_profit_percentiles[2]),
+        'winrate_p5': float(winrate_percentiles[0]),
+        'winrate_p50': float(winrate_percentiles[1]),
+        'winrate_p95': float(winrate_percentiles[2]),
+        'pair_net_profit_p5': float(pair_net_profit_percentiles[0]),
+        'pair_net_profit_p50': float(pair_net_profit_percentiles[1]),
+        'pair_net_profit_p95': float(pair_net_profit_percentiles[2]),
+        'max_drawdown_p50': float(max_drawdown_percentiles[0]),
+        'max_drawdown_p95': float(max_drawdown_percentiles[1]),
+        'ruin_probability': float(sample_ruined.mean() * 100),
+    }
@@ -0,0 +1,315 @@
+import collections
+import ipaddress
+import socket
+import sys
+import threading
+import time
+import traceback
+from multiprocessing import AuthenticationError, Process
+from multiprocessing.connection import Client, Connection, Listener
+
+import numpy as np
+
+from algo_code.run_algo import run_algo
+from param_opt.fitness_function import calc_fitness_from_net_profits
+from utils.config import Config, get_config, set_config
+from utils.general_utils import load_local_data
+from utils.logger import LoggerSingleton
+
+# The messages of the protocol between the coordinator and the workers are tuples starting with the message type:
+#   worker -> coordinator: ('request',) asks for a task, ('result', lease_id, net_profits) returns the result of a task, and
+#   ('error', lease_id, traceback) reports that processing the task raised an exception
+#   coordinator -> worker: ('task', lease_id, params, pair_names, load_kwargs) hands out a task, ('wait', seconds) asks the worker to request again
+#   later, since all the remaining tasks are leased to other workers, and ('done',) tells the worker that all the tasks are complete.
+
+
+# The key the coordinator and the workers authenticate with when no --authkey is given, only allowed on loopback addresses
+default_authkey = b'st2-backtest'
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def is_loopback_address(address: str) -> bool:
+    # Whether the host of the address resolves to a loopback address. An empty host (all the interfaces) or one which doesn't resolve isn't.
+    host, _ = parse_address(address)
+    try:
+        return bool(host) and ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def get_authkey(address: str, authkey: bytes | None) -> bytes:
+    """
+    Returns the key to authenticate with on the given coordinator address. The connections exchange pickled messages, so anyone able to
+    authenticate can run code on the coordinator and the workers: the default key is only used on loopback addresses, and a key has to be given
+    for any other address.
+    """
+    if authkey:
+        return authkey
+    if not is_loopback_address(address):
+        raise ValueError(f'An --authkey is required with the non-loopback coordinator address {address}, since anyone who can reach the '
+                         f'coordinator with the default key could run code on it')
+    return default_authkey
+
+
+class LeaseCoordinator:
+    """
+    Hands out the tasks of a parameter optimization run to the workers and collects their results. Each task is a (parameter set, pair batch) pair,
+    and is handed out as a lease which expires after lease_timeout seconds. Expired leases are reissued to the next worker asking for a task, so
+    the tasks of a worker which crashed or lost its connection are eventually processed by another one. If both the original and the reissued lease
+    return a result, only the first one is used.
+
+    A task whose processing raised an exception or whose lease expired is handed out again, until it has failed max_task_failures times. Its
+    parameter set is then marked as failed, with the last traceback in failed_sets, and its other tasks aren't handed out anymore.
+    """
+
+    def __init__(self, parameter_sets: list, pair_list: list[str], pair_batch_size: int, lease_timeout: float, load_kwargs: dict,
+                 max_task_failures: int = 3):
+        self.parameter_sets = parameter_sets
+        self.pair_batches = [pair_list[i:i + pair_batch_size] for i in range(0, len(pair_list), pair_batch_size)]
+        self.lease_timeout = lease_timeout
+        self.load_kwargs = load_kwargs
+        self.max_task_failures = max_task_failures
+
+        # Each task is identified by (set_index, batch_index)
+        self.pending_tasks = collections.deque((set_index, batch_index)
+                                               for set_index in range(len(parameter_sets))
+                                               for batch_index in range(len(self.pair_batches)))
+        # The task of every lease handed out, and the expiry time of the active leases
+        self.issued_tasks: dict[int, tuple[int, int]] = {}
+        self.lease_expiries: dict[int, float] = {}
+        self.next_lease_id = 0
+
+        # The net profits of the finished batches of each parameter set, and the fitness of each finished parameter set
+        self.batch_results: dict[int, dict[int, np.ndarray]] = collections.defaultdict(dict)
+        self.fitness_results: dict[int, dict] = {}
+
+        # The number of times each task has failed, and the last traceback of each failed parameter set
+        self.task_failures: dict[tuple[int, int], int] = collections.Counter()
+        self.failed_sets: dict[int, str] = {}
+
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.on_parameter_set_finished = None
+        self.on_parameter_set_failed = None
+
+        # Without pairs, every parameter set is finished without trades, and without parameter sets there is nothing to hand out
+        if not self.pair_batches:
+            self.fitness_results = {set_index: calc_fitness_from_net_profits(np.array([])) for set_index in range(len(parameter_sets))}
+        if not self.pending_tasks:
+            self.finished.set()
+
+    def reissue_expired_leases(self):
+        now = time.monotonic()
+        for lease_id, expiry in list(self.lease_expiries.items()):
+            if expiry < now and lease_id in self.lease_expiries:
+                del self.lease_expiries[lease_id]
+                self.fail_task(self.issued_tasks[lease_id], f'The lease of the task expired after {self.lease_timeout} seconds', reissue_first=True)
+
+    def fail_task(self, task: tuple[int, int], error: str, reissue_first: bool = False):
+        # Hands out a failed task again, or marks its parameter set as failed once the task has failed max_task_failures times
+        if self.is_task_finished(task):
+            return
+
+        self.task_failures[task] += 1
+        if self.task_failures[task] < self.max_task_failures:
+            if reissue_first:
+                self.pending_tasks.appendleft(task)
+            else:
+                self.pending_tasks.append(task)
+            return
+
+        set_index = task[0]
+        self.failed_sets[set_index] = error
+        self.batch_results.pop(set_index, None)
+        for other_lease_id in [other_lease_id for other_lease_id in self.lease_expiries if self.issued_tasks[other_lease_id][0] == set_index]:
+            del self.lease_expiries[other_lease_id]
+
+        if self.on_parameter_set_failed is not None:
+            self.on_parameter_set_failed(set_index, error)
+
+        self.check_finished()
+
+    def is_task_finished(self, task: tuple[int, int]) -> bool:
+        set_index, batch_index = task
+        return set_index in self.fitness_results or set_index in self.failed_sets or batch_index in self.batch_results[set_index]
+
+    def check_finished(self):
+        if len(self.fitness_results) + len(self.failed_sets) == len(self.parameter_sets):
+            self.finished.set()
+
+    def lease_task(self) -> tuple:
+        # Returns the message answering a task request
+        with self.lock:
+            if self.finished.is_set():
+                return 'done',
+
+            self.reissue_expired_leases()
+            while self.pending_tasks:
+                task = self.pending_tasks.popleft()
+                if self.is_task_finished(task):
+                    continue
+
+                lease_id = self.next_lease_id
+                self.next_lease_id += 1
+                self.issued_tasks[lease_id] = task
+                self.lease_expiries[lease_id] = time.monotonic() + self.lease_timeout
+
+                set_index, batch_index = task
+                return 'task', lease_id, self.parameter_sets[set_index][0], self.pair_batches[batch_index], self.load_kwargs
+
+            # All the remaining tasks are leased, so the worker should ask again when the earliest lease expires.
+            earliest_expiry = min(self.lease_expiries.values(), default=time.monotonic())
+            return 'wait', min(max(earliest_expiry - time.monotonic(), 0.1), 5)
+
+    def submit_result(self, lease_id: int, net_profits: np.ndarray):
+        with self.lock:
+            # The result of an expired lease is still accepted, as long as its task hasn't been finished by the reissued lease.
+            task = self.issued_tasks[lease_id]
+            self.lease_expiries.pop(lease_id, None)
+            if self.is_task_finished(task):
+                return
+
+            set_index, batch_index = task
+            self.batch_results[set_index][batch_index] = net_profits
+
+            # The other leases of the same task (if it was reissued) are no longer needed
+            for other_lease_id in [other_lease_id for other_lease_id in self.lease_expiries if self.issued_tasks[other_lease_id] == task]:
+                del self.lease_expiries[other_lease_id]
+
+            if len(self.batch_results[set_index]) == len(self.pair_batches):
+                set_net_profits = np.concatenate([self.batch_results[set_index][i] for i in range(len(self.pair_batches))])
+                self.fitness_results[set_index] = calc_fitness_from_net_profits(set_net_profits)
+                del self.batch_results[set_index]
+
+                if self.on_parameter_set_finished is not None:
+                    self.on_parameter_set_finished(set_index, self.fitness_results[set_index])
+
+                self.check_finished()
+
+    def submit_error(self, lease_id: int, error_traceback: str):
+        with self.lock:
+            # An error of a lease which already expired was counted as a failure when it expired
+            if self.lease_expiries.pop(lease_id, None) is not None:
+                self.fail_task(self.issued_tasks[lease_id], error_traceback)
+
+    def serve_connection(self, connection: Connection):
+        # Answers the messages of a single worker until it disconnects
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == 'request':
+                    connection.send(self.lease_task())
+                elif message[0] == 'result':
+                    self.submit_result(message[1], message[2])
+                elif message[0] == 'error':
+                    self.submit_error(message[1], message[2])
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            connection.close()
+
+    def serve(self, address: str, authkey: bytes):
+        """
+        Listens for workers on the given address until all the tasks are finished. Each worker connection is served by its own thread.
+        """
+        listener = Listener(parse_address(address), authkey=authkey)
+
+        def accept_connections():
+            while not self.finished.is_set():
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    # Failed authentication or a closed listener
+                    continue
+                threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+        threading.Thread(target=accept_connections, daemon=True).start()
+        self.finished.wait()
+        listener.close()
+
+
+def connect_to_coordinator(address: str, authkey: bytes, connect_timeout: float = 60) -> Connection:
+    # Connects to the coordinator, retrying until connect_timeout in case the coordinator hasn't started listening yet.
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            return Client(parse_address(address), authkey=authkey)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def run_worker(address: str, authkey: bytes, logging_config: tuple | None = None, config: Config | None = None):
+    """
+    Requests tasks from the coordinator and processes them until the coordinator reports that all the tasks are finished. The data of the pairs is
+    loaded from the local cache the first time each pair is needed, and kept for the next tasks.
+
+    A task raising an exception (such as a pair missing from the local cache) is reported to the coordinator with its traceback, and the worker
+    goes on with the next task. The worker process exits with status 1 if any of its tasks failed.
+    """
+    if config is not None:
+        set_config(config)
+    if logging_config is not None:
+        LoggerSingleton.configure_process(*logging_config)
+
+    connection = connect_to_coordinator(address, authkey)
+    all_pairs_data = {}
+    n_failed_tasks = 0
+
+    try:
+        while True:
+            connection.send(('request',))
+            message = connection.recv()
+
+            if message[0] == 'done':
+                break
+            elif message[0] == 'wait':
+                time.sleep(message[1])
+                continue
+
+            _, lease_id, params, pair_names, load_kwargs = message
+            try:
+                pair_net_profits = []
+                for pair_name in pair_names:
+                    if pair_name not in all_pairs_data:
+                        all_pairs_data[pair_name] = load_local_data(pair_name, **load_kwargs)
+
+                    pair_net_profits.append(run_algo(pair_name, all_pairs_data[pair_name], params)[0].net_profits())
+            except Exception:
+                n_failed_tasks += 1
+                error_traceback = traceback.format_exc()
+                print(f'Task {lease_id} failed on pairs {", ".join(pair_names)}:\n{error_traceback}', file=sys.stderr)
+                connection.send(('error', lease_id, error_traceback))
+                continue
+
+            connection.send(('result', lease_id, np.concatenate(pair_net_profits) if pair_net_profits else np.array([])))
+    except (EOFError, ConnectionError):
+        # The coordinator has finished and closed the connection
+        pass
+    finally:
+        connection.close()
+
+    if n_failed_tasks:
+        sys.exit(1)
+
+
+def run_workers(address: str, authkey: bytes, n_workers: int, logging_config: tuple | None = None) -> list[int]:
+    """
+    Runs several worker processes on this machine, each with its own connection to the coordinator, logging to the queue of this process and
+    using its configuration.
+
+    Returns:
+        list[int]: The exit codes of the worker processes which didn't exit normally (failed tasks, or a crash)
+    """
+    workers = [Process(target=run_worker, args=(address, authkey, logging_config, get_config())) for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return [worker.exitcode for worker in workers if worker.exitcode != 0]
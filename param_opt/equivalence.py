@@ -0,0 +1,92 @@
+import math
+
+import numpy as np
+
+
+def get_effective_params(params, param_set: dict) -> tuple:
+    """
+    Canonicalizes a parameter set to the behavior it actually has in the algo, so parameter sets producing identical trades get identical keys.
+    The rules are:
+    1) The trailing stoploss is only triggered by an intermediate target event, so a trailing_sl_target_id which isn't an integer between 1 and
+       n_targets - 1 behaves like 0 (trailing disabled): a target event of n_targets is always handled as a full target.
+    2) Bounces are counted down by 1 from max_bounces while it's positive, so a fractional max_bounces behaves like the next integer.
+    3) With no bounces (max_bounces <= 0), no order block is ever entered, so none of the other parameters make any difference.
+
+    Args:
+        params: The Params of the parameter set, used to look up the values which aren't part of the parameter set (e.g. n_targets)
+        param_set (dict): The values of the parameter set's own parameters
+
+    Returns:
+        tuple: The canonical key of the parameter set, with one (name, effective value) item per parameter
+    """
+    effective_param_set = dict(param_set)
+
+    max_bounces = params.max_bounces
+    if max_bounces <= 0:
+        return ('max_bounces', 0),
+
+    if 'max_bounces' in effective_param_set:
+        effective_param_set['max_bounces'] = math.ceil(max_bounces)
+
+    if 'trailing_sl_target_id' in effective_param_set:
+        trailing_sl_target_id = params.trailing_sl_target_id
+        if not (float(trailing_sl_target_id).is_integer() and 1 <= trailing_sl_target_id <= params.n_targets - 1):
+            effective_param_set['trailing_sl_target_id'] = 0
+
+    return tuple(effective_param_set.items())
+
+
+class EquivalenceClasses:
+    """
+    Groups a sequence of parameter sets into classes of parameter sets with the same behavior (see get_effective_params), so each class is only run
+    once, by its first member (the representative). The results of the representatives are then fanned back out to every member of their class.
+    """
+
+    def __init__(self, parameter_sets):
+        self.parameter_sets = parameter_sets
+
+        # The index of the class of each parameter set, and the index of the representative parameter set of each class
+        class_indices = []
+        self.representative_indices: list[int] = []
+
+        class_ids = {}
+        for set_index, (params, param_set) in enumerate(parameter_sets):
+            key = get_effective_params(params, param_set)
+            if key not in class_ids:
+                class_ids[key] = len(self.representative_indices)
+                self.representative_indices.append(set_index)
+
+            class_indices.append(class_ids[key])
+
+        self.class_indices = np.array(class_indices, dtype=np.int64)
+
+    def __len__(self):
+        # The number of classes, which is the number of parameter sets which are actually run
+        return len(self.representative_indices)
+
+    def __getitem__(self, class_index: int):
+        return self.parameter_sets[self.representative_indices[class_index]]
+
+    def __iter__(self):
+        for set_index in self.representative_indices:
+            yield self.parameter_sets[set_index]
+
+    @property
+    def saved_evaluations(self) -> int:
+        return len(self.class_indices) - len(self.representative_indices)
+
+    def report(self) -> str:
+        return (f'{len(self.class_indices)} parameter sets fall into {len(self)} equivalence classes, '
+                f'saving {self.saved_evaluations} evaluations ({self.saved_evaluations / max(len(self.class_indices), 1) * 100:.1f}%).')
+
+    def fan_out(self, class_results: list[dict]) -> list[dict]:
+        """
+        Fans out the result rows of the representatives (one per class, in class order) to a result row for every parameter set, in the order of
+        the parameter sets. The parameter values of each row are replaced with the values of its own parameter set.
+        """
+        results = []
+        for (_, param_set), class_index in zip(self.parameter_sets, self.class_indices):
+            class_result = class_results[class_index]
+            results.append({**param_set, **{key: value for key, value in class_result.items() if key not in param_set}})
+
+        return results
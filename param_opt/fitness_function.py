@@ -1,11 +1,17 @@
-import pandas as pd
 import numpy as np
 
+from algo_code.trade_records import TradeRecords
 
-def calc_fitness_parameters(positions_df: pd.DataFrame) -> dict:
-    # Calculates the fitness function from a list of positions.
-    net_profits = positions_df['Net profit'].to_numpy()
+
+def calc_fitness_from_net_profits(net_profits: np.ndarray) -> dict:
+    # Calculates the fitness function from the net profits of a set of trades.
     return {
-        'net_profit': float(sum(net_profits)),
-        'winrate': len(np.where(net_profits > 0)[0]) / len(net_profits) * 100,
+        'net_profit': float(net_profits.sum()),
+        'winrate': len(np.where(net_profits > 0)[0]) / len(net_profits) * 100 if len(net_profits) else 0,
     }
+
+
+def calc_fitness_parameters(trade_records_list: list[TradeRecords]) -> dict:
+    # Calculates the fitness function from the trade records of the pairs.
+    net_profits = np.concatenate([trade_records.net_profits() for trade_records in trade_records_list]) if trade_records_list else np.array([])
+    return calc_fitness_from_net_profits(net_profits)
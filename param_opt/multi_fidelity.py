@@ -0,0 +1,98 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from param_opt.param_set_generator import Params
+from utils.resample import parse_timeframe
+
+# The parameters counted in candles, which are scaled down by the resample ratio on the coarse timeframe so they cover the same time span
+window_param_names = ['zigzag_window_size']
+
+# The smallest window on the coarse timeframe, since a window of a single candle only compares each candle to itself
+min_window_size = 2
+
+
+def get_resample_ratio(timeframe: str, coarse_timeframe: str) -> float:
+    # The number of candles of the timeframe in each candle of the coarse timeframe
+    ratio = parse_timeframe(coarse_timeframe) / parse_timeframe(timeframe)
+    if ratio <= 1:
+        raise ValueError(f'The screening timeframe {coarse_timeframe} must be coarser than the timeframe {timeframe}')
+    return ratio
+
+
+def scale_parameter_set(param_set: dict, ratio: float) -> dict:
+    # The parameter set to run on the coarse timeframe, with the window sizes scaled by the resample ratio
+    return {name: max(round(value / ratio), min_window_size) if name in window_param_names else value for name, value in param_set.items()}
+
+
+def make_coarse_parameter_sets(parameter_sets, coarse_timeframe: str, ratio: float) -> list[tuple[Params, dict]]:
+    """
+    Builds the parameter sets of the screening run: one per parameter set, in the same order, with the window sizes scaled and the timeframe
+    replaced by the coarse timeframe. The lower timeframe resolution of the ambiguous candles is disabled, since the screening only needs a ranking.
+    Parameter sets whose scaled values coincide are equivalent, so the screening runs fewer distinct parameter sets than the full resolution run.
+    """
+    coarse_base_params = {**parameter_sets.base_params, 'timeframe': coarse_timeframe, 'intrabar_timeframe': None}
+
+    coarse_parameter_sets = []
+    for _, param_set in parameter_sets:
+        coarse_param_set = scale_parameter_set(param_set, ratio)
+        coarse_parameter_sets.append((Params(coarse_base_params, **coarse_param_set), coarse_param_set))
+
+    return coarse_parameter_sets
+
+
+def select_promoted(coarse_scores: np.ndarray, promote_fraction: float) -> np.ndarray:
+    """
+    Selects the parameter sets with the best screening scores, at least one. Ties are broken by the order of the parameter sets.
+
+    Returns:
+        np.ndarray: The indices of the promoted parameter sets, in the order of the parameter sets
+    """
+    n_promoted = min(max(math.ceil(len(coarse_scores) * promote_fraction), 1), len(coarse_scores))
+    return np.sort(np.argsort(-coarse_scores, kind='stable')[:n_promoted])
+
+
+def summarize_screening(parameter_sets, coarse_results: list[dict], fine_results: dict[int, dict], optimize_by: str = 'net_profit') -> \
+        tuple[pd.DataFrame, dict]:
+    """
+    Builds the report of a screening run, with a row per parameter set holding its coarse fitness and rank, and its full resolution fitness and
+    rank if it was promoted.
+
+    The Spearman rank correlation between the coarse and full resolution scores of the promoted parameter sets tells how well the screening
+    predicts the full resolution ranking. Since it's only measured among the promoted parameter sets, it's most meaningful when the promoted
+    fraction is large; a run promoting every parameter set gives the correlation over the whole space, to tune the fraction and the timeframe by.
+
+    Returns:
+        tuple[pd.DataFrame, dict]: The report, and the summary of the screening: the number of promoted parameter sets, the rank correlation, and
+        how many of the best promoted parameter sets at full resolution were also the best at the coarse resolution
+    """
+    rows = []
+    for set_index, ((_, param_set), coarse_result) in enumerate(zip(parameter_sets, coarse_results)):
+        row = {**param_set, **{f'coarse_{name}': value for name, value in coarse_result.items()}}
+        for name in coarse_result:
+            row[name] = fine_results[set_index][name] if set_index in fine_results else np.nan
+        row['promoted'] = set_index in fine_results
+        rows.append(row)
+
+    report_df = pd.DataFrame(rows)
+    report_df['coarse_rank'] = report_df[f'coarse_{optimize_by}'].rank(ascending=False, method='min')
+    report_df['rank'] = report_df[optimize_by].rank(ascending=False, method='min')
+
+    promoted_df = report_df[report_df['promoted']]
+    # The Spearman correlation is the Pearson correlation of the ranks, computed this way since pandas needs scipy for method='spearman'
+    rank_correlation = promoted_df[f'coarse_{optimize_by}'].rank().corr(promoted_df[optimize_by].rank()) if len(promoted_df) > 1 else np.nan
+
+    # The overlap of the top 10% of the promoted parameter sets by their coarse and full resolution scores
+    n_top = max(len(promoted_df) // 10, 1)
+    top_coarse = set(promoted_df.nlargest(n_top, f'coarse_{optimize_by}').index)
+    top_fine = set(promoted_df.nlargest(n_top, optimize_by).index)
+
+    summary = {
+        'n_parameter_sets': len(report_df),
+        'n_promoted': len(promoted_df),
+        'rank_correlation': float(rank_correlation),
+        'top_overlap': len(top_coarse & top_fine) / n_top if len(promoted_df) else np.nan,
+    }
+
+    return report_df, summary
@@ -1,7 +1,9 @@
 # param_opt/param_set_generator.py
 
-import itertools
+import math
+
 from utils import constants
+from utils.config import get_config
 
 param_cases = {
     'zigzag_window_size': [9, 11, 13, 15],
@@ -14,9 +16,22 @@ param_cases = {
 
 
 class Params:
-    def __init__(self, **kwargs):
+    """
+    The parameters of a single run of the algo. Only the values of the parameter set are stored in the object itself; every other value is looked
+    up in the base dict, which is shared between all the parameter sets of a parameter space instead of being copied into each of them.
+    """
+
+    def __init__(self, base: dict = None, **kwargs):
+        self._base = base if base is not None else {}
         self.__dict__.update(kwargs)
 
+    def __getattr__(self, name):
+        # Only called for the attributes which aren't part of the parameter set
+        try:
+            return self.__dict__['_base'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
     def __reduce__(self):
         # Return a tuple with the callable and arguments to reconstruct the object
         return self.__class__, (), self.__dict__
@@ -26,27 +41,88 @@ class Params:
         self.__dict__.update(state)
 
 
-def create_parameter_sets(param_cases):
-    keys = param_cases.keys()
-    values = param_cases.values()
-    permutations = [dict(zip(keys, combination)) for combination in itertools.product(*values)]
-    return permutations
+def get_base_params() -> dict:
+    # The configuration values all the parameter sets share, filtered to include only int, float, or str values
+    return {k: v for k, v in vars(get_config()).items() if isinstance(v, (int, float, str))}
+
+
+class ParameterSpace:
+    """
+    A lazy sequence of all the combinations of param_cases, in the same order as itertools.product. Nothing is materialized up front: the
+    combination at any ordinal is decoded on demand as a mixed-radix number, with one digit per parameter and the last parameter changing
+    fastest. Each item is a (Params, permutation_params_dict) tuple.
+
+    Slicing and shard() return another ParameterSpace over a subset of the ordinals, so a space can be split between machines without building it.
+    """
+
+    def __init__(self, param_cases: dict, base_params: dict = None, ordinals: range = None):
+        self.param_cases = param_cases
+        self.keys = list(param_cases.keys())
+        self.values = [list(values) for values in param_cases.values()]
+        self.base_params = base_params if base_params is not None else get_base_params()
+
+        self.full_size = math.prod(len(values) for values in self.values)
+        self.ordinals = ordinals if ordinals is not None else range(self.full_size)
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def __iter__(self):
+        for ordinal in self.ordinals:
+            yield self.get_parameter_set(ordinal)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ParameterSpace(self.param_cases, self.base_params, self.ordinals[index])
+
+        return self.get_parameter_set(self.ordinals[index])
+
+    def get_combination(self, ordinal: int) -> dict:
+        # Decodes the ordinal into one value per parameter, starting from the last (fastest changing) parameter
+        if not 0 <= ordinal < self.full_size:
+            raise IndexError(f'Parameter set ordinal {ordinal} is out of range for a parameter space of size {self.full_size}')
+
+        combination = {}
+        for key, values in zip(reversed(self.keys), reversed(self.values)):
+            ordinal, digit = divmod(ordinal, len(values))
+            combination[key] = values[digit]
+
+        return {key: combination[key] for key in self.keys}
+
+    def get_parameter_set(self, ordinal: int) -> tuple[Params, dict]:
+        # Filter the combination to include only int, float, or str values
+        param_set = {k: v for k, v in self.get_combination(ordinal).items() if isinstance(v, (int, float, str))}
+        return Params(self.base_params, **param_set), param_set
+
+    def shard(self, shard_index: int, n_shards: int) -> 'ParameterSpace':
+        """
+        Returns the shard_index-th of n_shards disjoint shards of the parameter space (shard_index starting at 0). The shards take every n_shards-th
+        combination, so each shard gets a similar mix of the expensive and cheap combinations.
+        """
+        if not 0 <= shard_index < n_shards:
+            raise ValueError(f'Invalid shard {shard_index}/{n_shards}: the shard index must be between 0 and {n_shards - 1}')
+
+        return self[shard_index::n_shards]
 
 
 def get_params(param_cases):
-    permutation_params_dict = create_parameter_sets(param_cases)
-    combined_params = []
+    return ParameterSpace(param_cases)
+
 
-    # Filter constants to include only int, float, or str values
-    filtered_constants = {k: v for k, v in vars(constants).items() if isinstance(v, (int, float, str))}
+def get_parameter_sets() -> ParameterSpace:
+    # The parameter space of this run, only the shard given with --shard if any
+    parameter_sets = get_params(param_cases)
+    if constants.shard:
+        parameter_sets = parameter_sets.shard(*constants.shard)
 
-    for param_set in permutation_params_dict:
-        # Filter param_set to include only int, float, or str values
-        filtered_param_set = {k: v for k, v in param_set.items() if isinstance(v, (int, float, str))}
-        # Combine with filtered constants
-        combined = {**filtered_constants, **filtered_param_set}
-        combined_params.append((Params(**combined), filtered_param_set))
-    return combined_params
+    return parameter_sets
 
 
-parameter_sets = get_params(param_cases)
+def __getattr__(name: str):
+    # The parameter space is only built (which loads the configuration) the first time `parameter_sets` is imported, not when the module
+    # is imported
+    global parameter_sets
+    if name == 'parameter_sets':
+        parameter_sets = get_parameter_sets()
+        return parameter_sets
+    raise AttributeError(name)
@@ -0,0 +1,260 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from algo_code.algo import Algo
+from algo_code.run_algo import run_algo, run_universe_algo
+from algo_code.universe_algo import Universe
+import utils.datatypes as dt
+
+# The tables compared between the engines, in the order of the stages producing them
+table_names = ['zigzag', 'msb_points', 'order_blocks', 'trades']
+
+# The column of each table the pair of a row of the universe engine is found by
+segment_columns = {'zigzag': 'pdi', 'msb_points': 'pdi', 'order_blocks': 'base_candle_pdi', 'trades': None}
+
+
+def get_pair_tables(algo: Algo) -> dict[str, dict[str, np.ndarray]]:
+    """
+    The results of each stage of an algo run, as tables of column arrays. The order blocks are described by their geometry, their active PDIs and
+    the prices of their positions.
+    """
+    ob_list = algo.ob_list
+    return {
+        'zigzag': {column: algo.zigzag_df[column].to_numpy() for column in algo.zigzag_df.columns},
+        'msb_points': {column: algo.msb_points_df[column].to_numpy() for column in algo.msb_points_df.columns},
+        'order_blocks': {
+            'id': np.array([ob.id for ob in ob_list], dtype=object),
+            'type': np.array([ob.type for ob in ob_list], dtype=object),
+            'base_candle_pdi': np.array([ob.base_candle_pdi for ob in ob_list], dtype=np.int64),
+            'formation_pdi': np.array([ob.formation_pdi for ob in ob_list], dtype=np.int64),
+            'end_pdi': np.array([ob.end_pdi for ob in ob_list], dtype=np.int64),
+            'top': np.array([ob.top for ob in ob_list], dtype=float),
+            'bottom': np.array([ob.bottom for ob in ob_list], dtype=float),
+            'entry_price': np.array([ob.position.entry_price for ob in ob_list], dtype=float),
+            'stoploss': np.array([ob.position.stoploss for ob in ob_list], dtype=float),
+            'target_list': np.array([ob.position.target_list for ob in ob_list], dtype=float) if ob_list else np.zeros((0, algo.params.n_targets)),
+        },
+        'trades': {field: algo.trade_records.records[field] for field in algo.trade_records.records.dtype.names},
+    }
+
+
+class ReferenceEngine:
+    """
+    The reference implementation of the algo: every stage run one pair at a time, with nothing reused between the runs. The fast engines are
+    checked against its results.
+    """
+
+    def __init__(self, pair_list: list[str], all_pairs_data: dict[str, dt.PairDf]):
+        self.pair_list = pair_list
+        self.all_pairs_data = all_pairs_data
+
+    def run(self, params):
+        algos = {}
+        for pair_name in self.pair_list:
+            algo = Algo(self.all_pairs_data[pair_name], pair_name, params)
+            algo.init_zigzag()
+            algo.find_msb_points()
+            algo.find_order_block_bases()
+            algo.find_order_blocks()
+            algo.process_concurrent_order_blocks()
+            algo.calc_events_array()
+            algo.process_events_array()
+            algos[pair_name] = algo
+
+        return algos
+
+    def get_tables(self, run_result) -> dict[str, dict[str, dict[str, np.ndarray]]]:
+        # The tables of each pair, from the result of run()
+        return {pair_name: get_pair_tables(algo) for pair_name, algo in run_result.items()}
+
+
+class DetectionStoreEngine(ReferenceEngine):
+    """
+    The pair engine of main.py and main_param_opt.py, which loads the zigzag, MSB points and order block bases from the detection store when they
+    were stored by an earlier run.
+    """
+
+    def run(self, params):
+        return {pair_name: run_algo(pair_name, self.all_pairs_data[pair_name], params)[1] for pair_name in self.pair_list}
+
+
+class UniverseEngine(ReferenceEngine):
+    """
+    The universe engine, which runs each stage once over all the pairs concatenated. The universe is built once, outside the timed runs, like in
+    the universe version of main_param_opt.py.
+    """
+
+    def __init__(self, pair_list: list[str], all_pairs_data: dict[str, dt.PairDf]):
+        super().__init__(pair_list, all_pairs_data)
+        self.universe = Universe({pair_name: all_pairs_data[pair_name] for pair_name in pair_list})
+
+    def run(self, params):
+        return run_universe_algo(self.universe, params)
+
+    def get_tables(self, run_result) -> dict[str, dict[str, dict[str, np.ndarray]]]:
+        # The tables of the universe are split per pair, with their PDIs made local to the pair like the reference's
+        pair_trade_records, algo = run_result
+        universe_tables = get_pair_tables(algo)
+
+        all_pairs_tables = {}
+        for segment_id, pair_name in enumerate(self.universe.pair_names):
+            offset = int(algo.segment_offsets[segment_id])
+
+            pair_tables = {}
+            for table_name in ['zigzag', 'msb_points', 'order_blocks']:
+                table = universe_tables[table_name]
+                in_segment = algo.segment_ids[table[segment_columns[table_name]]] == segment_id if len(table[segment_columns[table_name]]) else \
+                    np.zeros(0, dtype=bool)
+
+                pair_tables[table_name] = {}
+                for column, values in table.items():
+                    values = values[in_segment]
+                    if column.endswith('pdi'):
+                        # Unset PDIs (-1) stay unset
+                        values = np.where(values >= 0, values - offset, values)
+                    pair_tables[table_name][column] = values
+
+            records = pair_trade_records[pair_name].records
+            pair_tables['trades'] = {field: records[field] for field in records.dtype.names}
+            all_pairs_tables[pair_name] = pair_tables
+
+        return all_pairs_tables
+
+
+fast_engines = {'universe': UniverseEngine, 'detection_store': DetectionStoreEngine}
+
+
+def find_first_divergence(reference_table: dict[str, np.ndarray], fast_table: dict[str, np.ndarray], rtol: float, atol: float) -> \
+        tuple[int, list[str]] | None:
+    """
+    Finds the first row where two tables differ. The float columns are compared with the given tolerances, the other columns exactly, with
+    the missing values equal to each other.
+
+    Returns:
+        tuple[int, list[str]] | None: The index of the first differing row and the columns differing in it, or None if the tables are equal. A row
+        missing from one of the tables differs in all the columns.
+    """
+    n_reference_rows = len(next(iter(reference_table.values()), []))
+    n_fast_rows = len(next(iter(fast_table.values()), []))
+
+    # Empty tables are equal whatever their columns, since a stage finding nothing may build its table without columns (DataFrame([]))
+    if list(reference_table) != list(fast_table):
+        return None if n_reference_rows == n_fast_rows == 0 else (0, sorted(set(reference_table) ^ set(fast_table)))
+    n_common_rows = min(n_reference_rows, n_fast_rows)
+
+    differing_rows = {}
+    for column in reference_table:
+        reference_values = reference_table[column][:n_common_rows]
+        fast_values = fast_table[column][:n_common_rows]
+
+        if reference_values.dtype.kind == 'f' and fast_values.dtype.kind == 'f':
+            differs = ~np.isclose(reference_values, fast_values, rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            # Missing values (NaT, None) are equal to each other
+            differs = (reference_values != fast_values) & ~(pd.isna(reference_values) & pd.isna(fast_values))
+        if differs.ndim > 1:
+            differs = differs.any(axis=tuple(range(1, differs.ndim)))
+
+        if differs.any():
+            differing_rows[column] = int(np.argmax(differs))
+
+    first_row = min(differing_rows.values(), default=n_common_rows)
+    if first_row == n_common_rows and n_reference_rows == n_fast_rows:
+        return None
+
+    if first_row == n_common_rows:
+        return first_row, list(reference_table)
+    return first_row, [column for column, row in differing_rows.items() if row == first_row]
+
+
+def format_context(table: dict[str, np.ndarray], row: int, n_context_rows: int) -> str:
+    # The rows of a table around the given row
+    start, stop = max(row - n_context_rows, 0), row + n_context_rows + 1
+    context_df = pd.DataFrame({column: list(values[start:stop]) for column, values in table.items()},
+                              index=range(start, min(stop, len(next(iter(table.values()), [])))))
+    return context_df.to_string() if len(context_df) else '(no rows)'
+
+
+def compare_pair_tables(reference_tables: dict, fast_tables: dict, rtol: float = 1e-9, atol: float = 1e-9, n_context_rows: int = 2) -> \
+        tuple[str, str] | None:
+    """
+    Compares the tables of a pair stage by stage, and describes the first divergence, in the first stage diverging, with the rows of both tables
+    around it.
+
+    Returns:
+        tuple[str, str] | None: A one-line summary and a description with context of the first divergence, or None if all the tables are equal
+    """
+    for table_name in table_names:
+        divergence = find_first_divergence(reference_tables[table_name], fast_tables[table_name], rtol, atol)
+        if divergence is None:
+            continue
+
+        row, columns = divergence
+        summary = f'{table_name} row {row}: {", ".join(columns)}'
+        description = '\n'.join([f'First divergence in {table_name}, row {row}, columns {", ".join(columns)}',
+                                 'Reference:',
+                                 format_context(reference_tables[table_name], row, n_context_rows),
+                                 'Fast engine:',
+                                 format_context(fast_tables[table_name], row, n_context_rows)])
+        return summary, description
+
+    return None
+
+
+def verify_engine(engine_name: str, pair_list: list[str], all_pairs_data: dict[str, dt.PairDf], parameter_sets) -> pd.DataFrame:
+    """
+    Runs the reference engine and a fast engine side by side on every parameter set, and compares the zigzag, MSB points, order blocks and trades of
+    every pair. The engines are run one after the other in this process, so their times are comparable. The first divergence found is printed with
+    its context.
+
+    Args:
+        engine_name (str): The fast engine to verify, from fast_engines
+        pair_list (list[str]): The pairs to run
+        all_pairs_data (dict[str, dt.PairDf]): The candles of the pairs
+        parameter_sets: The (params, permutation params dict) pairs to run
+
+    Returns:
+        pd.DataFrame: One row per parameter set and pair, with the first divergence of the pair, if any, and the times and speedup of the engines on
+        the parameter set
+    """
+    reference_engine = ReferenceEngine(pair_list, all_pairs_data)
+    fast_engine = fast_engines[engine_name](pair_list, all_pairs_data)
+
+    report_rows = []
+    first_divergence_printed = False
+    for i, (params, permutation_params_dict) in enumerate(parameter_sets, 1):
+        start_time = time.perf_counter()
+        reference_result = reference_engine.run(params)
+        reference_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        fast_result = fast_engine.run(params)
+        fast_time = time.perf_counter() - start_time
+
+        reference_tables = reference_engine.get_tables(reference_result)
+        fast_tables = fast_engine.get_tables(fast_result)
+
+        n_diverging_pairs = 0
+        for pair_name in pair_list:
+            divergence = compare_pair_tables(reference_tables[pair_name], fast_tables[pair_name])
+            if divergence is not None:
+                n_diverging_pairs += 1
+                if not first_divergence_printed:
+                    print(f'{pair_name}, {permutation_params_dict}:')
+                    print(divergence[1])
+                    print()
+                    first_divergence_printed = True
+
+            report_rows.append({**permutation_params_dict,
+                                'pair': pair_name,
+                                'equal': divergence is None,
+                                'first_divergence': divergence[0] if divergence is not None else '',
+                                'reference_time': reference_time,
+                                'fast_time': fast_time,
+                                'speedup': reference_time / fast_time if fast_time > 0 else np.inf})
+
+        print(f'Parameter set {i}: {n_diverging_pairs} / {len(pair_list)} pairs diverging, speedup {reference_time / fast_time:.2f}x')
+
+    return pd.DataFrame(report_rows)
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+
+from algo_code.run_algo import detection_key, run_algo, run_detection
+import utils.datatypes as dt
+
+# The phases of each walk-forward window, and the statistics accumulated per phase. The statistics are sums, so the results of the pairs can be
+# added together before calculating the fitness.
+phases = ['train', 'test']
+stats = ['net_profit', 'n_wins', 'n_trades']
+
+
+def make_windows(first_time: pd.Timestamp, last_time: pd.Timestamp, train_days: float, test_days: float, step_days: float = None) -> pd.DataFrame:
+    """
+    Creates the rolling walk-forward windows between two times. Each window has a train period followed directly by a test period, and the windows
+    are moved forward by step_days. Only the windows whose test period ends before last_time are kept.
+
+    Args:
+        first_time (pd.Timestamp): The start of the first train period
+        last_time (pd.Timestamp): The time the test periods can't extend beyond
+        train_days (float): The length of the train periods, in days
+        test_days (float): The length of the test periods, in days
+        step_days (float): The distance between the starts of consecutive windows, in days. Defaults to test_days.
+
+    Returns:
+        pd.DataFrame: The windows, with train_start, test_start (which is also the end of the train period) and test_end columns
+    """
+    train_length = pd.Timedelta(days=train_days)
+    test_length = pd.Timedelta(days=test_days)
+    step_length = pd.Timedelta(days=step_days if step_days else test_days)
+
+    train_starts = []
+    train_start = first_time
+    while train_start + train_length + test_length <= last_time:
+        train_starts.append(train_start)
+        train_start += step_length
+
+    if not train_starts:
+        raise ValueError(f'The data between {first_time} and {last_time} is too short for a single walk-forward window of {train_days} train days '
+                         f'and {test_days} test days.')
+
+    train_starts = pd.DatetimeIndex(train_starts)
+    return pd.DataFrame({
+        'train_start': train_starts,
+        'test_start': train_starts + train_length,
+        'test_end': train_starts + train_length + test_length,
+    })
+
+
+def calc_window_stats(pair_df: dt.PairDf, entry_pdis: np.ndarray, net_profits: np.ndarray, windows: pd.DataFrame) -> np.ndarray:
+    """
+    Sums the net profits, wins and trades of a pair in the train and test periods of each window. Each trade is assigned to the periods its entry
+    PDI falls into. The trades are sorted by entry PDI once, so the sums of every period are differences of cumulative sums at the period bounds.
+
+    Returns:
+        np.ndarray: The statistics with shape (number of windows, number of phases, number of stats)
+    """
+    # The PDI bounds of the periods in this pair. A bound is the first candle at or after the bound's time.
+    bound_epochs = np.concatenate([pd.DatetimeIndex(windows[column]).as_unit('ns').asi8 for column in ['train_start', 'test_start', 'test_end']])
+    period_bounds = pair_df.time_index.to_pdis(bound_epochs)
+    train_start_pdis, test_start_pdis, test_end_pdis = period_bounds.reshape(3, len(windows))
+
+    order = np.argsort(entry_pdis, kind='stable')
+    sorted_entry_pdis = entry_pdis[order]
+    sorted_net_profits = net_profits[order]
+
+    cumulative_stats = np.zeros((len(sorted_entry_pdis) + 1, len(stats)))
+    cumulative_stats[1:, 0] = np.cumsum(sorted_net_profits)
+    cumulative_stats[1:, 1] = np.cumsum(sorted_net_profits > 0)
+    cumulative_stats[1:, 2] = np.arange(1, len(sorted_entry_pdis) + 1)
+
+    def period_stats(start_pdis, end_pdis):
+        start_positions = np.searchsorted(sorted_entry_pdis, start_pdis, side='left')
+        end_positions = np.searchsorted(sorted_entry_pdis, end_pdis, side='left')
+        return cumulative_stats[end_positions] - cumulative_stats[start_positions]
+
+    return np.stack([period_stats(train_start_pdis, test_start_pdis), period_stats(test_start_pdis, test_end_pdis)], axis=1)
+
+
+def process_pair_walk_forward(pair_name: str, pair_df: dt.PairDf, parameter_sets: list, windows: pd.DataFrame) -> np.ndarray:
+    """
+    Runs all the parameter sets on the full history of a pair and splits the resulting trades between the walk-forward windows. The detection
+    stages (zigzag and MSB points) are only run once for all the parameter sets sharing the same detection parameters.
+
+    Returns:
+        np.ndarray: The statistics with shape (number of parameter sets, number of windows, number of phases, number of stats)
+    """
+    pair_stats = np.zeros((len(parameter_sets), len(windows), len(phases), len(stats)))
+
+    detections = {}
+    for set_index, (params, _) in enumerate(parameter_sets):
+        key = detection_key(params)
+        if key not in detections:
+            detections[key] = run_detection(pair_name, pair_df, params)
+
+        trade_records = run_algo(pair_name, pair_df, params, detection=detections[key])[0]
+        pair_stats[set_index] = calc_window_stats(pair_df, trade_records.records['entry_pdi'], trade_records.net_profits(), windows)
+
+    return pair_stats
+
+
+def stats_to_fitness(period_stats: np.ndarray) -> dict:
+    # Converts the summed statistics of a period to the same fitness values calc_fitness_from_net_profits returns.
+    net_profit, n_wins, n_trades = period_stats
+    return {
+        'net_profit': float(net_profit),
+        'winrate': n_wins / n_trades * 100 if n_trades else 0,
+    }
+
+
+def summarize_walk_forward(all_stats: np.ndarray, parameter_sets: list, windows: pd.DataFrame, optimize_by: str = 'net_profit') -> \
+        tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Builds the walk-forward reports from the summed statistics of all the pairs. In each window, the parameter set with the best train fitness is
+    selected and scored on the test period.
+
+    Args:
+        all_stats (np.ndarray): The statistics of all the pairs added together, as returned by process_pair_walk_forward
+        parameter_sets (list): The parameter sets, as (Params, permutation_params_dict) tuples
+        windows (pd.DataFrame): The walk-forward windows
+        optimize_by (str): The fitness value the best parameter set of each window is selected by
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: The train and test fitness of every parameter set in every window, and the selected parameter set of
+        each window with its train and test fitness
+    """
+    window_times = windows.assign(**{column: windows[column].dt.tz_localize(None) for column in windows.columns})
+
+    score_rows = []
+    for set_index, (_, permutation_params_dict) in enumerate(parameter_sets):
+        for window_index, window in enumerate(window_times.itertuples(index=False)):
+            score_row = {'window': window_index, **window._asdict(), **permutation_params_dict}
+            for phase_index, phase in enumerate(phases):
+                for fitness_name, value in stats_to_fitness(all_stats[set_index, window_index, phase_index]).items():
+                    score_row[f'{phase}_{fitness_name}'] = value
+            score_rows.append(score_row)
+
+    scores_df = pd.DataFrame(score_rows)
+
+    # The parameter set with the best train fitness in each window. Ties are broken by the order of the parameter sets.
+    best_rows = scores_df.loc[scores_df.groupby('window')[f'train_{optimize_by}'].idxmax()]
+    summary_df = best_rows.reset_index(drop=True)
+
+    return scores_df, summary_df
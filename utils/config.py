@@ -1,13 +1,234 @@
-# A config Singleton containing the pair_name that is being processed. This is used to update the logger and to keep track of the current pair being
-# processed.
+import argparse
+import copy
+import json
+import os
+
+from dotenv import dotenv_values
+
+# Set up argument parser
+parser = argparse.ArgumentParser()
+parser.add_argument('--output', type=str, help='File name of the output')
+parser.add_argument('--pl', type=str, help='File name of the pair list CSV')
+parser.add_argument('--position_type', type=str, help='Limit the direction of the positions (short/long)')
+parser.add_argument('--timeframe', type=str, help='Override the timeframe set by the params file.')
+parser.add_argument('--processes', type=str, help='Maximum number of processes to use while multiprocessing.')
+parser.add_argument('--engine', type=str, help='The engine to run the algo with: "pair" (default) runs each pair separately, "universe" runs each '
+                                                'stage once over all the pairs concatenated.')
+parser.add_argument('--start', type=str, help='Only load the candles from this date/time on (inclusive, UTC).')
+parser.add_argument('--end', type=str, help='Only load the candles up to this date/time (exclusive, UTC).')
+parser.add_argument('--walk_forward', type=str, help='Run the parameter optimization in walk-forward mode, with rolling train/test windows given '
+                                                   'as train_days,test_days[,step_days], e.g. 180,30. step_days defaults to test_days.')
+parser.add_argument('--columns', type=str, help='Comma-separated list of the columns to load from the cached data, e.g. '
+                                                'open,high,low,close,candle_color')
+parser.add_argument('--role', type=str, help='Run the parameter optimization distributed over several machines: "coordinator" hands out the '
+                                           'tasks and collects the results, "worker" processes the tasks using its local cached data.')
+parser.add_argument('--address', type=str, help='host:port the coordinator listens on and the workers connect to (default localhost:6000).')
+parser.add_argument('--authkey', type=str, help='The shared key the workers authenticate to the coordinator with. Required unless the address is '
+                                                'a loopback address.')
+parser.add_argument('--lease_timeout', type=str, help='Seconds after which a task handed out by the coordinator is reissued to another worker.')
+parser.add_argument('--max_task_failures', type=str, help='Number of times a task of the coordinator may fail (raise an exception on a worker, or '
+                                                           'have its lease expire) before its parameter set is marked as failed (default 3).')
+parser.add_argument('--pair_batch', type=str, help='Number of pairs in each task handed out by the coordinator.')
+parser.add_argument('--shard', type=str, help='Only run one shard of the parameter space, given as i/n with i from 0 to n-1, to split a '
+                                            'parameter optimization between machines.')
+parser.add_argument('--executor', type=str, help='The parallel execution backend of the parameter optimization: "processes" (default) or "threads".')
+parser.add_argument('--benchmark_sets', type=str, help='Number of parameter sets benchmark_executors.py times each executor on (default 20).')
+parser.add_argument('--log_level', type=str, help='Write the logs of the algo to ./logs, one file per pair, from this level on (e.g. DEBUG). '
+                                                'Logging is disabled by default.')
+parser.add_argument('--log_queue_size', type=str, help='Number of log records buffered for writing before new ones are dropped (default 10000).')
+parser.add_argument('--no_detection_store', action='store_true', help='Always recompute the zigzag, MSB points and order blocks instead of '
+                                                                      'loading them from the detection store of earlier runs.')
+parser.add_argument('--detection_store_mb', type=str, help='Maximum size of the detection store in MB (default 1024).')
+parser.add_argument('--intrabar', type=str, help='Resolve the order of the events of the candles touching several price levels of a position from '
+                                               'the candles of this lower timeframe, e.g. 1m, instead of the fixed priority rules.')
+parser.add_argument('--startup_profile', action='store_true', help='Report the time spent importing the modules of the script, loading the '
+                                                                   'configuration and starting a worker process, then exit.')
+parser.add_argument('--full', action='store_true', help='Process every pair again in main.py, instead of reusing the results of the previous run for '
+                                                        'the pairs whose data and parameters haven\'t changed.')
+parser.add_argument('--portfolio', action='store_true', help='Also simulate the trades of all the pairs in main.py on a single account, with '
+                                                             'the capital and position limits below.')
+parser.add_argument('--initial_capital', type=str, help='The initial capital of the account of the portfolio simulation and of the bootstrap '
+                                                        'ruin probability (default 10000).')
+parser.add_argument('--max_capital', type=str, help='The maximum capital in open positions in the portfolio simulation (default: the equity).')
+parser.add_argument('--max_positions', type=str, help='The maximum number of open positions in the portfolio simulation (default: unlimited).')
+parser.add_argument('--bootstrap', type=str, help='Add the Monte Carlo bootstrap statistics of this many resamples of the trades of each parameter '
+                                                  'set to the parameter optimization results (not supported by the distributed and walk-forward '
+                                                  'versions).')
+parser.add_argument('--telemetry', type=str, help='Every this many seconds, append the throughput, queue depth, IPC and per-worker busy time and RSS '
+                                                  'statistics of the parameter optimization to telemetry.jsonl in its reports and show them on '
+                                                  'the console.')
+parser.add_argument('--memory_budget', type=str, help='Keep the memory of main_param_opt.py and its workers under this many MB, by running fewer '
+                                                      'workers when it\'s exceeded and calculating the events of one order block at a time.')
+parser.add_argument('--screen', type=str, help='Score every parameter set on a coarser timeframe first, and only run the best fraction at full '
+                                               'resolution in main_param_opt.py, given as timeframe,fraction, e.g. 1h,0.2.')
+parser.add_argument('--chunksize', type=str, help='Number of tasks sent to a worker process at once in main_param_opt.py (default 1).')
+parser.add_argument('--min_task_candles', type=str, help='Batch consecutive pairs into tasks of at least this many candles in main_param_opt.py, so '
+                                                         'small pairs don\'t cost a task each (default: one pair per task).')
+parser.add_argument('--verify_engine', type=str, help='Instead of optimizing, run the reference engine and this fast engine ("universe" or '
+                                                      '"detection_store") on every parameter set in main_param_opt.py, and report the first '
+                                                      'divergence of their results and the speedup of the fast engine.')
+
 
 class Config:
-    _pair_name = None
+    """
+    The configuration of a run: the parameters of the .env.params file, overridden by the command line arguments. Loaded once per process by
+    get_config, and passed to the worker processes with set_config instead of being parsed again in each of them.
+    """
+
+    def __init__(self, args: argparse.Namespace, params: dict, run_profile: dict | None = None):
+        self.timeframe = args.timeframe if args.timeframe else params['timeframe']
+        self.zigzag_window_size = int(params['zigzag_window_size'])
+        self.fib_retracement_coeff = float(params['fib_retracement_coeff'])
+        self.stoploss_coeff = float(params['stoploss_coeff'])
+        self.target_coeff = float(params['target_coeff'])
+        self.max_bounces = int(params['max_bounces'])
+        self.max_concurrent = int(params['max_concurrent'])
+        self.used_capital = float(params['used_capital'])
+        self.trailing_sl_target_id = float(params['trailing_sl_target_id'])
+
+        self.ob_size_lower_limit = float(params['ob_size_lower_limit'])    # In percentage of entry price
+        self.ob_size_upper_limit = float(params['ob_size_upper_limit'])
+        self.n_targets = int(params['n_targets'])
+
+        # The strategy used for setting up the stoploss and targets of the positions, from the registries in algo_code/position_prices_setup.py
+        self.price_setup = params.get('price_setup', 'small_box_1234')
+
+        self.output_filename = args.output if args.output else 'all_positions.xlsx'
+        self.pair_list_filename = args.pl if args.pl else None
+        self.position_type = args.position_type.lower() if args.position_type else None
+        self.max_processes = int(args.processes) if args.processes else 4
+        self.engine = args.engine.lower() if args.engine else 'pair'
+        self.start_time = args.start if args.start else None
+        self.end_time = args.end if args.end else None
+        self.load_columns = args.columns.split(',') if args.columns else None
+        self.walk_forward_days = [float(days) for days in args.walk_forward.split(',')] if args.walk_forward else None
+        self.role = args.role.lower() if args.role else None
+        self.coordinator_address = args.address if args.address else 'localhost:6000'
+        self.authkey = args.authkey.encode() if args.authkey else None
+        self.lease_timeout = float(args.lease_timeout) if args.lease_timeout else 600
+        self.max_task_failures = int(args.max_task_failures) if args.max_task_failures else 3
+        self.pair_batch_size = int(args.pair_batch) if args.pair_batch else 8
+        self.shard = tuple(int(part) for part in args.shard.split('/')) if args.shard else None
+        self.executor_type = args.executor.lower() if args.executor else 'processes'
+        self.task_chunksize = int(args.chunksize) if args.chunksize else 1
+        self.min_task_candles = int(args.min_task_candles) if args.min_task_candles else 0
+        self.benchmark_sets = int(args.benchmark_sets) if args.benchmark_sets else 20
+        self.log_level = args.log_level if args.log_level else None
+        self.log_queue_size = int(args.log_queue_size) if args.log_queue_size else 10000
+        self.use_detection_store = not args.no_detection_store
+        self.detection_store_max_mb = float(args.detection_store_mb) if args.detection_store_mb else 1024
+        self.incremental = not args.full
+        self.intrabar_timeframe = args.intrabar if args.intrabar else None
+        self.startup_profile = args.startup_profile
+        self.portfolio = args.portfolio
+        self.initial_capital = float(args.initial_capital) if args.initial_capital else 10000
+        self.max_capital = float(args.max_capital) if args.max_capital else None
+        self.max_positions = int(args.max_positions) if args.max_positions else None
+        self.bootstrap_samples = int(args.bootstrap) if args.bootstrap else None
+        self.telemetry_interval = float(args.telemetry) if args.telemetry else None
+        self.memory_budget_mb = float(args.memory_budget) if args.memory_budget else None
+        self.screen_timeframe = args.screen.split(',')[0] if args.screen else None
+        self.screen_fraction = float(args.screen.split(',')[1]) if args.screen and ',' in args.screen else 0.2
+        self.verify_engine = args.verify_engine.lower() if args.verify_engine else None
+
+        # The run profile measured by calibrate.py, without the settings given on the command line, which apply_run_profile applies to the runs it
+        # was measured on
+        given_settings = {'processes': args.processes, 'executor': args.executor, 'chunksize': args.chunksize,
+                          'min_task_pairs': args.min_task_candles}
+        self.run_profile = {name: value for name, value in (run_profile or {}).items() if not given_settings.get(name)}
+
+
+# The configuration of this process, loaded the first time it's needed
+_config: Config | None = None
+
+
+# The local profile written by calibrate.py, with the best execution settings measured on this machine
+run_profile_path = '.run_profile.json'
+
+
+def load_run_profile(profile_path: str = run_profile_path) -> dict:
+    # The settings of the run profile, or none if there is no profile or it can't be read
+    if not os.path.exists(profile_path):
+        return {}
+
+    try:
+        with open(profile_path) as profile_file:
+            return json.load(profile_file)
+    except (OSError, json.JSONDecodeError) as error:
+        print(f'Ignoring the run profile {profile_path}: {error}')
+        return {}
+
+
+# The largest ratio between the number of pairs of a run and of the calibration the run profile still applies to
+max_profile_pairs_ratio = 2
+
+
+def check_run_profile(run_profile: dict, timeframe: str, n_pairs: int) -> str | None:
+    """
+    Checks that a run profile was measured in conditions comparable to a run: on the same timeframe and number of CPUs, and on a number of pairs
+    within max_profile_pairs_ratio of the run's, since the best number of workers and batching depend on the number and size of the tasks.
+
+    Returns:
+        str | None: Why the profile doesn't apply to the run, or None if it does
+    """
+    if run_profile.get('timeframe') != timeframe:
+        return f'it was calibrated on the {run_profile.get("timeframe")} timeframe, not {timeframe}'
+    if run_profile.get('cpu_count') != os.cpu_count():
+        return f'it was calibrated with {run_profile.get("cpu_count")} CPUs, not {os.cpu_count()}'
+
+    profile_n_pairs = run_profile.get('n_pairs') or 0
+    if not profile_n_pairs / max_profile_pairs_ratio <= n_pairs <= profile_n_pairs * max_profile_pairs_ratio:
+        return f'it was calibrated on {profile_n_pairs} pairs, not comparable to {n_pairs}'
+
+    return None
+
+
+def apply_run_profile(config: Config, n_pairs: int, mean_pair_candles: float) -> Config:
+    """
+    Returns a copy of the configuration with the execution settings of its run profile, for the pair-level parallel runs of main_param_opt.py
+    which calibrate.py measures. The minimum number of candles per task is stored in the profile relative to the mean size of the pairs, and is
+    scaled to the mean size of the pairs of the run. If the profile doesn't apply to the run, it's ignored with a warning and the configuration is
+    returned as is.
+    """
+    if not config.run_profile:
+        return config
+
+    mismatch = check_run_profile(config.run_profile, config.timeframe, n_pairs)
+    if mismatch is not None:
+        print(f'Ignoring the run profile {run_profile_path}, since {mismatch}. Run calibrate.py again to calibrate this run.')
+        return config
+
+    profiled_config = copy.copy(config)
+    if 'processes' in config.run_profile:
+        profiled_config.max_processes = int(config.run_profile['processes'])
+    if 'executor' in config.run_profile:
+        profiled_config.executor_type = config.run_profile['executor']
+    if 'chunksize' in config.run_profile:
+        profiled_config.task_chunksize = int(config.run_profile['chunksize'])
+    if 'min_task_pairs' in config.run_profile:
+        profiled_config.min_task_candles = round(float(config.run_profile['min_task_pairs']) * mean_pair_candles)
+
+    print(f'Using the run profile {run_profile_path}: {profiled_config.executor_type}, {profiled_config.max_processes} workers, chunksize '
+          f'{profiled_config.task_chunksize}, min {profiled_config.min_task_candles} candles per task')
+    return profiled_config
+
+
+def load_config(argv: list[str] | None = None, params_path: str = '.env.params', profile_path: str = run_profile_path) -> Config:
+    """
+    Parses the command line arguments (sys.argv if argv is None), the params file and the run profile into a new Config.
+    """
+    return Config(parser.parse_args(argv), dotenv_values(params_path), load_run_profile(profile_path))
+
+
+def get_config() -> Config:
+    # The configuration of this process, loading it on the first call
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
 
-    @classmethod
-    def set_pair_name(cls, pair_name: str):
-        cls._pair_name = pair_name
 
-    @classmethod
-    def get_pair_name(cls) -> str:
-        return cls._pair_name
+def set_config(config: Config):
+    # Sets the configuration of this process, e.g. in a worker process to the configuration of the main process
+    global _config
+    _config = config
@@ -2,6 +2,8 @@ from typing import NamedTuple
 
 import pandas as pd
 
+from utils.time_index import PairTimeIndex
+
 
 class TypedDataFrame(pd.DataFrame):
     @property
@@ -14,10 +16,28 @@ class TypedDataFrame(pd.DataFrame):
 
 
 class PairDf(TypedDataFrame):
+    # The time index and the detection store fingerprint are carried along by pandas operations which return a new PairDf, such as reset_index()
+    _metadata = ['_time_index', '_fingerprint']
+
+    @property
+    def _constructor(self):
+        return PairDf
+
     @property
     def time(self) -> pd.Series:
         return self['time']
 
+    @property
+    def time_index(self) -> PairTimeIndex:
+        # Built once per loaded pair, and rebuilt if the frame it was carried over to doesn't have the same candles.
+        time_index: PairTimeIndex | None = getattr(self, '_time_index', None)
+        if time_index is None or len(time_index) != len(self) or \
+                (len(self) and time_index.epochs[0] != pd.Timestamp(self['time'].iloc[0]).value):
+            time_index = PairTimeIndex.from_times(self['time'])
+            object.__setattr__(self, '_time_index', time_index)
+
+        return time_index
+
     @property
     def high(self) -> pd.Series:
         return self['high']
@@ -1,42 +1,223 @@
+import json
 import numpy as np
 import pandas as pd
 import os
+import tempfile
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 
 import utils.datatypes as dt
 from utils import constants
+from utils.config import Config, get_config, set_config
+from utils.logger import LoggerSingleton
+from utils.resample import find_base_timeframe, get_derived_path
 
 
-def load_local_data(pair_name: str = "BTCUSDT", timeframe: str = "15m") -> dt.PairDf:
+def load_local_data(pair_name: str = "BTCUSDT",
+                    timeframe: str = "15m",
+                    start: str | pd.Timestamp | None = None,
+                    end: str | pd.Timestamp | None = None,
+                    columns: list[str] | None = None) -> dt.PairDf:
     """
-    Imports the .hdf5 files associated with the indicated pair in the give timeframe.
+    Imports the .hdf5 files associated with the indicated pair in the give timeframe. Optionally, only the candles within a date range and only a
+    subset of the columns are read. The date range is pushed down to the storage layer: table-format files are queried with a "where" condition on
+    the time column, and other files are read by row offsets found through a cached index of the candle times, so the candles out of range are
+    never read.
+
+    If the timeframe isn't cached for the pair, its candles are derived from the finest cached timeframe of the pair it can be derived from (see
+    utils/resample.py). The derived candles are cached as well, and only derived again when the file they were derived from changes.
 
     Args:
         pair_name (str): The symbol of the pair to load
         timeframe (str): Standardized timeframe
+        start (str | pd.Timestamp | None): The time of the first candle to load (inclusive). Naive times are taken as UTC.
+        end (str | pd.Timestamp | None): The time to load the candles up to (exclusive). Naive times are taken as UTC.
+        columns (list[str] | None): The columns to load. The time column is always loaded.
 
     Returns:
         pd.DataFrame: A dataframe containing all the OHLC data of the give pair
 
     """
-    hdf_path: str = f"./cached_data/{timeframe}/{pair_name}.hdf5"
+    hdf_path = get_pair_data_path(pair_name, timeframe)
+
+    start = to_utc_timestamp(start)
+    end = to_utc_timestamp(end)
+    if columns is not None and 'time' not in columns:
+        columns = ['time'] + list(columns)
+
+    with pd.HDFStore(hdf_path, mode='r') as store:
+        key = store.keys()[0]
+        storer = store.get_storer(key)
+
+        select_kwargs = {}
+        if storer.is_table:
+            select_kwargs['columns'] = columns
+
+        if start is not None or end is not None:
+            if storer.is_table and 'time' in storer.queryables():
+                conditions = []
+                if start is not None:
+                    conditions.append(f"time >= '{start.isoformat()}'")
+                if end is not None:
+                    conditions.append(f"time < '{end.isoformat()}'")
+                select_kwargs['where'] = ' & '.join(conditions)
+            else:
+                select_kwargs['start'], select_kwargs['stop'] = get_row_range(hdf_path, store, key, start, end)
+
+        pair_df = pd.DataFrame(store.select(key, **select_kwargs))
+
+    # Fixed-format files can't be read by column, so the projection is applied after reading.
+    if columns is not None and not storer.is_table:
+        pair_df = pair_df[columns]
+
+    # PDIs are positional, so partially loaded data is re-indexed from 0.
+    if start is not None or end is not None:
+        pair_df = pair_df.reset_index(drop=True)
+
+    pair_df = dt.PairDf(pair_df)
+
+    # Build the time index of the pair once, at load time
+    _ = pair_df.time_index
+
+    return pair_df
+
+
+def get_pair_data_path(pair_name: str, timeframe: str) -> str:
+    # The cached file of the pair in the timeframe, or the file of its derived candles if the timeframe isn't cached
+    hdf_path = f"./cached_data/{timeframe}/{pair_name}.hdf5"
+    if not os.path.exists(hdf_path):
+        hdf_path = get_derived_path(pair_name, timeframe) or hdf_path
+
+    return hdf_path
+
+
+def to_utc_timestamp(time: str | pd.Timestamp | None) -> pd.Timestamp | None:
+    if time is None:
+        return None
+
+    time = pd.Timestamp(time)
+    return time.tz_localize('UTC') if time.tz is None else time
+
+
+def get_row_range(hdf_path: str, store: pd.HDFStore, key: str, start: pd.Timestamp | None, end: pd.Timestamp | None) -> tuple[int, int]:
+    """
+    Finds the row offsets of the candles between start (inclusive) and end (exclusive) in a cached pair file, using an index of its candle times.
+
+    Returns:
+        tuple[int, int]: The start and stop row offsets
+    """
+    times = get_time_offsets_index(hdf_path, store, key)
+
+    start_row = int(np.searchsorted(times, start.value, side='left')) if start is not None else 0
+    stop_row = int(np.searchsorted(times, end.value, side='left')) if end is not None else len(times)
+
+    return start_row, stop_row
+
+
+# The sidecar arrays of the cached pair files opened by this process, by path, with the fingerprint of the file they were built from
+_sidecar_arrays: dict[str, tuple[dict, np.ndarray]] = {}
+
+
+def get_sidecar_array(hdf_path: str, name: str, build_array, store: pd.HDFStore | None = None, key: str | None = None) -> np.ndarray:
+    """
+    Returns an array derived from a cached pair file, stored next to it as <pair>.<name>.npy with a <pair>.<name>.json fingerprint of the file
+    (its size and modification time), and rebuilt by build_array(store, key) whenever the file is modified. The file is only opened to rebuild the
+    array, unless an open store is given.
+
+    The array is memory-mapped read-only, so only the parts of it which are read are loaded, and is kept open for the later calls of this process
+    as long as the file isn't modified.
+    """
+    array_path = hdf_path.replace('.hdf5', f'.{name}.npy')
+    fingerprint_path = hdf_path.replace('.hdf5', f'.{name}.json')
+    file_stat = os.stat(hdf_path)
+    fingerprint = {'mtime_ns': file_stat.st_mtime_ns, 'size': file_stat.st_size}
+
+    cached_fingerprint, array = _sidecar_arrays.get(array_path, (None, None))
+    if cached_fingerprint == fingerprint:
+        return array
+
+    try:
+        with open(fingerprint_path) as fingerprint_file:
+            if json.load(fingerprint_file) == fingerprint:
+                array = np.load(array_path, mmap_mode='r')
+                _sidecar_arrays[array_path] = (fingerprint, array)
+                return array
+    except (FileNotFoundError, json.JSONDecodeError, ValueError):
+        pass
+
+    if store is None:
+        with pd.HDFStore(hdf_path, mode='r') as store:
+            built_array = build_array(store, store.keys()[0])
+    else:
+        built_array = build_array(store, key)
+
+    # Written to temporary files which are then renamed, so concurrent processes never read a partial file. The fingerprint is written last, so
+    # an interrupted write is rebuilt by the next run.
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(hdf_path), suffix='.tmp')
+    os.close(file_descriptor)
+    try:
+        with open(temp_path, 'wb') as array_file:
+            np.save(array_file, built_array)
+        os.replace(temp_path, array_path)
+
+        with open(temp_path, 'w') as fingerprint_file:
+            json.dump(fingerprint, fingerprint_file)
+        os.replace(temp_path, fingerprint_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
-    pair_df = pd.DataFrame(pd.read_hdf(hdf_path))
+    array = np.load(array_path, mmap_mode='r')
+    _sidecar_arrays[array_path] = (fingerprint, array)
+    return array
 
-    return dt.PairDf(pair_df)
+
+def get_time_offsets_index(hdf_path: str, store: pd.HDFStore | None = None, key: str | None = None) -> np.ndarray:
+    """
+    Returns the times of the candles of a cached pair file as int64 epoch nanoseconds, whose positions are the row offsets of the candles. The index
+    is a memory-mapped .times.npy file next to the file (see get_sidecar_array), so finding the rows of a few times only reads a few pages of it.
+    """
+    def build_times(store: pd.HDFStore, key: str) -> np.ndarray:
+        select_kwargs = {'columns': ['time']} if store.get_storer(key).is_table else {}
+        return pd.DatetimeIndex(store.select(key, **select_kwargs)['time']).as_unit('ns').asi8
+
+    return get_sidecar_array(hdf_path, 'times', build_times, store, key)
+
+
+def get_high_low_array(hdf_path: str, store: pd.HDFStore | None = None, key: str | None = None) -> np.ndarray:
+    """
+    Returns the highs and lows of the candles of a cached pair file as a read-only, memory-mapped (n_candles, 2) array, whose row positions are the
+    row offsets of the candles like in the index of get_time_offsets_index. Any rows can then be read without reading the rest of the file, which
+    fixed-format files can't do: they're read by whole row ranges, unpickling their object columns. The array is a .highlow.npy file next to the
+    file (see get_sidecar_array).
+    """
+    def build_high_low(store: pd.HDFStore, key: str) -> np.ndarray:
+        select_kwargs = {'columns': ['high', 'low']} if store.get_storer(key).is_table else {}
+        high_low_df = store.select(key, **select_kwargs)
+        return np.column_stack([high_low_df['high'].to_numpy(dtype=np.float64), high_low_df['low'].to_numpy(dtype=np.float64)])
+
+    return get_sidecar_array(hdf_path, 'highlow', build_high_low, store, key)
 
 
 def get_pair_list(timeframe: str = '15m'):
-    # Get the pairs in cached_data/<timeframe> folder, or, if given, the pair list given through the --pl runtime argument
+    # Get the pairs in cached_data/<timeframe> folder, or, if given, the pair list given through the --pl runtime argument. If the timeframe isn't
+    # cached, the pairs whose candles can be derived from a finer cached timeframe are used.
     if constants.pair_list_filename:
         pair_list = pd.read_csv(f'./{constants.pair_list_filename}', header=None)[0].tolist()
         print(f'Running on {len(pair_list)} pairs')
         return pair_list
 
     pair_list = []
-    for file in os.listdir(f'./cached_data/{timeframe}'):
+    for file in os.listdir(f'./cached_data/{timeframe}') if os.path.isdir(f'./cached_data/{timeframe}') else []:
         if file.endswith(".hdf5"):
             pair_list.append(file.replace('.hdf5', ''))
 
+    if not pair_list:
+        # The pairs cached in any timeframe, which have a cached timeframe the timeframe can be derived from
+        cached_pairs = {file.replace('.hdf5', '')
+                        for base_timeframe in os.listdir('./cached_data') if os.path.isdir(f'./cached_data/{base_timeframe}')
+                        for file in os.listdir(f'./cached_data/{base_timeframe}') if file.endswith(".hdf5")}
+        pair_list = sorted(pair_name for pair_name in cached_pairs if find_base_timeframe(pair_name, timeframe) is not None)
+
     print(f'Running on {len(pair_list)} pairs')
     return pair_list
 
@@ -77,3 +258,36 @@ def format_time(seconds):
     hours, remainder = divmod(seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
     return f"{int(hours):02}:{int(minutes):02}:{int(seconds):02}"
+
+
+def get_executor(max_workers: int, executor_type: str = 'processes', initializer=None, initargs: tuple = ()) -> Executor:
+    """
+    Creates the executor used to run the tasks of the parameter optimization in parallel.
+
+    Args:
+        max_workers (int): The number of worker threads or processes
+        executor_type (str): "threads" runs the tasks in threads of this process, which share the data without pickling it and scale as long as the
+            tasks spend their time in NumPy calls releasing the GIL. "processes" runs the tasks in separate processes.
+        initializer: Called once by each worker before running any tasks
+        initargs (tuple): The arguments of initializer
+
+    Returns:
+        Executor: The executor
+    """
+    if executor_type == 'threads':
+        return ThreadPoolExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs)
+    elif executor_type == 'processes':
+        # The worker processes take the configuration of the main process instead of parsing it again, and push their log records onto the queue
+        # of the main process, before running the initializer
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker_process,
+                                   initargs=(get_config(), LoggerSingleton.get_process_config(), initializer, initargs))
+
+    raise ValueError(f'Unknown executor type "{executor_type}", expected "threads" or "processes"')
+
+
+def init_worker_process(config: Config, logging_config: tuple, initializer=None, initargs: tuple = ()):
+    # Sets up the configuration and the logging of a worker process, then runs the initializer of the executor, if any
+    set_config(config)
+    LoggerSingleton.configure_process(*logging_config)
+    if initializer is not None:
+        initializer(*initargs)
@@ -1,9 +1,118 @@
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
 from datetime import datetime
 
 
+class PairFileHandler(logging.Handler):
+    """
+    Writes each record to the log file of its logger and pair, e.g. ./logs/ob_logger_<timestamp>-BTCUSDT.log. The files are opened the first time
+    a pair logs something and are kept open until the handler is closed, instead of reopening a file every time the pair changes.
+    """
+
+    def __init__(self, log_dir: str = './logs'):
+        super().__init__()
+        self.log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        self.timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.file_handlers: dict[tuple[str, str], logging.FileHandler] = {}
+
+    def emit(self, record: logging.LogRecord):
+        # A record which can't be written is reported by handleError instead of raising, which would kill the listener thread and leave the
+        # processes logging with nobody emptying the queue
+        try:
+            pair_name = getattr(record, 'pair_name', None)
+            file_handler = self.file_handlers.get((record.name, pair_name))
+            if file_handler is None:
+                file_handler = logging.FileHandler(f"{self.log_dir}/{record.name}_{self.timestamp}-{pair_name}.log")
+                file_handler.setFormatter(logging.Formatter('%(message)s'))
+                self.file_handlers[(record.name, pair_name)] = file_handler
+
+            file_handler.emit(record)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for file_handler in self.file_handlers.values():
+            file_handler.close()
+        self.file_handlers.clear()
+        super().close()
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler which never blocks the process logging: if the (bounded) queue is full because the listener can't keep up, the record is dropped
+    and counted instead. The count is a multiprocessing.Value shared by all the processes logging onto the queue, so the main process can report
+    the records dropped by the workers too.
+    """
+
+    def __init__(self, log_queue, dropped_records):
+        super().__init__(log_queue)
+        self.dropped_records = dropped_records
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_records.get_lock():
+                self.dropped_records.value += 1
+
+
+class BoundedQueueListener(logging.handlers.QueueListener):
+    """
+    A QueueListener for a bounded queue which stops within a timeout. QueueListener.stop pushes its sentinel with put_nowait, which fails while the
+    queue is full, and then waits for the listener thread without a timeout.
+    """
+
+    def __init__(self, log_queue, *handlers, stop_timeout: float = 10):
+        super().__init__(log_queue, *handlers)
+        self.stop_timeout = stop_timeout
+
+    def enqueue_sentinel(self):
+        # Waits for the listener to make room for the sentinel, unless the listener thread is gone
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                self.queue.put(self._sentinel, timeout=self.stop_timeout)
+            except queue.Full:
+                pass
+
+    def stop(self):
+        if self._thread is not None:
+            self.enqueue_sentinel()
+            self._thread.join(self.stop_timeout)
+            self._thread = None
+
+
+class PairNameFilter(logging.Filter):
+    # Stamps the records logged without a pair name (i.e. not through a pair logger) with the pair name set by LoggerSingleton.update_pair_name.
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'pair_name'):
+            record.pair_name = LoggerSingleton._pair_name
+        return True
+
+
 class LoggerSingleton:
+    """
+    The loggers of the project. The records of all the processes are pushed onto a single bounded multiprocessing queue by a BoundedQueueHandler,
+    and a QueueListener in the main process writes them to a log file per pair, so the processes logging never wait on disk I/O.
+
+    Logging is disabled unless start_logging is called with a level. While disabled, the loggers have no handlers and their level is above
+    CRITICAL, so a logging call (or an isEnabledFor check guarding an expensive one) returns immediately.
+    """
     _loggers = {}
+    _pair_name = None
+
+    # The level of the loggers, the queue the records are pushed onto, the count of the records dropped by all the processes and the handler
+    # pushing them, in this process
+    _level = logging.CRITICAL + 1
+    _queue = None
+    _dropped_records = None
+    _queue_handler: BoundedQueueHandler | None = None
+
+    # The listener writing the records of all the processes, only in the main process
+    _listener: BoundedQueueListener | None = None
 
     @classmethod
     def get_logger(cls, name: str):
@@ -14,25 +123,84 @@ class LoggerSingleton:
     @classmethod
     def _create_logger(cls, name: str):
         logger = logging.getLogger(name)
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(cls._level)
+        logger.propagate = False
+        logger.addFilter(PairNameFilter())
+        if cls._queue_handler is not None:
+            logger.addHandler(cls._queue_handler)
         return logger
 
+    @classmethod
+    def get_pair_logger(cls, name: str, pair_name: str) -> logging.LoggerAdapter:
+        # A logger whose records are written to the log file of the given pair. Safe to use from several threads processing different pairs.
+        return logging.LoggerAdapter(cls.get_logger(name), {'pair_name': pair_name})
+
     @classmethod
     def update_pair_name(cls, name: str, pair_name: str):
-        logger = cls.get_logger(name)
-        # Remove existing file handlers
-        for handler in logger.handlers[:]:
-            if isinstance(handler, logging.FileHandler):
+        # Sets the pair the records of this process are written for, if they're not logged through a pair logger.
+        cls.get_logger(name)
+        cls._pair_name = pair_name
+
+    @classmethod
+    def configure_process(cls, log_queue, level: int, dropped_records=None):
+        """
+        Makes the loggers of this process push their records onto the given queue, counting the records dropped while it's full in the shared
+        dropped_records value. Called in the main process by start_logging and in each worker process with the values of get_process_config.
+        """
+        cls._level = level
+        cls._queue = log_queue
+        cls._dropped_records = dropped_records
+        cls._queue_handler = BoundedQueueHandler(log_queue, dropped_records) if log_queue is not None else None
+
+        for logger in cls._loggers.values():
+            logger.setLevel(level)
+            for handler in logger.handlers[:]:
                 logger.removeHandler(handler)
-                handler.close()
+            if cls._queue_handler is not None:
+                logger.addHandler(cls._queue_handler)
+
+    @classmethod
+    def get_process_config(cls) -> tuple:
+        # The arguments of configure_process for the worker processes
+        return cls._queue, cls._level, cls._dropped_records
+
+    @classmethod
+    def start_logging(cls, level: str | None, max_queued_records: int = 10000):
+        """
+        Starts the listener writing the records of all the processes to the per-pair log files.
+
+        Args:
+            level (str | None): The name of the lowest level to log, e.g. "DEBUG". If None, logging stays disabled.
+            max_queued_records (int): The number of records the queue buffers before new records are dropped
+        """
+        if level is None:
+            return
+
+        log_queue = multiprocessing.Queue(maxsize=max_queued_records)
+        cls._listener = BoundedQueueListener(log_queue, PairFileHandler())
+        cls._listener.start()
+
+        cls.configure_process(log_queue, logging.getLevelNamesMapping()[level.upper()], multiprocessing.Value('q', 0))
+
+    @classmethod
+    def stop_logging(cls):
+        # Writes the remaining records, closes the log files and disables logging in this process
+        if cls._listener is None:
+            return
+
+        cls._listener.stop()
+        for handler in cls._listener.handlers:
+            handler.close()
+        cls._listener = None
 
-        # Create a new file handler with the updated pair_name
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        log_filename = f"./logs/{name}_{timestamp}-{pair_name}.log"
-        file_handler = logging.FileHandler(log_filename)
-        file_handler.setLevel(logging.DEBUG)
+        # The records dropped by this process and all the workers, which have all finished by now
+        dropped_records = cls._dropped_records.value if cls._dropped_records is not None else 0
+        log_queue = cls._queue
+        cls.configure_process(None, logging.CRITICAL + 1)
 
-        formatter = logging.Formatter('%(message)s')
-        file_handler.setFormatter(formatter)
+        # Records still buffered in this process are discarded at exit instead of waiting for room in a queue nobody reads anymore
+        log_queue.close()
+        log_queue.cancel_join_thread()
 
-        logger.addHandler(file_handler)
+        if dropped_records:
+            print(f'{dropped_records} log records were dropped because the log queue was full.')
@@ -0,0 +1,147 @@
+from collections import deque
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from typing import Callable
+
+from utils.telemetry import get_pss_bytes
+
+
+class MemoryBudget(Executor):
+    """
+    Keeps the memory used by a parameter sweep under a budget by adapting the number of workers. The tasks report the PSS of their worker when they
+    finish (see utils.telemetry.run_measured_task), and the total PSS of the main process and the workers, which doesn't count the pages they share
+    more than once, is checked after each task: above the budget, one worker less is used, down to one, and when one more worker would still keep
+    it below low_watermark of the budget, one more is used, up to max_concurrency.
+
+    The budget owns the executor it runs the tasks on, created by create_executor with the number of workers. When the number of workers changes,
+    no more tasks are handed out until the running ones finish, then the executor is shut down and created again with the new number of workers,
+    so the memory held by the idle workers is released. Since the tasks are handed to the executor as the workers free up instead of all at once,
+    the data of the tasks waiting doesn't sit in the executor's queue either.
+    """
+
+    def __init__(self, budget_mb: float, max_concurrency: int, create_executor: Callable[[int], Executor], shared_process: bool = False,
+                 low_watermark: float = 0.8):
+        """
+        Args:
+            budget_mb (float): The memory budget, in MB
+            max_concurrency (int): The maximum number of workers
+            create_executor (Callable[[int], Executor]): Creates an executor with the given number of workers
+            shared_process (bool): Whether the workers are threads of the main process, whose PSS is then the PSS of the main process
+            low_watermark (float): The fraction of the budget below which the number of workers grows again
+        """
+        self.budget_bytes = budget_mb * 2 ** 20
+        self.max_concurrency = max_concurrency
+        self.create_executor = create_executor
+        self.shared_process = shared_process
+        self.low_watermark = low_watermark
+
+        self.concurrency = max_concurrency
+        self.worker_pss_bytes: dict[str, int] = {}
+
+        # The executor and its number of workers, created when the first task is submitted
+        self.executor: Executor | None = None
+        self.executor_workers = 0
+        self.warned_over_budget = False
+
+    def get_total_pss_bytes(self) -> int | None:
+        main_pss_bytes = get_pss_bytes()
+        if main_pss_bytes is None or self.shared_process:
+            return main_pss_bytes
+        return main_pss_bytes + sum(self.worker_pss_bytes.values())
+
+    def update(self, task_stats: dict):
+        # Adapts the number of workers to the PSS reported with a finished task. While the executor is waiting to be resized, the workers of the
+        # old executor are still running, so the memory isn't checked again until the new one is measured. Until every worker of a process pool
+        # has reported, the total is a lower bound, which is enough to shrink the pool but not to grow it.
+        if task_stats['pss_bytes'] is not None:
+            self.worker_pss_bytes[task_stats['worker_id']] = task_stats['pss_bytes']
+
+        total_pss_bytes = self.get_total_pss_bytes()
+        if total_pss_bytes is None or self.executor_workers != self.concurrency:
+            return
+        all_workers_measured = self.shared_process or len(self.worker_pss_bytes) >= self.executor_workers
+
+        # The pool only grows if the total with one more worker, using as much as the current ones on average, stays below the low watermark
+        grown_pss_bytes = total_pss_bytes
+        if not self.shared_process and self.worker_pss_bytes:
+            grown_pss_bytes += sum(self.worker_pss_bytes.values()) / len(self.worker_pss_bytes)
+
+        previous_concurrency = self.concurrency
+        if total_pss_bytes > self.budget_bytes:
+            self.concurrency = max(self.concurrency - 1, 1)
+        elif grown_pss_bytes < self.budget_bytes * self.low_watermark and all_workers_measured:
+            self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+
+        if self.concurrency != previous_concurrency:
+            print(f'Memory budget: {total_pss_bytes / 2 ** 20:,.0f} / {self.budget_bytes / 2 ** 20:,.0f} MB used, resizing to {self.concurrency} '
+                  f'workers')
+        elif total_pss_bytes > self.budget_bytes and not self.warned_over_budget:
+            # A single worker is already over the budget, which can't be met by running fewer tasks at once
+            self.warned_over_budget = True
+            print(f'WARNING: Memory budget: {total_pss_bytes / 2 ** 20:,.0f} MB used by the main process and a single worker, over the budget '
+                  f'of {self.budget_bytes / 2 ** 20:,.0f} MB. Raise --memory_budget, or run on fewer pairs or a shorter date range.')
+
+    def resize_executor(self):
+        # Replaces the executor with one of self.concurrency workers. Only called while no task is running.
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.executor = self.create_executor(self.concurrency)
+        self.executor_workers = self.concurrency
+        self.worker_pss_bytes = {}
+
+    def submit(self, function, /, *args, **kwargs):
+        if self.executor is None:
+            self.resize_executor()
+        return self.executor.submit(function, *args, **kwargs)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+            self.executor = None
+            self.executor_workers = 0
+
+    def map(self, function, *iterables, timeout=None, chunksize=1):
+        """
+        Like Executor.map, but only hands as many tasks to the executor at once as it has workers, and resizes the executor between the tasks when
+        the budget requires it. The function must return its result with the statistics of the task, like utils.telemetry.run_measured_task. The
+        results are yielded in the order of the arguments. timeout and chunksize are ignored.
+        """
+        arguments = zip(*iterables)
+        futures = deque()
+        n_running = 0
+        arguments_left = True
+
+        # The tasks whose PSS was taken into account, which may finish before the tasks before them are yielded
+        updated_futures = set()
+
+        while arguments_left or futures:
+            # The executor is resized once the tasks running on the old one have finished
+            if n_running == 0 and arguments_left and self.executor_workers != self.concurrency:
+                self.resize_executor()
+
+            while arguments_left and self.executor_workers == self.concurrency and n_running < self.concurrency:
+                task_arguments = next(arguments, None)
+                if task_arguments is None:
+                    arguments_left = False
+                    break
+
+                futures.append(self.executor.submit(function, *task_arguments))
+                n_running += 1
+
+            # Wait for a task to finish, then adapt the number of workers to the PSS reported by the tasks finished since
+            running_futures = [future for future in futures if not future.done()]
+            if running_futures:
+                wait(running_futures, return_when=FIRST_COMPLETED)
+
+            n_running = 0
+            for future in futures:
+                if not future.done():
+                    n_running += 1
+                elif future not in updated_futures:
+                    updated_futures.add(future)
+                    if future.exception() is None:
+                        self.update(future.result()[1])
+
+            while futures and futures[0].done():
+                future = futures.popleft()
+                updated_futures.discard(future)
+                yield future.result()
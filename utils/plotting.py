@@ -1,10 +1,155 @@
-from typing import Any
+from typing import Any, Optional
 
+import numpy as np
+import pandas as pd
 from lightweight_charts import Chart
+from lightweight_charts.abstract import Line
 from lightweight_charts.drawings import TwoPointDrawing
 
 import utils.datatypes as dt
 from algo_code.order_block import OrderBlock
+from utils.time_index import PairTimeIndex
+
+
+class OrderBlockIntervalIndex:
+    """
+    A static, centered interval tree over the lifetimes (formation_pdi..end_pdi) of a list of order blocks. Order blocks which haven't been closed
+    by a newer order block (end_pdi == -1) live until the last candle of the chart.
+
+    Querying the order blocks which overlap a range of PDIs costs O(log n + k), where k is the number of order blocks returned, instead of a full
+    scan of the order block list on every range change of the chart.
+    """
+
+    def __init__(self, order_blocks: list[OrderBlock], last_pdi: int):
+        self.order_blocks: dict[str, OrderBlock] = {ob.id: ob for ob in order_blocks}
+
+        ob_ids = list(self.order_blocks.keys())
+        starts = np.array([ob.formation_pdi for ob in self.order_blocks.values()], dtype=np.int64)
+        ends = np.array([ob.end_pdi if ob.end_pdi != -1 else last_pdi for ob in self.order_blocks.values()], dtype=np.int64)
+
+        # Sorted start PDIs, used for finding the order blocks which start within a range using binary search.
+        start_order = np.argsort(starts, kind='stable')
+        self._sorted_starts = starts[start_order]
+        self._ids_by_start = [ob_ids[i] for i in start_order]
+
+        # The tree itself, used for finding the order blocks which are alive at the start of the range (stabbing query).
+        self._root = self._build(ob_ids, starts, ends, np.arange(len(ob_ids)))
+
+    def _build(self, ob_ids: list[str], starts: np.ndarray, ends: np.ndarray, members: np.ndarray) -> Optional[dict]:
+        if len(members) == 0:
+            return None
+
+        center = int(np.median(np.concatenate((starts[members], ends[members]))))
+
+        left_members = members[ends[members] < center]
+        right_members = members[starts[members] > center]
+        center_members = members[(starts[members] <= center) & (ends[members] >= center)]
+
+        # The intervals containing the center are kept twice: sorted by start ascending and sorted by end descending, so a stabbing query can stop
+        # scanning as soon as it reaches the first interval not containing the query point.
+        by_start = center_members[np.argsort(starts[center_members], kind='stable')]
+        by_end = center_members[np.argsort(-ends[center_members], kind='stable')]
+
+        return {
+            'center': center,
+            'by_start': [(int(starts[i]), ob_ids[i]) for i in by_start],
+            'by_end': [(int(ends[i]), ob_ids[i]) for i in by_end],
+            'left': self._build(ob_ids, starts, ends, left_members),
+            'right': self._build(ob_ids, starts, ends, right_members),
+        }
+
+    def _stab(self, pdi: int) -> list[str]:
+        # Returns the IDs of the order blocks whose lifetime contains the given PDI.
+        found = []
+        node = self._root
+        while node is not None:
+            if pdi < node['center']:
+                for start, ob_id in node['by_start']:
+                    if start > pdi:
+                        break
+                    found.append(ob_id)
+                node = node['left']
+            elif pdi > node['center']:
+                for end, ob_id in node['by_end']:
+                    if end < pdi:
+                        break
+                    found.append(ob_id)
+                node = node['right']
+            else:
+                found.extend(ob_id for _, ob_id in node['by_start'])
+                break
+
+        return found
+
+    def query(self, first_pdi: int, last_pdi: int) -> set[str]:
+        """
+        Finds the order blocks whose lifetimes overlap the given range of PDIs.
+
+        Args:
+            first_pdi (int): The first PDI of the range
+            last_pdi (int): The last PDI of the range
+
+        Returns:
+            set[str]: The IDs of the overlapping order blocks
+        """
+
+        # An order block overlaps the range if it is alive at the start of the range, or if it starts within the range.
+        lo = np.searchsorted(self._sorted_starts, first_pdi, side='left')
+        hi = np.searchsorted(self._sorted_starts, last_pdi, side='right')
+
+        ob_ids_in_range = set(self._ids_by_start[lo:hi])
+        ob_ids_in_range.update(self._stab(first_pdi))
+
+        return ob_ids_in_range
+
+
+class CandleLevelOfDetail:
+    """
+    Pre-aggregated OHLC candles of a pair at coarser resolutions. The candles of the level with factor f are formed by aggregating every f
+    consecutive candles of pair_df, so the candle at index i of that level covers the PDIs i * f through (i + 1) * f - 1, and carries the time of
+    its first candle. Factor 1 is the native pair_df. The aggregates are calculated once per factor and cached.
+    """
+
+    def __init__(self, pair_df: dt.PairDf, factor_base: int = 4, max_displayed_bars: int = 5000):
+        self.pair_df = pair_df
+        self.factor_base = factor_base
+        self.max_displayed_bars = max_displayed_bars
+
+        self._levels: dict[int, pd.DataFrame] = {}
+
+    def choose_factor(self, n_candles: int) -> int:
+        # The smallest factor (a power of factor_base) at which n_candles native candles fit in max_displayed_bars bars
+        factor = 1
+        while n_candles / factor > self.max_displayed_bars:
+            factor *= self.factor_base
+
+        return factor
+
+    def get_level(self, factor: int) -> pd.DataFrame:
+        if factor not in self._levels:
+            self._levels[factor] = self._aggregate(factor)
+
+        return self._levels[factor]
+
+    def _aggregate(self, factor: int) -> pd.DataFrame:
+        if factor == 1:
+            return pd.DataFrame(self.pair_df[[column for column in ['time', 'open', 'high', 'low', 'close', 'volume'] if column in self.pair_df]])
+
+        # The start index of each group of factor candles, used with the reduceat functions to aggregate the groups in one vectorized call.
+        group_starts = np.arange(0, len(self.pair_df), factor)
+        group_ends = np.minimum(group_starts + factor, len(self.pair_df)) - 1
+
+        level_df = pd.DataFrame({
+            'time': self.pair_df.time_index.to_timestamps(group_starts),
+            'open': self.pair_df.open.to_numpy()[group_starts],
+            'high': np.maximum.reduceat(self.pair_df.high.to_numpy(), group_starts),
+            'low': np.minimum.reduceat(self.pair_df.low.to_numpy(), group_starts),
+            'close': self.pair_df.close.to_numpy()[group_ends],
+        })
+        if 'volume' in self.pair_df:
+            level_df['volume'] = np.add.reduceat(self.pair_df['volume'].to_numpy(), group_starts)
+
+        return level_df
 
 
 class PlottingTool:
@@ -13,110 +158,183 @@ class PlottingTool:
         self.chart.legend(visible=True, ohlc=True, color_based_on_candle=True, font_size=15)
 
         self.pair_df: dt.PairDf | None = None
+        self.time_index: PairTimeIndex | None = None
 
-        self.ob_drawings: list[dict[str, TwoPointDrawing | str | Any]] = []
-
-    def register_msb_point_updates(self, msb_points_df: dt.MSBPointsDf):
-        # Subscribe to the event of the chart's range change
-        self.chart.events.range_change += lambda chart, bars_before, bars_after: self.update_msb_points_on_range_change(chart,
-                                                                                                                        bars_before,
-                                                                                                                        bars_after,
-                                                                                                                        msb_points_df)
+        # The level of detail of the displayed candles. The chart displays the candles of level lod_factor from index lod_window[0] up to (but not
+        # including) lod_window[1].
+        self.lod: CandleLevelOfDetail | None = None
+        self.lod_factor: int = 1
+        self.lod_window: tuple[int, int] = (0, 0)
 
-    def register_ob_updates(self, order_blocks: list[OrderBlock]):
-        self.chart.events.range_change += lambda chart, bars_before, bars_after: self.update_order_blocks_on_range_change(chart,
-                                                                                                                          bars_before,
-                                                                                                                          bars_after,
-                                                                                                                          order_blocks)
-
-    def update_msb_points_on_range_change(self, chart, bars_before, bars_after, msb_points_df: dt.MSBPointsDf):
-        if bars_before < 0:
-            first_bar_pdi = self.pair_df.iloc[0].name
-        else:
-            first_bar_pdi = self.pair_df.iloc[int(bars_before)].name
+        # Drawn order blocks, keyed by the ID of the order block
+        self.ob_drawings: dict[str, dict[str, TwoPointDrawing | str | Any]] = {}
+        self.ob_index: OrderBlockIntervalIndex | None = None
 
-        if bars_after < 0:
-            last_bar_pdi = self.pair_df.iloc[-1].name
-        else:
-            last_bar_pdi = self.pair_df.iloc[-int(bars_after)].name
+        # MSB points sorted by their PDI, and the markers drawn for them keyed by their position in the sorted MSB points
+        self.msb_points_df: dt.MSBPointsDf | None = None
+        self.msb_pdis: np.ndarray = np.array([], dtype=np.int64)
+        self.msb_markers: dict[int, str] = {}
 
-        range_start_time = self.pair_df.iloc[first_bar_pdi].time.timestamp()  # UNIX
-        range_end_time = self.pair_df.iloc[last_bar_pdi].time.timestamp()  # UNIX
+        self.zigzag_line: Line | None = None
+        self.zigzag_df: dt.ZigZagDf | None = None
 
-        msb_points_in_range = msb_points_df[(msb_points_df.pdi >= first_bar_pdi) & (msb_points_df.pdi <= last_bar_pdi)]
-        markers_out_of_range_ids = [marker_id for marker_id in self.chart.markers.keys() if
-                                    self.chart.markers[marker_id]['time'] < range_start_time or self.chart.markers[marker_id][
-                                        'time'] > range_end_time]
+        # The chart only keeps a single handler per event, so the range change handlers are dispatched from one registered callback.
+        self.range_change_handlers: list = []
+        self.chart.events.range_change += self.on_range_change
 
-        for marker_id in markers_out_of_range_ids:
-            self.chart.remove_marker(marker_id)
+    def on_range_change(self, chart, bars_before, bars_after):
+        first_bar_pdi, last_bar_pdi = self.get_visible_pdi_range(bars_before, bars_after)
 
-        # Draw the markers from msb_points_in_range that aren't already in the marker list.
-        current_marker_times = [marker['time'] for marker in self.chart.markers.values()]
-        msb_points_in_range_unix_times = self.pair_df.iloc[msb_points_in_range.pdi].time.apply(lambda x: x.timestamp())
-        boolfilter = ~msb_points_in_range_unix_times.isin(current_marker_times).reset_index(drop=True)
+        self.update_level_of_detail(first_bar_pdi, last_bar_pdi)
 
-        msb_points_to_draw = msb_points_in_range.reset_index()[boolfilter]
+        for handler in self.range_change_handlers:
+            handler(first_bar_pdi, last_bar_pdi)
 
-        self.draw_msb_points(msb_points_to_draw)
+    def register_msb_point_updates(self, msb_points_df: dt.MSBPointsDf):
+        self.msb_points_df = dt.MSBPointsDf(msb_points_df.sort_values(by=['pdi']).reset_index(drop=True))
+        self.msb_pdis = self.msb_points_df.pdi.to_numpy(dtype=np.int64)
 
-    def update_order_blocks_on_range_change(self, chart, bars_before, bars_after, order_blocks: list[OrderBlock]):
-        if bars_before < 0:
-            first_bar_pdi = self.pair_df.iloc[0].name
-        else:
-            first_bar_pdi = self.pair_df.iloc[int(bars_before)].name
+        # Subscribe to the event of the chart's range change
+        self.range_change_handlers.append(self.update_msb_points_on_range_change)
 
-        if bars_after < 0:
-            last_bar_pdi = self.pair_df.iloc[-1].name
-        else:
-            last_bar_pdi = self.pair_df.iloc[-int(bars_after)].name
-        #
-        range_start_time = self.pair_df.iloc[first_bar_pdi].time
-        range_end_time = self.pair_df.iloc[last_bar_pdi].time
-        #
-        # # Display order blocks if their starts or ends are within the bounds
-        order_blocks_in_range = [order_block for order_block in order_blocks if (first_bar_pdi <= order_block.formation_pdi <= last_bar_pdi) or
-                                 (first_bar_pdi <= order_block.end_pdi <= last_bar_pdi)]
-        #
-        # # Delete the now-out of range order blocks
-        out_of_range_ob_drawings = [ob_drawing for ob_drawing in self.ob_drawings if
-                            range_end_time < ob_drawing['start_time'] or ob_drawing['end_time'] < range_start_time]
-
-        # out_of_range_obs_times = [ob_drawing.start_time for ob_drawing in out_of_range_obs]
-        #
-        for ob_drawing in out_of_range_ob_drawings:
-            self.delete_ob_drawing(ob_drawing)
-
-        #
-        new_obs_to_draw = [order_block for order_block in order_blocks_in_range if
-                           self.pair_df.iloc[order_block.formation_pdi].time not in [ob_drawing['start_time'] for ob_drawing in self.ob_drawings]]
-
-        for new_order_block_to_draw in new_obs_to_draw:
-            self.draw_order_block(new_order_block_to_draw)
-
-        print(len(self.ob_drawings))
-
-    def draw_candlesticks(self, pair_df: dt.PairDf):
+    def register_ob_updates(self, order_blocks: list[OrderBlock]):
+        self.ob_index = OrderBlockIntervalIndex(order_blocks, last_pdi=len(self.pair_df) - 1)
+
+        self.range_change_handlers.append(self.update_order_blocks_on_range_change)
+
+    def get_visible_pdi_range(self, bars_before, bars_after) -> tuple[int, int]:
+        """
+        Converts the bars_before and bars_after values reported by the chart's range_change event to the first and last visible PDIs. The values are
+        counted in displayed bars, which may be aggregated candles. Negative values mean there is empty space between the edge of the chart and the
+        data.
+        """
+        window_start, window_end = self.lod_window
+
+        first_bar_pdi = min((window_start + max(int(bars_before), 0)) * self.lod_factor, len(self.pair_df) - 1)
+        last_bar_pdi = min((window_end - max(int(bars_after), 0)) * self.lod_factor, len(self.pair_df)) - 1
+
+        return first_bar_pdi, max(last_bar_pdi, first_bar_pdi)
+
+    def snap_pdi(self, pdi: int) -> int:
+        # The first PDI of the displayed candle which contains the given PDI. Negative PDIs count from the end, like end_pdi=-1.
+        if pdi < 0:
+            pdi += len(self.pair_df)
+
+        return pdi - pdi % self.lod_factor
+
+    def snap_time(self, pdi: int) -> pd.Timestamp:
+        # The time of the displayed candle containing the given PDI. Drawings are placed on these times, so they stay positioned on aggregated
+        # candles.
+        return self.time_index.to_timestamp(self.snap_pdi(pdi))
+
+    def update_level_of_detail(self, first_bar_pdi: int, last_bar_pdi: int):
+        """
+        Switches the displayed candles to the level of detail appropriate for the visible range: aggregated candles when zoomed out, native candles
+        when zoomed in. Only a window of the level around the visible range is displayed, which is moved when the visible range gets close to its
+        edges.
+        """
+        visible_span = last_bar_pdi - first_bar_pdi + 1
+        factor = self.lod.choose_factor(min(3 * visible_span, len(self.pair_df)))
+
+        level_len = len(self.lod.get_level(factor))
+        window_start = max((first_bar_pdi - visible_span) // factor, 0)
+        window_end = min((last_bar_pdi + visible_span) // factor + 1, level_len)
+
+        # Keep the current window as long as it is at the same level and still has at least half a visible span of margin on both sides (or reaches
+        # the edges of the data).
+        margin = visible_span // 2
+        current_start, current_end = self.lod_window
+        if factor == self.lod_factor and \
+                (current_start == 0 or current_start * factor <= first_bar_pdi - margin) and \
+                (current_end == level_len or current_end * factor > last_bar_pdi + margin):
+            return
+
+        self.set_displayed_candles(factor, window_start, window_end)
+        self.chart.set_visible_range(self.snap_time(first_bar_pdi), self.snap_time(last_bar_pdi))
+
+    def set_displayed_candles(self, factor: int, window_start: int, window_end: int):
+        # Drawings are placed on the times of the displayed candles, so they are removed and get redrawn by the range change handlers at the new
+        # level.
+        for ob_id in list(self.ob_drawings.keys()):
+            self.delete_ob_drawing(ob_id)
+
+        for msb_position in list(self.msb_markers.keys()):
+            self.chart.remove_marker(self.msb_markers.pop(msb_position))
+
+        self.lod_factor = factor
+        self.lod_window = (window_start, window_end)
+        self.chart.set(self.lod.get_level(factor).iloc[window_start:window_end])
+
+        if self.zigzag_df is not None:
+            self.set_zigzag_line()
+
+    def update_msb_points_on_range_change(self, first_bar_pdi: int, last_bar_pdi: int):
+        # The MSB points in range are a contiguous slice of the sorted MSB points
+        lo = int(np.searchsorted(self.msb_pdis, first_bar_pdi, side='left'))
+        hi = int(np.searchsorted(self.msb_pdis, last_bar_pdi, side='right'))
+        msb_positions_in_range = set(range(lo, hi))
+
+        # Only the markers leaving and entering the visible range are touched
+        for msb_position in self.msb_markers.keys() - msb_positions_in_range:
+            self.chart.remove_marker(self.msb_markers.pop(msb_position))
+
+        for msb_position in sorted(msb_positions_in_range - self.msb_markers.keys()):
+            self.msb_markers[msb_position] = self.draw_msb_point(self.msb_points_df.iloc[msb_position])
+
+    def update_order_blocks_on_range_change(self, first_bar_pdi: int, last_bar_pdi: int):
+        ob_ids_in_range = self.ob_index.query(first_bar_pdi, last_bar_pdi)
+
+        # Delete the now-out of range order blocks, and draw the ones that have just come into range
+        for ob_id in self.ob_drawings.keys() - ob_ids_in_range:
+            self.delete_ob_drawing(ob_id)
+
+        for ob_id in ob_ids_in_range - self.ob_drawings.keys():
+            self.draw_order_block(self.ob_index.order_blocks[ob_id])
+
+    def draw_candlesticks(self, pair_df: dt.PairDf, max_displayed_bars: int = 5000):
         self.pair_df = pair_df
-        self.chart.set(pair_df)
+        self.time_index = pair_df.time_index
+        self.lod = CandleLevelOfDetail(pair_df, max_displayed_bars=max_displayed_bars)
+
+        # Open the chart zoomed out over the whole history, at the level of detail which fits it in the displayed bars limit.
+        factor = self.lod.choose_factor(len(pair_df))
+        self.set_displayed_candles(factor, 0, len(self.lod.get_level(factor)))
 
     def draw_zigzag(self, zigzag_df: dt.ZigZagDf):
-        line = self.chart.create_line('pivot_value')
-        line.set(zigzag_df[['time', 'pivot_value']])
+        self.zigzag_df = zigzag_df
+        self.zigzag_line = self.chart.create_line('pivot_value')
+        self.set_zigzag_line()
+
+    def set_zigzag_line(self):
+        # Only the pivots within the displayed window are set on the line, with their times snapped to the displayed candles, since any other time
+        # would add points to the chart's time scale. Multiple pivots within one aggregated candle are reduced to the last one.
+        window_start, window_end = self.lod_window
+        zigzag_pdis = self.zigzag_df.pdi.to_numpy()
+        in_window = (zigzag_pdis >= window_start * self.lod_factor) & (zigzag_pdis < window_end * self.lod_factor)
+        snapped_pdis = zigzag_pdis[in_window] - zigzag_pdis[in_window] % self.lod_factor
+
+        zigzag_line_df = pd.DataFrame({
+            'time': self.time_index.to_timestamps(snapped_pdis),
+            'pivot_value': self.zigzag_df.pivot_value.to_numpy()[in_window]
+        }).drop_duplicates(subset='time', keep='last')
+
+        self.zigzag_line.set(zigzag_line_df)
+
+    def draw_msb_point(self, msb_point) -> str:
+        time = self.snap_time(msb_point.pdi)
+        if msb_point.type == 'long':
+            return self.chart.marker(time, position='above', shape='arrow_up', color='green')
+        else:
+            return self.chart.marker(time, position='below', shape='arrow_down', color='red')
 
     def draw_msb_points(self, msb_points_df: dt.MSBPointsDf):
-        plotting_df = msb_points_df.sort_values(by=['pdi'])
-        for _, msb_point in msb_points_df.iterrows():
-            time = self.pair_df.iloc[msb_point.pdi].time
-            if msb_point.type == 'long':
-                marker = self.chart.marker(time, position='above', shape='arrow_up', color='green')
-            else:
-                marker = self.chart.marker(time, position='below', shape='arrow_down', color='red')
+        for _, msb_point in msb_points_df.sort_values(by=['pdi']).iterrows():
+            self.draw_msb_point(msb_point)
 
     def draw_order_block(self, order_block):
-        ob_end_time = self.pair_df.iloc[order_block.end_pdi].time
+        ob_end_time = self.snap_time(order_block.end_pdi)
 
-        ob_formation_time = self.pair_df.iloc[order_block.formation_pdi].time
+        ob_formation_time = self.snap_time(order_block.formation_pdi)
         ob_start_value = order_block.top
         ob_end_value = order_block.bottom
 
@@ -129,10 +347,8 @@ class PlottingTool:
         #                                      fill_color=inactive_color)
         ob_box_drawing = self.chart.box(ob_formation_time, ob_start_value, ob_end_time, ob_end_value, color=border_color, fill_color=color)
 
-        # self.ob_drawings.append(ob_drawing)
-
         if order_block.position.entry_pdi:
-            entry_time = self.pair_df.iloc[order_block.position.entry_pdi].time
+            entry_time = self.snap_time(order_block.position.entry_pdi)
             if order_block.type == 'long':
                 entry_marker_id = self.chart.marker(entry_time, position='below', shape='arrow_up', color='green', text='buy')
             else:
@@ -140,23 +356,21 @@ class PlottingTool:
         else:
             entry_marker_id = None
 
-        self.ob_drawings.append({
+        self.ob_drawings[order_block.id] = {
             'order_block_box': ob_box_drawing,
             'entry_marker_id': entry_marker_id,
             'start_time': ob_formation_time,
             'end_time': ob_end_time
-        })
+        }
 
-    def delete_ob_drawing(self, ob_drawing_to_delete):
-        # Remove an order block box and its markers
+    def delete_ob_drawing(self, ob_id: str):
+        # Remove an order block box and its markers, along with its entry in self.ob_drawings
+        ob_drawing_to_delete = self.ob_drawings.pop(ob_id)
         ob_drawing_to_delete['order_block_box'].delete()
 
         if ob_drawing_to_delete['entry_marker_id']:
             self.chart.remove_marker(ob_drawing_to_delete['entry_marker_id'])
 
-        # Remove the entry from self.ob_drawings as well
-        self.ob_drawings = [ob_drawing for ob_drawing in self.ob_drawings if ob_drawing['start_time'] != ob_drawing_to_delete['start_time']]
-
     def draw_order_blocks(self, order_blocks: list[OrderBlock]):
         for order_block in order_blocks:
             self.draw_order_block(order_block)
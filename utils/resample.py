@@ -0,0 +1,158 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Bumped whenever the resampling or the derived file format change, so the derived files of older versions are rebuilt
+RESAMPLE_VERSION = 2
+
+timeframe_units = {'m': pd.Timedelta(minutes=1), 'h': pd.Timedelta(hours=1), 'd': pd.Timedelta(days=1), 'w': pd.Timedelta(weeks=1)}
+
+# Candles are aligned to multiples of their duration since the UNIX epoch, except weekly candles, which start on Mondays like the exchanges' (the
+# epoch is a Thursday)
+weekly_origin = pd.Timestamp('1970-01-05', tz='UTC').value
+
+
+def parse_timeframe(timeframe: str) -> pd.Timedelta:
+    # The duration of the candles of a standardized timeframe, e.g. "15m", "4h", "1d" or "1w"
+    try:
+        return int(timeframe[:-1]) * timeframe_units[timeframe[-1]]
+    except (KeyError, ValueError):
+        raise ValueError(f'Invalid timeframe "{timeframe}", expected a number followed by one of {", ".join(timeframe_units)}') from None
+
+
+def find_base_timeframe(pair_name: str, timeframe: str, cache_dir: str = './cached_data') -> str | None:
+    """
+    Finds the finest cached timeframe of a pair the given timeframe can be derived from, i.e. a finer timeframe whose duration divides it.
+
+    Returns:
+        str | None: The base timeframe, or None if the pair has no cached timeframe the timeframe can be derived from
+    """
+    duration = parse_timeframe(timeframe)
+
+    base_timeframes = []
+    for base_timeframe in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        try:
+            base_duration = parse_timeframe(base_timeframe)
+        except ValueError:
+            continue
+
+        if base_duration < duration and duration % base_duration == pd.Timedelta(0) and \
+                os.path.exists(f'{cache_dir}/{base_timeframe}/{pair_name}.hdf5'):
+            base_timeframes.append((base_duration, base_timeframe))
+
+    return min(base_timeframes)[1] if base_timeframes else None
+
+
+def resample_ohlc(pair_df: pd.DataFrame, timeframe: str) -> pd.DataFrame:
+    """
+    Aggregates the candles of a pair into candles of a higher timeframe. The candles must be sorted by time. Each candle takes the open of its first
+    candle, the highest high, the lowest low, the close of its last candle and the summed volume. The candle color is recomputed from the new open
+    and close: green if the close is at or above the open, red otherwise.
+
+    The aggregation is vectorized: the candles are assigned to their buckets by integer division of their epoch times, and each column is reduced
+    over the bucket boundaries with ufunc.reduceat. The buckets at the edges of the data are only kept if the data covers them: the first bucket is
+    dropped if the data starts after its start, and the last one if the data ends before its end, since their candles would only hold part of
+    the bucket's price action (e.g. a weekly candle built from the Sunday of data starting on a Sunday).
+
+    Args:
+        pair_df (pd.DataFrame): The candles, with a time column and the open, high, low and close columns
+        timeframe (str): The timeframe to aggregate the candles into
+
+    Returns:
+        pd.DataFrame: The aggregated candles, with the columns of pair_df among time, open, high, low, close, volume and candle_color
+    """
+    duration = parse_timeframe(timeframe).value
+    origin = weekly_origin if timeframe.endswith('w') else 0
+
+    times = pd.DatetimeIndex(pair_df['time']).as_unit('ns')
+    epochs = times.asi8
+    if len(epochs) == 0:
+        return pair_df.iloc[:0].copy()
+
+    buckets = (epochs - origin) // duration
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(epochs)] - 1
+
+    # The candle duration of the source data, from the smallest gap between its candles
+    source_duration = int(np.diff(epochs).min()) if len(epochs) > 1 else duration
+    if epochs[-1] + source_duration < (buckets[-1] + 1) * duration + origin:
+        starts, ends = starts[:-1], ends[:-1]
+    if len(starts) and epochs[0] > buckets[0] * duration + origin:
+        starts, ends = starts[1:], ends[1:]
+
+    bucket_times = pd.to_datetime(buckets[starts] * duration + origin, unit='ns', utc=True)
+    resampled_df = pd.DataFrame({'time': bucket_times.tz_convert(times.tz) if times.tz is not None else bucket_times.tz_localize(None)})
+
+    if len(starts):
+        reductions = {'open': lambda values: values[starts],
+                      'high': lambda values: np.maximum.reduceat(values, starts),
+                      'low': lambda values: np.minimum.reduceat(values, starts),
+                      'close': lambda values: values[ends],
+                      'volume': lambda values: np.add.reduceat(values, starts)}
+    else:
+        reductions = {column: lambda values: values[:0] for column in ['open', 'high', 'low', 'close', 'volume']}
+
+    # The candles of a dropped last bucket are left out, since reduceat reduces the last bucket up to the end of the array
+    n_used_candles = ends[-1] + 1 if len(ends) else 0
+    for column, reduce in reductions.items():
+        if column in pair_df.columns:
+            resampled_df[column] = reduce(pair_df[column].to_numpy()[:n_used_candles])
+
+    resampled_df['candle_color'] = np.where(resampled_df['close'] >= resampled_df['open'], 'green', 'red').astype(object)
+
+    return resampled_df
+
+
+def get_derived_path(pair_name: str, timeframe: str, cache_dir: str = './cached_data') -> str | None:
+    """
+    Returns the path of a cached file holding the candles of a pair in a timeframe which isn't cached itself, derived from the finest cached
+    timeframe it can be derived from. The derived files are kept in <cache_dir>/derived/<timeframe>, each with a .source.json file holding the
+    fingerprint of the file it was derived from (its path, size and modification time), and are rebuilt whenever the source file changes.
+
+    Returns:
+        str | None: The path of the derived .hdf5 file, or None if the timeframe can't be derived from any cached timeframe of the pair
+    """
+    base_timeframe = find_base_timeframe(pair_name, timeframe, cache_dir)
+    if base_timeframe is None:
+        return None
+
+    source_path = f'{cache_dir}/{base_timeframe}/{pair_name}.hdf5'
+    source_stat = os.stat(source_path)
+    source_fingerprint = {'version': RESAMPLE_VERSION, 'source_path': source_path, 'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns}
+
+    derived_dir = f'{cache_dir}/derived/{timeframe}'
+    derived_path = f'{derived_dir}/{pair_name}.hdf5'
+    fingerprint_path = f'{derived_dir}/{pair_name}.source.json'
+
+    try:
+        with open(fingerprint_path) as fingerprint_file:
+            if json.load(fingerprint_file) == source_fingerprint and os.path.exists(derived_path):
+                return derived_path
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    print(f'Deriving the {timeframe} candles of {pair_name} from its {base_timeframe} candles...')
+    with pd.HDFStore(source_path, mode='r') as store:
+        source_df = store.select(store.keys()[0])
+    resampled_df = resample_ohlc(source_df.sort_values('time', kind='stable'), timeframe)
+
+    # Written to temporary files which are then renamed, so concurrent processes never read a partial file. The fingerprint is written last, so
+    # an interrupted write is rebuilt by the next run.
+    os.makedirs(derived_dir, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=derived_dir, suffix='.tmp')
+    os.close(file_descriptor)
+    try:
+        resampled_df.to_hdf(temp_path, key='data', mode='w', format='table', data_columns=['time'])
+        os.replace(temp_path, derived_path)
+
+        with open(temp_path, 'w') as fingerprint_file:
+            json.dump(source_fingerprint, fingerprint_file)
+        os.replace(temp_path, fingerprint_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return derived_path
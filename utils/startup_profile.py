@@ -0,0 +1,68 @@
+import subprocess
+import sys
+import time
+
+from utils.config import load_config
+from utils.general_utils import get_executor
+
+
+def profile_imports(module_name: str) -> tuple[float, list[tuple[float, str]]]:
+    """
+    Imports a module in a fresh interpreter with -X importtime, so the modules already imported by this process don't hide their cost.
+
+    Args:
+        module_name (str): The module to import, e.g. "main_param_opt"
+
+    Returns:
+        tuple[float, list[tuple[float, str]]]: The total import time of the module in seconds, and the cumulative import time in seconds of each of
+            the modules it imports directly, slowest first
+    """
+    completed_process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module_name}'], capture_output=True, text=True,
+                                       check=True)
+
+    # Each line is "import time: <self us> | <cumulative us> | <module name indented by its nesting level>"
+    total_time = 0
+    direct_imports = []
+    for line in completed_process.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+
+        _, cumulative_us, indented_name = line[len('import time:'):].split('|')
+        name = indented_name.strip()
+        nesting_level = (len(indented_name) - len(indented_name.lstrip()) - 1) // 2
+
+        # A module is listed after the modules it imports, so the direct imports of the module are the top-level imports listed since the
+        # previous module imported by the interpreter itself
+        if nesting_level == 0:
+            if name == module_name:
+                total_time = int(cumulative_us) / 1e6
+                break
+            direct_imports = []
+        elif nesting_level == 1:
+            direct_imports.append((int(cumulative_us) / 1e6, name))
+
+    return total_time, sorted(direct_imports, reverse=True)
+
+
+def noop():
+    return None
+
+
+def report_startup_profile(module_name: str, n_slowest: int = 10):
+    """
+    Prints the time spent importing a script's modules, loading the configuration, and starting a worker process and running a first task on it.
+    Run with --startup_profile.
+    """
+    total_import_time, direct_imports = profile_imports(module_name)
+    print(f'Importing {module_name}: {total_import_time * 1000:.1f} ms')
+    for cumulative_time, name in direct_imports[:n_slowest]:
+        print(f'    {name}: {cumulative_time * 1000:.1f} ms')
+
+    start_time = time.perf_counter()
+    load_config()
+    print(f'Loading the configuration: {(time.perf_counter() - start_time) * 1000:.1f} ms')
+
+    start_time = time.perf_counter()
+    with get_executor(1, 'processes') as executor:
+        executor.submit(noop).result()
+    print(f'Starting a worker process: {(time.perf_counter() - start_time) * 1000:.1f} ms')
@@ -0,0 +1,205 @@
+import builtins
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+
+
+def get_rss_bytes() -> int | None:
+    """
+    Returns the resident set size of this process in bytes, or None if it can't be read on this platform. psutil is used if it's installed,
+    otherwise /proc/self/statm on Linux.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_pss_bytes() -> int | None:
+    """
+    Returns the proportional set size of this process in bytes: its private memory plus its share of the pages it shares with other processes, such
+    as the data forked workers inherit from the main process. Unlike the RSS, the PSS of several processes adds up to the memory they use together.
+    Read from /proc/self/smaps_rollup on Linux, otherwise the unique set size from psutil if it's installed, or None.
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as smaps_file:
+            for line in smaps_file:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    try:
+        import psutil
+        return psutil.Process().memory_full_info().uss
+    except (ImportError, AttributeError, OSError):
+        return None
+
+
+def get_worker_id() -> str:
+    # The process ID, and the thread name in a thread pool, of the worker running a task
+    thread_name = threading.current_thread().name
+    return str(os.getpid()) if thread_name == 'MainThread' else f'{os.getpid()}/{thread_name}'
+
+
+class PickledResult:
+    """
+    The result of a task pickled once in the worker, so its size is known without pickling it a second time. Pickling the object only copies the
+    pickled bytes, and unpickling it in the main process returns the result itself.
+    """
+
+    def __init__(self, result):
+        self.pickled_result = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __reduce__(self):
+        return pickle.loads, (self.pickled_result,)
+
+
+def run_measured_task(measure_bytes: bool, function, *args):
+    """
+    Runs a task in a worker and returns its result with the statistics of the run: the worker ID, the start and end times, the size of the
+    pickled result (0 unless measure_bytes, since the results of a thread pool aren't pickled) and the RSS and PSS of the worker afterwards. With
+    measure_bytes, the result is returned as a PickledResult, which is received as the result itself.
+    """
+    start_time = time.time()
+    result = function(*args)
+    end_time = time.time()
+
+    result_bytes = 0
+    if measure_bytes:
+        result = PickledResult(result)
+        result_bytes = len(result.pickled_result)
+
+    task_stats = {'worker_id': get_worker_id(), 'start_time': start_time, 'end_time': end_time,
+                  'result_bytes': result_bytes, 'rss_bytes': get_rss_bytes(), 'pss_bytes': get_pss_bytes()}
+    return result, task_stats
+
+
+class SweepTelemetry:
+    """
+    Collects the throughput statistics of a parameter sweep in the main process: the candles and tasks processed per second, the number of tasks
+    submitted but not finished yet (the queue depth), the bytes sent to and returned by the workers, and the busy time and RSS of each worker, which
+    the workers report with the result of each task (see run_measured_task).
+
+    While started, a background thread appends a snapshot of the statistics to a JSON lines file and rewrites a compact status line on the console
+    every interval seconds. A sweep limited by CPU shows busy workers, one limited by serialization shows idle workers and a large number of bytes
+    per task, and one limited by memory shows the RSS of the workers growing. Anything else printed meanwhile should go through print, which keeps
+    it from being mixed into the status line.
+    """
+
+    def __init__(self, metrics_path: str, interval: float):
+        self.metrics_path = metrics_path
+        self.interval = interval
+
+        self.start_time = time.time()
+        self.n_submitted_tasks = 0
+        self.n_finished_tasks = 0
+        self.n_candles = 0
+        self.sent_bytes = 0
+        self.received_bytes = 0
+
+        # The time spent running tasks and the last reported RSS of each worker
+        self.worker_busy_seconds: dict[str, float] = {}
+        self.worker_rss_bytes: dict[str, int | None] = {}
+
+        self.lock = threading.Lock()
+        self.console_lock = threading.Lock()
+        self.status_line = ''
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def start(self):
+        self.start_time = time.time()
+        os.makedirs(os.path.dirname(self.metrics_path) or '.', exist_ok=True)
+        self.thread = threading.Thread(target=self.report_periodically, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Stops the reporting thread and writes the final snapshot
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+        sys.stdout.write('\n')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def submit_tasks(self, n_tasks: int, sent_bytes: int):
+        # Registers tasks handed to the executor, and the size of their pickled arguments
+        with self.lock:
+            self.n_submitted_tasks += n_tasks
+            self.sent_bytes += sent_bytes
+
+    def finish_task(self, task_stats: dict, n_candles: int):
+        # Registers a task finished by a worker, with the statistics returned by run_measured_task
+        with self.lock:
+            self.n_finished_tasks += 1
+            self.n_candles += n_candles
+            self.received_bytes += task_stats['result_bytes']
+
+            worker_id = task_stats['worker_id']
+            self.worker_busy_seconds[worker_id] = self.worker_busy_seconds.get(worker_id, 0) + task_stats['end_time'] - task_stats['start_time']
+            self.worker_rss_bytes[worker_id] = task_stats['rss_bytes']
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            elapsed_seconds = time.time() - self.start_time
+            return {
+                'time': time.time(),
+                'elapsed_seconds': elapsed_seconds,
+                'candles_per_second': self.n_candles / elapsed_seconds if elapsed_seconds > 0 else 0,
+                'tasks_per_second': self.n_finished_tasks / elapsed_seconds if elapsed_seconds > 0 else 0,
+                'finished_tasks': self.n_finished_tasks,
+                'queue_depth': self.n_submitted_tasks - self.n_finished_tasks,
+                'sent_bytes': self.sent_bytes,
+                'received_bytes': self.received_bytes,
+                'main_rss_bytes': get_rss_bytes(),
+                'workers': {worker_id: {'busy_seconds': busy_seconds,
+                                        'idle_seconds': max(elapsed_seconds - busy_seconds, 0),
+                                        'rss_bytes': self.worker_rss_bytes[worker_id]}
+                            for worker_id, busy_seconds in self.worker_busy_seconds.items()},
+            }
+
+    def report(self):
+        # Appends a snapshot to the metrics file and rewrites the status line
+        snapshot = self.snapshot()
+        with open(self.metrics_path, 'a') as metrics_file:
+            metrics_file.write(json.dumps(snapshot) + '\n')
+
+        workers = snapshot['workers'].values()
+        utilization = sum(worker['busy_seconds'] for worker in workers) / (snapshot['elapsed_seconds'] * len(workers)) * 100 if workers else 0
+        worker_rss = [worker['rss_bytes'] for worker in workers if worker['rss_bytes'] is not None]
+        with self.console_lock:
+            self.status_line = (f'{snapshot["candles_per_second"]:,.0f} candles/s | {snapshot["tasks_per_second"]:.2f} tasks/s | '
+                                f'queue {snapshot["queue_depth"]} | {len(workers)} workers {utilization:.0f}% busy | '
+                                f'IPC {snapshot["sent_bytes"] / 2 ** 20:,.1f} MB out, {snapshot["received_bytes"] / 2 ** 20:,.1f} MB in | '
+                                f'max worker RSS {max(worker_rss, default=0) / 2 ** 20:,.0f} MB ')
+            sys.stdout.write(f'\r{self.status_line}')
+            sys.stdout.flush()
+
+    def print(self, *values):
+        # Prints a line above the status line: the status line is cleared, the line printed, and the status line written again below it
+        with self.console_lock:
+            sys.stdout.write('\r' + ' ' * len(self.status_line) + '\r')
+            builtins.print(*values)
+            sys.stdout.write(self.status_line)
+            sys.stdout.flush()
+
+    def report_periodically(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+
+class PairTimeIndex:
+    """
+    A bidirectional index between the PDIs of a pair and the times of its candles. The times are held as an int64 array of epoch nanoseconds, so
+    converting a batch of PDIs to times (or times to PDIs, using binary search) is a single vectorized operation instead of a Python loop of
+    pair_df.iloc[pdi].time lookups.
+    """
+
+    def __init__(self, epochs: np.ndarray, tz=None):
+        self.epochs: np.ndarray = epochs
+        self.tz = tz
+
+    @classmethod
+    def from_times(cls, times: pd.Series) -> 'PairTimeIndex':
+        times = pd.DatetimeIndex(times).as_unit('ns')
+        return cls(times.asi8, times.tz)
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def to_epochs(self, pdis: np.ndarray | list[int]) -> np.ndarray:
+        return self.epochs[np.asarray(pdis, dtype=np.int64)]
+
+    def to_unix(self, pdis: np.ndarray | list[int]) -> np.ndarray:
+        # UNIX times in seconds, as used by the charting library
+        return self.to_epochs(pdis) // 10 ** 9
+
+    def to_timestamps(self, pdis: np.ndarray | list[int]) -> pd.DatetimeIndex:
+        times = pd.to_datetime(self.to_epochs(pdis), unit='ns', utc=True)
+        return times.tz_convert(self.tz) if self.tz is not None else times.tz_localize(None)
+
+    def to_timestamp(self, pdi: int) -> pd.Timestamp:
+        time = pd.Timestamp(int(self.epochs[pdi]), tz='UTC')
+        return time.tz_convert(self.tz) if self.tz is not None else time.tz_localize(None)
+
+    def to_pdis(self, times, side: str = 'left') -> np.ndarray:
+        """
+        Finds the PDIs of the given times using binary search. For times which don't fall exactly on a candle, side='left' returns the PDI of the
+        next candle and side='right' returns the PDI after the last candle at or before the time.
+
+        Args:
+            times: The times to convert, anything pd.DatetimeIndex accepts, or int64 epoch nanoseconds
+            side (str): Passed to np.searchsorted
+
+        Returns:
+            np.ndarray: The PDIs of the times
+        """
+        if not (isinstance(times, np.ndarray) and times.dtype == np.int64):
+            times = pd.DatetimeIndex(np.atleast_1d(times))
+            if times.tz is None and self.tz is not None:
+                times = times.tz_localize(self.tz)
+            times = times.as_unit('ns').asi8
+
+        return np.searchsorted(self.epochs, times, side=side)